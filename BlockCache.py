@@ -0,0 +1,136 @@
+''' Cache of fixed size blocks of objects, shared by every object given it.
+
+    Range reads through an object with a block cache (see FitsObjStore.setBlockCache) are
+    split into 'block_size' blocks of the object: blocks already cached are copied from the
+    cache, and each run of missing blocks is fetched with one (block-aligned) range read.
+    Different requests that overlap - a cutout inside an earlier one, a spectrum through a
+    cached channel range, the same box in another batch - share the blocks they have in
+    common, rather than only identical requests sharing a result.
+
+    Blocks are keyed by (object id, block number), and the least recently used blocks are
+    removed once more than 'max_bytes' are cached. A block being fetched by one thread is
+    waited for by any other that needs it, so each block is read from the objectstore once.
+    Cached blocks are not updated when an object is rewritten - clear() them afterwards.
+'''
+import threading
+from collections import OrderedDict
+
+ONE_M = 1024 ** 2
+ONE_G = 1024 ** 3
+
+########################################################################################
+############################### CLASS BlockCache #######################################
+########################################################################################
+class BlockCache:
+    ''' Thread-safe LRU cache of object blocks. Blocks are immutable bytes, so a block removed
+        from the cache stays valid for a read that is still copying from it.
+    '''
+
+    def __init__(self,max_bytes=4*ONE_G,block_size=4*ONE_M):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.cached_bytes = 0
+        self.hits = 0 # blocks served from the cache
+        self.misses = 0 # blocks read from the objectstore
+        self.__blocks = OrderedDict() # (object id,block) -> bytes, in LRU order
+        self.__inflight = {} # (object id,block) -> threading.Event
+        self.__lock = threading.Lock()
+
+    def __store(self,key,data):
+        ''' Add a block and remove the least recently used beyond max_bytes (called holding the lock) '''
+        self.__blocks[key] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.max_bytes and len(self.__blocks) > 1:
+            (oldkey,old) = self.__blocks.popitem(last=False)
+            self.cached_bytes -= len(old)
+
+    def __fetch(self,objid,run,fetch):
+        ''' Read a run of consecutive missing blocks with one range read, and cache them '''
+        start = run[0]*self.block_size
+        data = bytearray(len(run)*self.block_size)
+        got = fetch(start,data)
+        blocks = {}
+        with self.__lock:
+            for b in run:
+                offset = (b - run[0])*self.block_size
+                if offset >= got:
+                    break
+                blocks[b] = bytes(data[offset:min(offset+self.block_size,got)])
+                self.__store((objid,b),blocks[b])
+        return blocks
+
+    def readInto(self,objid,start,buf,fetch):
+        ''' Fill 'buf' with the object's bytes from 'start', using cached blocks where possible.
+            'fetch(start,buf)' reads bytes of the object from the objectstore into a buffer and
+            returns the number read. Returns the number of bytes copied into 'buf'.
+        '''
+        mv = memoryview(buf).cast('B')
+        end = start + len(mv)
+        if end <= start:
+            return 0
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = {}
+        while len(blocks) < last - first + 1:
+            missing = []
+            waits = []
+            with self.__lock:
+                for b in range(first,last+1):
+                    if b in blocks:
+                        continue
+                    key = (objid,b)
+                    if key in self.__blocks:
+                        self.__blocks.move_to_end(key)
+                        blocks[b] = self.__blocks[key]
+                        self.hits += 1
+                    elif key in self.__inflight:
+                        waits.append(self.__inflight[key])
+                    else:
+                        self.__inflight[key] = threading.Event()
+                        missing.append(b)
+                self.misses += len(missing)
+            # Fetch each run of consecutive missing blocks in one read
+            runs = []
+            for b in missing:
+                if runs and runs[-1][-1] == b-1:
+                    runs[-1].append(b)
+                else:
+                    runs.append([b])
+            try:
+                for run in runs:
+                    fetched = self.__fetch(objid,run,fetch)
+                    blocks.update(fetched)
+                    if len(fetched) < len(run):
+                        # the object ends before the run does - nothing more to read
+                        last = min(last,run[0] + len(fetched) - 1)
+            finally:
+                with self.__lock:
+                    events = [self.__inflight.pop((objid,b)) for b in missing]
+                for event in events:
+                    event.set()
+            if not missing and waits:
+                waits[0].wait() # another thread is reading it - then look again
+        got = 0
+        for b in range(first,last+1):
+            bstart = b*self.block_size
+            data = blocks[b]
+            lo = max(start,bstart) - bstart
+            hi = min(end,bstart + len(data)) - bstart
+            if hi <= lo:
+                break
+            mv[max(start,bstart)-start:max(start,bstart)-start+hi-lo] = data[lo:hi]
+            got += hi - lo
+            if len(data) < self.block_size:
+                break # end of the object
+        mv.release()
+        return got
+
+    def clear(self,objid=None):
+        ''' Remove all cached blocks, or those of one object '''
+        with self.__lock:
+            if objid is None:
+                self.__blocks.clear()
+                self.cached_bytes = 0
+                return
+            for key in [key for key in self.__blocks if key[0] == objid]:
+                self.cached_bytes -= len(self.__blocks.pop(key))
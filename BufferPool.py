@@ -0,0 +1,147 @@
+''' Pool of large, page-aligned buffers for range reads.
+
+    Range responses are read straight into a pooled buffer (see FitsObjStore.readBytesInto),
+    the required pixels are extracted, and the buffer is returned to the pool - so repeated
+    reads reuse memory that is already mapped instead of allocating (and page-faulting) a
+    new 'bytes' object each time.
+
+    Buffers are anonymous mmaps, so are page-aligned. With hugepages=True sizes are rounded
+    to 2Mb and the kernel is asked to back them with transparent huge pages (Linux only).
+
+    While a memory limit is active (see BufferPool.limit()), the free buffers kept plus the
+    buffers in use stay within it, so a pool shared with other reads does not hold on to more
+    than a memory-limited read allows.
+'''
+import mmap
+import threading
+from contextlib import contextmanager
+
+PAGE_SIZE = mmap.PAGESIZE
+HUGE_PAGE_SIZE = 2 * 1024 ** 2
+ONE_M = 1024 ** 2
+FOUR_G = 4 * 1024 ** 3
+
+########################################################################################
+############################### CLASS BufferPool #######################################
+########################################################################################
+class BufferPool:
+    ''' Thread-safe pool of reusable mmap buffers. Up to 'max_bytes' of free buffers are kept;
+        buffers returned beyond that are released. Within limit(), the free buffers plus those
+        in use are kept within the (smallest) active limit instead.
+    '''
+
+    def __init__(self,max_bytes=FOUR_G,hugepages=False,populate=False):
+        self.max_bytes = max_bytes
+        self.hugepages = hugepages
+        self.populate = populate # pre-fault pages when a buffer is created
+        self.free_bytes = 0
+        self.used_bytes = 0 # bytes of the buffers handed out by get() and not yet put() back
+        self.allocated = 0 # number of buffers created
+        self.reused = 0 # number of requests served from the pool
+        self.__free = [] # free buffers, smallest first
+        self.__limits = [] # active memory limits, see limit()
+        self.__lock = threading.Lock()
+
+    def __allocate(self,nbytes):
+        align = HUGE_PAGE_SIZE if self.hugepages else PAGE_SIZE
+        # Round up to a whole number of Mb (at least), so similar requests share buffers
+        size = -(-max(nbytes,1) // max(align,ONE_M)) * max(align,ONE_M)
+        flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+        if self.populate and hasattr(mmap,'MAP_POPULATE'):
+            flags |= mmap.MAP_POPULATE
+        buf = mmap.mmap(-1,size,flags=flags)
+        if self.hugepages and hasattr(mmap,'MADV_HUGEPAGE'):
+            try:
+                buf.madvise(mmap.MADV_HUGEPAGE)
+            except OSError:
+                pass
+        self.allocated += 1
+        return buf
+
+    def __retained(self):
+        ''' Bytes of free buffers that may be kept (called holding the lock) '''
+        if self.__limits:
+            return max(0,min(self.max_bytes,min(self.__limits) - self.used_bytes))
+        return self.max_bytes
+
+    def __trim(self,keep):
+        ''' Remove free buffers, largest first, until at most 'keep' bytes are left (called 
+            holding the lock). Returns the buffers removed, to be released outside the lock.
+        '''
+        removed = []
+        while self.__free and self.free_bytes > keep:
+            buf = self.__free.pop()
+            self.free_bytes -= len(buf)
+            removed.append(buf)
+        return removed
+
+    @staticmethod
+    def __release(buffers):
+        for buf in buffers:
+            try:
+                buf.close()
+            except BufferError:
+                pass # still exported - let it be garbage collected
+
+    def get(self,nbytes):
+        ''' Return a buffer of at least 'nbytes' bytes - the smallest free one that fits, or a new one '''
+        with self.__lock:
+            for (i,buf) in enumerate(self.__free):
+                if len(buf) >= nbytes:
+                    del self.__free[i]
+                    self.free_bytes -= len(buf)
+                    self.used_bytes += len(buf)
+                    self.reused += 1
+                    return buf
+            # none fit - make room for the new buffer within any limit
+            removed = self.__trim(self.__retained() - nbytes)
+        self.__release(removed)
+        buf = self.__allocate(nbytes)
+        with self.__lock:
+            self.used_bytes += len(buf)
+        return buf
+
+    def put(self,buf):
+        ''' Return a buffer to the pool. No views of it may be used afterwards. '''
+        with self.__lock:
+            self.used_bytes = max(0,self.used_bytes - len(buf))
+            if self.free_bytes + len(buf) <= self.__retained():
+                self.__free.append(buf)
+                self.__free.sort(key=len)
+                self.free_bytes += len(buf)
+                return
+        self.__release([buf])
+
+    def clear(self):
+        ''' Release all free buffers '''
+        with self.__lock:
+            removed = self.__trim(0)
+        self.__release(removed)
+
+    @contextmanager
+    def limit(self,nbytes):
+        ''' Keep the pool's buffers (free plus in use) within 'nbytes' while the context is
+            active - free buffers beyond that are released on entry, and afterwards the pool
+            keeps no more than this until it is used again without a limit.
+        '''
+        with self.__lock:
+            self.__limits.append(nbytes)
+            removed = self.__trim(self.__retained())
+        self.__release(removed)
+        try:
+            yield self
+        finally:
+            with self.__lock:
+                self.__limits.remove(nbytes)
+
+
+__default_pool = None
+__default_lock = threading.Lock()
+
+def defaultPool():
+    ''' Return the buffer pool shared by all objects that have not been given their own '''
+    global __default_pool
+    with __default_lock:
+        if __default_pool is None:
+            __default_pool = BufferPool()
+        return __default_pool
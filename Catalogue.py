@@ -0,0 +1,297 @@
+''' Local catalogue of the FITS cubes held in a bucket.
+
+    The bucket is listed in parallel (see S3Sync.listObjects) and the header of each FITS
+    object is fetched concurrently - from its '.hdr' sidecar object if there is one, else
+    from the header blocks at the start of the object, or (source='metadata') from its
+    HEAD metadata. The headers, with the sky and spectral bounds of each cube, are kept in
+    a SQLite file, so finding the cubes that cover a region or frequency range is a local
+    query. update() only fetches objects that are new or whose ETag has changed.
+'''
+import json
+import time
+import sqlite3
+
+import numpy as np
+
+try:
+    from ObjStore.FITSheader import *
+    from ObjStore.S3Sync import listObjects,FITS_SUFFIXES
+    from ObjStore.RateLimiter import getLimiter
+except ModuleNotFoundError:
+    from FITSheader import *
+    from S3Sync import listObjects,FITS_SUFFIXES
+    from RateLimiter import getLimiter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    size INTEGER,
+    last_modified REAL,
+    hdrsize INTEGER,
+    xsize INTEGER,
+    ysize INTEGER,
+    zsize INTEGER,
+    ra_min REAL,
+    ra_max REAL,
+    dec_min REAL,
+    dec_max REAL,
+    spec_min REAL,
+    spec_max REAL,
+    spec_type TEXT,
+    spec_unit TEXT,
+    restfrq REAL,
+    header TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_dec ON objects (dec_min,dec_max);
+CREATE INDEX IF NOT EXISTS objects_spec ON objects (spec_min,spec_max);
+"""
+
+
+def cubeBounds(header):
+    ''' Return the sky and spectral bounds of a cube, given its header dict, as a dict of
+        ra_min, ra_max, dec_min, dec_max (degrees - ra_min > ra_max if the cube spans RA 0),
+        spec_min, spec_max (in spec_unit), spec_type, spec_unit and restfrq. Bounds that
+        cannot be found (eg no celestial axes) are None.
+    '''
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    bounds = dict.fromkeys(('ra_min','ra_max','dec_min','dec_max','spec_min','spec_max','spec_type','spec_unit','restfrq'))
+    hdr = fits.Header()
+    for (key,value) in header.items():
+        if key in ('HISTORY','ORIGIN') or key.startswith('COMMENT_') or value is None:
+            continue
+        try:
+            hdr[key] = value
+        except (ValueError,TypeError):
+            pass
+    try:
+        wcs = WCS(hdr)
+    except Exception:
+        return bounds
+    naxis = [int(header.get("NAXIS%s" % (n+1),1)) for n in range(wcs.naxis)]
+    if wcs.has_celestial:
+        celestial = wcs.celestial
+        (lon,lat) = (celestial.wcs.lng,celestial.wcs.lat)
+        (nx,ny) = (naxis[wcs.wcs.lng],naxis[wcs.wcs.lat])
+        # Sample the edges of the image plane (the corners alone miss a pole inside the cube)
+        edge = np.linspace(0,1,17)
+        px = np.concatenate((edge*nx-0.5,edge*nx-0.5,np.full(17,-0.5),np.full(17,nx-0.5),[nx/2-0.5]))
+        py = np.concatenate((np.full(17,-0.5),np.full(17,ny-0.5),edge*ny-0.5,edge*ny-0.5,[ny/2-0.5]))
+        world = celestial.wcs_pix2world(np.stack((px,py),axis=1) if lon == 0 else np.stack((py,px),axis=1),0)
+        ra = np.mod(world[:,lon],360.0)
+        dec = world[:,lat]
+        ok = np.isfinite(ra) & np.isfinite(dec)
+        if ok.any():
+            (ra,dec) = (ra[ok],dec[ok])
+            bounds["dec_min"] = float(dec.min())
+            bounds["dec_max"] = float(dec.max())
+            if bounds["dec_max"] > 89.999 or bounds["dec_min"] < -89.999:
+                (bounds["ra_min"],bounds["ra_max"]) = (0.0,360.0)
+            else:
+                # Smallest RA interval covering the samples - it wraps if the largest gap spans 0
+                order = np.sort(ra)
+                gaps = np.diff(np.concatenate((order,[order[0]+360.0])))
+                i = int(np.argmax(gaps))
+                bounds["ra_min"] = float(order[(i+1) % len(order)])
+                bounds["ra_max"] = float(order[i])
+    if wcs.has_spectral:
+        spectral = wcs.spectral
+        nz = naxis[wcs.wcs.spec]
+        values = spectral.wcs_pix2world(np.array([[-0.5],[nz-0.5]]),0)[:,0]
+        bounds["spec_min"] = float(values.min())
+        bounds["spec_max"] = float(values.max())
+        bounds["spec_type"] = spectral.wcs.ctype[0].split('-')[0]
+        bounds["spec_unit"] = str(spectral.wcs.cunit[0])
+        bounds["restfrq"] = float(wcs.wcs.restfrq) or None
+    return bounds
+
+
+########################################################################################
+############################### CLASS Catalogue ########################################
+########################################################################################
+class Catalogue:
+    ''' SQLite catalogue (in 'dbfile') of the FITS objects in one bucket '''
+
+    def __init__(self,dbfile,bucket,access_key_id,secret_access,endpoint="https://nimbus.pawsey.org.au:8080",num_threads=16,project=None):
+        import boto3
+        from botocore.config import Config
+        self.dbfile = dbfile
+        self.bucket = bucket
+        self.endpoint = endpoint
+        self.num_threads = num_threads
+        config = Config(max_pool_connections=max(10,num_threads))
+        self.client = boto3.session.Session().client(service_name='s3',aws_access_key_id=access_key_id,
+                                                     aws_secret_access_key=secret_access,endpoint_url=endpoint,config=config)
+        limiter = getLimiter(endpoint,project)
+        if limiter:
+            limiter.attach(self.client)
+        self.db = sqlite3.connect(dbfile,check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __readHeaderBlocks(self,key):
+        ''' Read the raw header from the start of an object, a block of reads at a time '''
+        data = b''
+        while True:
+            ranges = "bytes=%s-%s" % (len(data),len(data)+HEADER_READ-1)
+            chunk = self.client.get_object(Bucket=self.bucket,Key=key,Range=ranges)['Body'].read()
+            if not chunk:
+                return b''
+            start = len(data) - len(data) % FITS_HEADER_LINE_SIZE
+            data += chunk
+            pos = data.find(ENDHEADER,start)
+            while pos >= 0 and pos % FITS_HEADER_LINE_SIZE:
+                pos = data.find(ENDHEADER,pos+1)
+            if pos >= 0:
+                length = -(-(pos + FITS_HEADER_LINE_SIZE) // FITS_HEADER_BLOCK_SIZE) * FITS_HEADER_BLOCK_SIZE
+                return data[:length]
+            if len(chunk) < HEADER_READ:
+                return b''
+
+    def __fetch(self,key,sidecar,source):
+        ''' Return (raw header,header dict) for an object, from its sidecar, header blocks
+            or HEAD metadata. The raw header is b'' when taken from metadata.
+        '''
+        if source == 'metadata':
+            metadata = self.client.head_object(Bucket=self.bucket,Key=key).get('Metadata',{})
+            header = {}
+            for (name,value) in metadata.items():
+                if name.startswith('objstore-'):
+                    continue
+                # Values were stored as strings, with logicals as 'True'/'False'
+                value = {'True':'T','False':'F'}.get(value,value)
+                header[name.upper()] = parseValue(value)[0]
+            return (b'',header)
+        if sidecar:
+            raw = self.client.get_object(Bucket=self.bucket,Key=key+HEADER_SIDECAR_SUFFIX)['Body'].read()
+        else:
+            raw = self.__readHeaderBlocks(key)
+        return (raw,parseHeader(raw) if raw else {})
+
+    def update(self,prefix="",source='header',suffixes=FITS_SUFFIXES):
+        ''' Bring the catalogue up to date with the objects under 'prefix' whose keys end with
+            one of 'suffixes'. Only new objects, or those whose ETag has changed, are fetched;
+            objects no longer in the bucket are removed. 'source' is 'header' (sidecar or
+            header blocks) or 'metadata' (HEAD request - only the keywords stored on upload).
+            Returns (number added or updated, number removed).
+        '''
+        start = time.time()
+        listing = listObjects(self.client,self.bucket,prefix,self.num_threads)
+        cubes = dict([(key,val) for (key,val) in listing.items() if key.lower().endswith(tuple(suffixes))])
+        known = dict(self.db.execute("SELECT key,etag FROM objects WHERE key >= ? AND key < ?",(prefix,prefix+'￿')).fetchall())
+        changed = [key for (key,(size,etag,mtime)) in cubes.items() if known.get(key) != etag]
+        removed = [key for key in known if key not in cubes]
+
+        rows = []
+        if changed:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(processes=max(1,min(self.num_threads,len(changed))))
+            result_objs = [(key,pool.apply_async(self.__fetch,(key,key+HEADER_SIDECAR_SUFFIX in listing,source))) for key in changed]
+            for (key,result) in result_objs:
+                try:
+                    (raw,header) = result.get()
+                except Exception as e:
+                    print(f"Could not read the header of {key}: {e}",flush=True)
+                    continue
+                (size,etag,mtime) = cubes[key]
+                rows.append(self.__row(key,etag,size,mtime,raw,header))
+            pool.close()
+            pool.join()
+
+        with self.db:
+            self.db.executemany("DELETE FROM objects WHERE key = ?",[(key,) for key in removed])
+            self.db.executemany("INSERT OR REPLACE INTO objects VALUES (%s)" % ','.join(['?']*18),rows)
+        print(f"Catalogue of {self.bucket}/{prefix}: {len(rows)} updated, {len(removed)} removed, {len(cubes)-len(changed)} unchanged in {time.time()-start:.1f}s",flush=True)
+        return (len(rows),len(removed))
+
+    def __row(self,key,etag,size,mtime,raw,header):
+        bounds = dict.fromkeys(('ra_min','ra_max','dec_min','dec_max','spec_min','spec_max','spec_type','spec_unit','restfrq'))
+        sizes = [None,None,None]
+        if "NAXIS1" in header and "NAXIS2" in header:
+            sizes = [int(header["NAXIS1"]),int(header["NAXIS2"]),1]
+            if int(header.get("NAXIS",2)) == 3:
+                sizes[2] = int(header["NAXIS3"])
+            elif int(header.get("NAXIS",2)) > 3:
+                sizes[2] = int(header["NAXIS4"])
+            try:
+                bounds = cubeBounds(header)
+            except Exception as e:
+                print(f"Could not find the bounds of {key}: {e}",flush=True)
+        text = raw.decode('ascii','replace') if raw else json.dumps(header,default=str)
+        return (key,etag,size,mtime,len(raw) or None,*sizes,bounds["ra_min"],bounds["ra_max"],bounds["dec_min"],bounds["dec_max"],
+                bounds["spec_min"],bounds["spec_max"],bounds["spec_type"],bounds["spec_unit"],bounds["restfrq"],text)
+
+    def keys(self,prefix=""):
+        return [row[0] for row in self.db.execute("SELECT key FROM objects WHERE key >= ? AND key < ? ORDER BY key",(prefix,prefix+'￿'))]
+
+    def getHeader(self,key):
+        ''' Return a FITSheader holding the catalogued raw header of an object (None if not known
+            or catalogued from metadata)
+        '''
+        row = self.db.execute("SELECT header,hdrsize FROM objects WHERE key = ?",(key,)).fetchone()
+        if row is None or not row[1]:
+            return None
+        hdr = FITSheader()
+        hdr.hdr_data = row[0].encode('ascii')
+        hdr.length = row[1]
+        return hdr
+
+    def query(self,ra=None,dec=None,radius=0.0,spectral=None,doppler='radio'):
+        ''' Return the keys of the cubes that cover a sky position (ra,dec in degrees, with an
+            optional 'radius') and/or a spectral range (low,high). The spectral range is in the
+            units of each cube's spectral axis, or astropy Quantities (frequency, wavelength or,
+            using each cube's rest frequency and 'doppler', velocity).
+        '''
+        sql = "SELECT key,ra_min,ra_max,spec_min,spec_max,spec_unit,restfrq FROM objects"
+        args = []
+        if dec is not None:
+            sql += " WHERE dec_min <= ? AND dec_max >= ?"
+            args = [dec+radius,dec-radius]
+        keys = []
+        for (key,ra_min,ra_max,spec_min,spec_max,spec_unit,restfrq) in self.db.execute(sql+" ORDER BY key",args):
+            if ra is not None and not self.__containsRA(ra_min,ra_max,ra,dec,radius):
+                continue
+            if spectral is not None:
+                if spec_min is None:
+                    continue
+                (lo,hi) = self.__spectralRange(spectral,spec_unit,restfrq,doppler)
+                if lo is None or hi < spec_min or lo > spec_max:
+                    continue
+            keys.append(key)
+        return keys
+
+    @staticmethod
+    def __containsRA(ra_min,ra_max,ra,dec,radius):
+        if ra_min is None:
+            return False
+        # Widen the search in RA by the radius projected at the declination
+        cosdec = np.cos(np.radians(min(abs(dec if dec is not None else 0.0)+radius,89.999)))
+        dra = radius/cosdec if cosdec > 0 else 360.0
+        if dra >= 180.0 or (ra_min == 0.0 and ra_max == 360.0):
+            return True
+        ra = ra % 360.0
+        if ra_min <= ra_max:
+            width = ra_max - ra_min
+            offset = (ra - ra_min) % 360.0
+        else: # wraps through RA 0
+            width = ra_max + 360.0 - ra_min
+            offset = (ra - ra_min) % 360.0
+        return offset <= width + dra or offset >= 360.0 - dra
+
+    @staticmethod
+    def __spectralRange(spectral,unit,restfrq,doppler):
+        (lo,hi) = spectral
+        if not hasattr(lo,'unit'):
+            return (min(lo,hi),max(lo,hi))
+        from astropy import units as u
+        equiv = u.spectral()
+        if restfrq:
+            equiv = equiv + getattr(u,'doppler_%s' % doppler)(restfrq * u.Hz)
+        try:
+            values = [lo.to_value(u.Unit(unit),equivalencies=equiv),hi.to_value(u.Unit(unit),equivalencies=equiv)]
+        except (u.UnitConversionError,ValueError):
+            return (None,None)
+        return (min(values),max(values))
@@ -0,0 +1,189 @@
+''' In-memory registry of the json certs file (see certs.json for the layout).
+
+    The file is parsed once and re-read only when its modification time changes.
+    Access keys, download URLs and upload dicts are indexed by (endpoint,project,...) tuples,
+    and presigned URLs are cached along with their expiry time. Where the access keys for
+    a project are known, URLs close to expiry are re-signed locally, in bulk.
+'''
+import os
+import ast
+import json
+import time
+import base64
+import threading
+import calendar
+from urllib.parse import urlparse, parse_qs
+
+RENEW_MARGIN = 3600 # Re-sign URLs that expire within the hour
+DEFAULT_EXPIRY = 8640000 # 100 days
+
+
+def urlExpiry(url):
+    ''' Return the expiry time (unix seconds) of a presigned URL, or None if not known.
+        Handles both V2 ('Expires=') and V4 ('X-Amz-Date' + 'X-Amz-Expires') signatures.
+    '''
+    query = parse_qs(urlparse(url).query)
+    if "Expires" in query:
+        return float(query["Expires"][0])
+    if "X-Amz-Date" in query and "X-Amz-Expires" in query:
+        signed = calendar.timegm(time.strptime(query["X-Amz-Date"][0],"%Y%m%dT%H%M%SZ"))
+        return signed + float(query["X-Amz-Expires"][0])
+    return None
+
+
+def uploadExpiry(upload_dict):
+    ''' Return the expiry time (unix seconds) of a presigned upload dict, taken from its policy '''
+    try:
+        policy = json.loads(base64.b64decode(upload_dict["fields"]["policy"]))
+        return calendar.timegm(time.strptime(policy["expiration"][:19],"%Y-%m-%dT%H:%M:%S"))
+    except (KeyError,ValueError,TypeError):
+        return None
+
+
+########################################################################################
+############################### CLASS CertsRegistry ####################################
+########################################################################################
+class CertsRegistry:
+    ''' Holds the contents of one certs file, indexed for direct lookup. '''
+
+    def __init__(self,filename,margin=RENEW_MARGIN):
+        self.filename = os.path.expanduser(filename)
+        self.margin = margin
+        self.projects = {} # (endpoint,project) -> (access_id,secret_id,quota)
+        self.download_urls = {} # (endpoint,project,bucket,objname) -> url
+        self.upload_urls = {} # (endpoint,project,bucket,objname) -> upload dict
+        self.__presigned = {} # (method,endpoint,project,bucket,objname) -> (url or dict,expiry)
+        self.__clients = {}
+        self.__mtime = None
+        self.__lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        ''' Re-read the certs file if it has changed since it was last loaded '''
+        mtime = os.stat(self.filename).st_mtime
+        if mtime == self.__mtime:
+            return
+        with self.__lock:
+            if mtime == self.__mtime:
+                return
+            with open(self.filename,'r') as cert_file:
+                cert_data = json.load(cert_file)
+            projects = {}
+            download_urls = {}
+            upload_urls = {}
+            for endpoint,edata in cert_data.get("endpoints",{}).items():
+                for project,access in edata.get("projects",{}).items():
+                    projects[(endpoint,project)] = (access.get("access",""),access.get("secret",""),access.get("quota",""))
+                    for bucket,bdata in access.get("bucket",{}).items():
+                        for objname,url in bdata.get("download_urls",{}).items():
+                            download_urls[(endpoint,project,bucket,objname)] = url
+                        for objname,upload in bdata.get("upload_urls",{}).items():
+                            if objname == "HELP":
+                                continue
+                            if isinstance(upload,str) and upload != "":
+                                upload = ast.literal_eval(upload)
+                            upload_urls[(endpoint,project,bucket,objname)] = upload
+            self.projects = projects
+            self.download_urls = download_urls
+            self.upload_urls = upload_urls
+            self.__presigned = {}
+            self.__mtime = mtime
+
+    def getAccessKeys(self,endpoint,project):
+        ''' Return (access_id,secret_id,quota) for the project '''
+        self.refresh()
+        return self.projects[(endpoint,project)]
+
+    def __hasKeys(self,endpoint,project):
+        keys = self.projects.get((endpoint,project))
+        return bool(keys and keys[0] and keys[1] and not keys[0].startswith('*'))
+
+    def __client(self,endpoint,project):
+        ''' One boto3 client per project, for local signing of URLs '''
+        with self.__lock:
+            if (endpoint,project) not in self.__clients:
+                import boto3
+                (access_id,secret_id,quota) = self.projects[(endpoint,project)]
+                self.__clients[(endpoint,project)] = boto3.client(service_name='s3',aws_access_key_id=access_id,aws_secret_access_key=secret_id, endpoint_url=endpoint)
+            return self.__clients[(endpoint,project)]
+
+    def __cached(self,cachekey,now):
+        entry = self.__presigned.get(cachekey)
+        if entry and (entry[1] is None or entry[1] - now > self.margin):
+            return entry[0]
+        return None
+
+    def getDownloadURL(self,endpoint,project,bucket,objname,expiry=DEFAULT_EXPIRY):
+        ''' Return a download URL for the object. If the URL in the certs file has expired
+            (or is about to) and the project keys are known, a new one is signed locally.
+        '''
+        return self.getDownloadURLs(endpoint,project,bucket,[objname],expiry)[0]
+
+    def getDownloadURLs(self,endpoint,project,bucket,objnames,expiry=DEFAULT_EXPIRY):
+        ''' As getDownloadURL(), for a list of objects. Objects with no valid URL are all
+            signed in one go. Objects without an entry in the certs file are signed if the
+            project keys are known.
+        '''
+        self.refresh()
+        now = time.time()
+        urls = []
+        renew = []
+        for objname in objnames:
+            cachekey = ('get_object',endpoint,project,bucket,objname)
+            url = self.__cached(cachekey,now)
+            if url is None:
+                url = self.download_urls.get((endpoint,project,bucket,objname),"")
+                stamp = urlExpiry(url) if url else None
+                if url and (stamp is None or stamp - now > self.margin):
+                    self.__presigned[cachekey] = (url,stamp)
+                elif self.__hasKeys(endpoint,project):
+                    renew.append(len(urls))
+                elif url == "":
+                    raise ValueError("URL for download not found")
+                elif stamp < now:
+                    raise ValueError("URL has expired")
+            urls.append(url)
+
+        if renew:
+            client = self.__client(endpoint,project)
+            for indx in renew:
+                objname = objnames[indx]
+                url = client.generate_presigned_url(ClientMethod='get_object', Params={'Bucket': bucket, 'Key': objname}, ExpiresIn=expiry)
+                self.__presigned[('get_object',endpoint,project,bucket,objname)] = (url,now+expiry)
+                urls[indx] = url
+        return urls
+
+    def getUploadDict(self,endpoint,project,bucket,objname,expiry=DEFAULT_EXPIRY):
+        ''' Return the presigned upload dict for the object, signing a new one locally if
+            it is missing or about to expire and the project keys are known.
+        '''
+        self.refresh()
+        now = time.time()
+        cachekey = ('post_object',endpoint,project,bucket,objname)
+        upload_dict = self.__cached(cachekey,now)
+        if upload_dict is not None:
+            return upload_dict
+        upload_dict = self.upload_urls.get((endpoint,project,bucket,objname),"")
+        stamp = uploadExpiry(upload_dict) if upload_dict else None
+        if upload_dict and (stamp is None or stamp - now > self.margin):
+            self.__presigned[cachekey] = (upload_dict,stamp)
+            return upload_dict
+        if self.__hasKeys(endpoint,project):
+            upload_dict = self.__client(endpoint,project).generate_presigned_post(bucket,objname,ExpiresIn=expiry)
+            self.__presigned[cachekey] = (upload_dict,now+expiry)
+            return upload_dict
+        if not upload_dict:
+            raise ValueError("URL for upload not found")
+        return upload_dict
+
+
+__registries = {}
+__registries_lock = threading.Lock()
+
+def getRegistry(filename):
+    ''' Return the (shared) CertsRegistry for a certs file '''
+    path = os.path.abspath(os.path.expanduser(filename))
+    with __registries_lock:
+        if path not in __registries:
+            __registries[path] = CertsRegistry(path)
+        return __registries[path]
@@ -0,0 +1,210 @@
+''' Integrity checksums for objects, computed as the bytes stream through upload and read.
+
+    An object is checksummed in fixed blocks (BLOCK_SIZE bytes): the CRC of each block is
+    kept in a table, stored as a small sidecar object ('<key>' + CHECKSUM_SUFFIX), so any
+    range read can check the whole blocks it covers without reading anything else. The MD5
+    of each upload part is also kept, giving the composite (S3 multipart ETag style) MD5 of
+    the whole object, which is checked against the ETag the objectstore returns.
+
+    CRC32C is used if the 'crc32c' or 'google_crc32c' package is installed, else zlib's
+    CRC32 - both run in native code over the buffers already in memory.
+'''
+import io
+import json
+import zlib
+import hashlib
+
+import numpy as np
+
+try:
+    import crc32c as __crc32c
+    CHECKSUM_ALGORITHM = 'crc32c'
+    def crc(data,value=0):
+        return __crc32c.crc32c(data,value)
+except ModuleNotFoundError:
+    try:
+        import google_crc32c as __crc32c
+        CHECKSUM_ALGORITHM = 'crc32c'
+        def crc(data,value=0):
+            return __crc32c.extend(value,bytes(data)) if value else __crc32c.value(bytes(data))
+    except ModuleNotFoundError:
+        CHECKSUM_ALGORITHM = 'crc32'
+        def crc(data,value=0):
+            return zlib.crc32(data,value)
+
+BLOCK_SIZE = 1024 ** 2 # bytes per checksummed block
+CHECKSUM_SUFFIX = '.crc' # key suffix of the sidecar object holding the block checksums
+CHECKSUM_KEY = 'objstore-checksum' # metadata entry naming the checksum sidecar
+
+
+class ChecksumError(IOError):
+    ''' Bytes transferred do not match their checksum '''
+    pass
+
+
+def blockChecksums(data,blocksize=BLOCK_SIZE):
+    ''' Return the CRCs of each 'blocksize' block of a buffer (the last may be short), as a uint32 array '''
+    mv = memoryview(data).cast('B')
+    return np.array([crc(mv[i:i+blocksize]) for i in range(0,len(mv),blocksize)],dtype=np.uint32)
+
+
+def makeManifest(description,blocks):
+    ''' Return the sidecar contents: a json line describing the checksums, then the block CRCs '''
+    table = np.asarray(blocks,dtype='>u4').tobytes()
+    description = dict(description,crc="%08x" % crc(table))
+    return json.dumps(description).encode() + b'\n' + table
+
+
+def compositeMD5(digests):
+    ''' Return the S3 multipart-style MD5 of an object, given the MD5 digests of its parts '''
+    if len(digests) == 1:
+        return digests[0].hex()
+    return "%s-%s" % (hashlib.md5(b''.join(digests)).hexdigest(),len(digests))
+
+
+########################################################################################
+############################### CLASS StreamChecksum ###################################
+########################################################################################
+class StreamChecksum:
+    ''' Checksums of an object whose bytes are passed to update() in order: a CRC per
+        'blocksize' block and an MD5 per 'partsize' part (partsize a multiple of blocksize).
+    '''
+
+    def __init__(self,partsize,blocksize=BLOCK_SIZE,algorithm=CHECKSUM_ALGORITHM):
+        if algorithm != CHECKSUM_ALGORITHM:
+            raise ValueError("Checksums were made with %s, but only %s is available" % (algorithm,CHECKSUM_ALGORITHM))
+        self.partsize = partsize
+        self.blocksize = blocksize
+        self.algorithm = algorithm
+        self.size = 0
+        self.__blocks = []
+        self.__digests = []
+        self.__block_crc = 0
+        self.__block_fill = 0
+        self.__md5 = hashlib.md5()
+        self.__part_fill = 0
+
+    def update(self,data):
+        mv = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(mv):
+            n = min(len(mv)-pos,self.blocksize-self.__block_fill,self.partsize-self.__part_fill)
+            chunk = mv[pos:pos+n]
+            self.__block_crc = crc(chunk,self.__block_crc)
+            self.__md5.update(chunk)
+            self.__block_fill += n
+            self.__part_fill += n
+            pos += n
+            if self.__block_fill == self.blocksize:
+                self.__blocks.append(self.__block_crc)
+                (self.__block_crc,self.__block_fill) = (0,0)
+            if self.__part_fill == self.partsize:
+                self.__digests.append(self.__md5.digest())
+                (self.__md5,self.__part_fill) = (hashlib.md5(),0)
+        self.size += len(mv)
+
+    def blocks(self):
+        ''' Return the block CRCs so far, including a final short block '''
+        blocks = self.__blocks + ([self.__block_crc] if self.__block_fill else [])
+        return np.array(blocks,dtype=np.uint32)
+
+    def md5(self):
+        ''' Return the composite MD5 of everything so far (the ETag of a multipart upload in 'partsize' parts) '''
+        digests = self.__digests + ([self.__md5.digest()] if self.__part_fill or not self.__digests else [])
+        return compositeMD5(digests)
+
+    def manifest(self):
+        ''' Return the sidecar contents: a json line describing the checksums, then the block CRCs '''
+        description = {"algorithm":self.algorithm,"blocksize":self.blocksize,"partsize":self.partsize,
+                       "size":self.size,"md5":self.md5()}
+        return makeManifest(description,self.blocks())
+
+
+def checksumFile(path,partsize,blocksize=BLOCK_SIZE,readsize=64*1024**2):
+    ''' Return the StreamChecksum of a local file '''
+    checksum = StreamChecksum(partsize,blocksize)
+    with open(path,'rb') as f:
+        while True:
+            data = f.read(readsize)
+            if not data:
+                break
+            checksum.update(data)
+    return checksum
+
+
+########################################################################################
+############################### CLASS ChecksumReader ###################################
+########################################################################################
+class ChecksumReader(io.RawIOBase):
+    ''' Read-only stream that checksums the bytes of another stream as they are read, so an
+        upload is checksummed in-line. Not seekable, so the bytes are read once, in order.
+    '''
+
+    def __init__(self,stream,checksum):
+        io.RawIOBase.__init__(self)
+        self.stream = stream
+        self.checksum = checksum
+
+    def readable(self):
+        return True
+
+    def readinto(self,b):
+        n = self.stream.readinto(b)
+        if n:
+            self.checksum.update(memoryview(b)[:n])
+        return n
+
+
+########################################################################################
+############################### CLASS ObjectChecksums ##################################
+########################################################################################
+class ObjectChecksums:
+    ''' Block checksums of a stored object, read from its sidecar, for checking range reads '''
+
+    def __init__(self,manifest):
+        (description,table) = manifest.split(b'\n',1)
+        description = json.loads(description)
+        if description["algorithm"] != CHECKSUM_ALGORITHM:
+            raise ValueError("Checksums were made with %s, but only %s is available" % (description["algorithm"],CHECKSUM_ALGORITHM))
+        self.blocksize = description["blocksize"]
+        self.partsize = description["partsize"]
+        self.size = description["size"]
+        self.md5 = description["md5"]
+        self.blocks = np.frombuffer(table,dtype='>u4').copy()
+        if "%08x" % crc(table) != description["crc"]:
+            raise ChecksumError("Checksum table is corrupt")
+
+    def updateBlocks(self,start,data):
+        ''' Replace the CRCs of the blocks held in 'data', which starts at block boundary 'start'
+            and holds whole blocks (or runs to the end of the object).
+        '''
+        if start % self.blocksize:
+            raise ValueError("Checksum update at %s is not on a %s byte block boundary" % (start,self.blocksize))
+        first = start // self.blocksize
+        blocks = blockChecksums(data,self.blocksize)
+        self.blocks[first:first+len(blocks)] = blocks
+
+    def manifest(self):
+        ''' Return the sidecar contents for the current block CRCs '''
+        description = {"algorithm":CHECKSUM_ALGORITHM,"blocksize":self.blocksize,"partsize":self.partsize,
+                       "size":self.size,"md5":self.md5}
+        return makeManifest(description,self.blocks)
+
+    def verify(self,start,data):
+        ''' Check the whole blocks within 'data' (bytes read from 'start'). Partial blocks at
+            the ends of the range cannot be checked and are skipped. Returns the number of
+            bytes checked; raises ChecksumError on a mismatch.
+        '''
+        mv = memoryview(data).cast('B')
+        end = start + len(mv)
+        first = -(-start // self.blocksize)
+        checked = 0
+        for block in range(first,len(self.blocks)):
+            bstart = block*self.blocksize
+            bend = min(bstart + self.blocksize,self.size)
+            if bend > end:
+                break
+            if crc(mv[bstart-start:bend-start]) != self.blocks[block]:
+                raise ChecksumError("Bytes %s-%s do not match their checksum" % (bstart,bend-1))
+            checked += bend - bstart
+        return checked
@@ -0,0 +1,160 @@
+''' Dry-run planning of cutout reads.
+
+    For a cutout (xmin,xmax,ymin,ymax,zmin,zmax) of a datacube, each reader - strategies 1, 2
+    and 3 of getPartitionDataByStrategy(), the threaded getPartitionData() and the merged
+    reads of getPartitionDataBatch() - is turned into the exact list of byte ranges it would
+    read, with the bytes, number of GET requests and peak buffer memory that follow. The time
+    of each is estimated from a LinkProfile (request latency and bandwidth, which can be
+    measured against a real object with measureProfile()), so the cheapest can be chosen
+    before anything is read.
+'''
+import time
+
+try:
+    from ObjStore.RangePlanner import *
+except ModuleNotFoundError:
+    from RangePlanner import *
+
+FLOAT_SIZE = 4
+
+########################################################################################
+############################### CLASS LinkProfile ######################################
+########################################################################################
+class LinkProfile:
+    ''' Cost model of the link to the objectstore: 'latency' seconds to open each request,
+        and 'bandwidth' bytes/s per stream, up to 'max_bandwidth' bytes/s in total.
+    '''
+
+    def __init__(self,latency=0.05,bandwidth=100*1024**2,max_bandwidth=1024**3):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_bandwidth = max_bandwidth
+
+    def __repr__(self):
+        return "LinkProfile(latency=%.4fs, bandwidth=%.1fMb/s, max_bandwidth=%.1fMb/s)" % \
+               (self.latency,self.bandwidth/1024**2,self.max_bandwidth/1024**2)
+
+    def estimate(self,lengths,num_threads=1):
+        ''' Estimated seconds to make reads of the given lengths on 'num_threads' streams '''
+        if not lengths:
+            return 0.0
+        num_threads = max(1,min(num_threads,len(lengths)))
+        per_stream = sum([self.latency + length/self.bandwidth for length in lengths]) / num_threads
+        return max(per_stream,max([self.latency + length/self.bandwidth for length in lengths]),
+                   sum(lengths)/self.max_bandwidth)
+
+
+def measureProfile(obj,samples=5,size=16*1024**2,num_threads=4):
+    ''' Measure a LinkProfile by timing reads of a real object (an S3Object or UrlObject):
+        small reads give the latency, 'size' byte reads the bandwidth of one stream, and
+        'num_threads' concurrent reads the total bandwidth.
+    '''
+    objsize = obj.getObjectSize()
+    size = max(1,min(size,objsize))
+    small = []
+    for i in range(samples):
+        start = time.time()
+        obj.readBytes(0,min(4096,objsize))
+        small.append(time.time() - start)
+    latency = sorted(small)[len(small)//2]
+    large = []
+    for i in range(max(1,samples//2)):
+        start = time.time()
+        obj.readBytes(0,size)
+        large.append(time.time() - start)
+    bandwidth = size / max(sorted(large)[len(large)//2] - latency,1e-6)
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(processes=num_threads)
+    start = time.time()
+    pool.starmap(obj.readBytes,[(0,size)]*num_threads)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    max_bandwidth = max(bandwidth,num_threads*size / max(elapsed - latency,1e-6))
+    return LinkProfile(latency,bandwidth,max_bandwidth)
+
+
+########################################################################################
+############################### CLASS ReadPlan #########################################
+########################################################################################
+class ReadPlan:
+    ''' The reads one reader would make for a cutout. 'ranges' are the (start,length) byte
+        ranges in the order they are requested; 'peak_memory' is the most bytes held at once
+        (reads in flight plus the result).
+    '''
+
+    def __init__(self,name,ranges,peak_memory,num_threads,profile):
+        self.name = name
+        self.ranges = ranges
+        self.nbytes = sum([length for (start,length) in ranges])
+        self.requests = len(ranges)
+        self.peak_memory = peak_memory
+        self.num_threads = num_threads
+        self.time = profile.estimate([length for (start,length) in ranges],num_threads)
+
+    def __repr__(self):
+        return "ReadPlan(%s: %s requests, %s bytes, peak memory %s bytes, %s threads, ~%.2fs)" % \
+               (self.name,self.requests,self.nbytes,self.peak_memory,self.num_threads,self.time)
+
+
+def planCutout(geometry,box,num_threads=1,profile=None,maxread=None,cutout_read=None,gap=MERGE_GAP,max_memory=None):
+    ''' Return {name: ReadPlan} for reading the (xmin,xmax,ymin,ymax,zmin,zmax) 'box' from a
+        datacube with geometry (xsize,ysize,zsize,hdrsize), for each reader:
+            'strategy1', 'strategy2', 'strategy3' : getPartitionDataByStrategy (one thread)
+            'partition' : getPartitionData - reads of up to 'maxread' bytes
+            'batch'     : getPartitionDataBatch - merged row spans, reads of up to 'cutout_read' bytes
+        Plans that cannot be made (eg strategy 2 when a channel is bigger than 'maxread', or
+        'partition' within 'max_memory') are left out.
+    '''
+    profile = profile or LinkProfile()
+    (xsize,ysize,zsize,hdrsize) = geometry
+    (xmin,xmax,ymin,ymax,zmin,zmax) = box
+    (xlen,ylen,zlen) = (xmax-xmin+1,ymax-ymin+1,zmax-zmin+1)
+    chbytes = xsize*ysize*FLOAT_SIZE
+    result = xlen*ylen*zlen*FLOAT_SIZE
+    maxread = maxread or chbytes
+    cutout_read = cutout_read or maxread
+    channels = [(hdrsize + z*chbytes,chbytes) for z in range(zmin,zmax+1)]
+    plans = {}
+
+    # Strategy 1: whole channels, one at a time. Results are concatenated (held twice)
+    plans['strategy1'] = ReadPlan('strategy1',channels,chbytes + 2*result,1,profile)
+
+    # Strategy 2: as many whole channels as fit in maxread per read
+    batch = maxread // chbytes
+    if batch > 0:
+        ranges = [(hdrsize + z*chbytes,min(batch,zmax+1-z)*chbytes) for z in range(zmin,zmax+1,batch)]
+        plans['strategy2'] = ReadPlan('strategy2',ranges,max([r[1] for r in ranges]) + 2*result,1,profile)
+
+    # Strategy 3: each row of the cutout on its own
+    rows = [(hdrsize + z*chbytes + (y*xsize + xmin)*FLOAT_SIZE,xlen*FLOAT_SIZE) for z in range(zmin,zmax+1) for y in range(ymin,ymax+1)]
+    plans['strategy3'] = ReadPlan('strategy3',rows,2*result,1,profile)
+
+    # getPartitionData: whole channels, merged into reads of up to maxread bytes on a pool of threads
+    limit = max(maxread,chbytes)
+    if max_memory:
+        reads_memory = max_memory - result
+        limit = min(maxread,max(chbytes,reads_memory // max(num_threads,1))) if reads_memory >= chbytes else 0
+    if limit:
+        groups = coalesceRanges(channels,gap=gap,maxlen=limit)
+        threads = max(1,min(num_threads,len(groups)))
+        if max_memory:
+            threads = min(threads,max(1,reads_memory // limit))
+        inflight = sum(sorted([g.length() for g in groups])[-threads:])
+        plans['partition'] = ReadPlan('partition',[(g.start,g.length()) for g in groups],inflight + result,threads,profile)
+
+    # getPartitionDataBatch: only the span of rows holding the cutout, merged when close
+    (ranges,owners) = boxRanges([box],xsize,ysize,zsize,hdrsize,FLOAT_SIZE)
+    groups = coalesceRanges(ranges,gap=gap,maxlen=max(cutout_read,max([r[1] for r in ranges])))
+    threads = max(1,min(num_threads,len(groups)))
+    inflight = sum(sorted([g.length() for g in groups])[-threads:])
+    plans['batch'] = ReadPlan('batch',[(g.start,g.length()) for g in groups],inflight + result,threads,profile)
+    return plans
+
+
+def cheapestPlan(plans,max_memory=None):
+    ''' Return the ReadPlan with the lowest estimated time (within 'max_memory', if given) '''
+    candidates = [plan for plan in plans.values() if not max_memory or plan.peak_memory <= max_memory]
+    if not candidates:
+        raise ValueError("No read plan fits in %s bytes" % max_memory)
+    return min(candidates,key=lambda plan: (plan.time,plan.nbytes))
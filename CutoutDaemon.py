@@ -0,0 +1,325 @@
+''' Node-local cutout daemon.
+
+    Many independent processes on a node (one per source or job) would otherwise each build
+    their own boto3 session, header and thread pool. The daemon owns these instead: it keeps
+    the header and a few S3Object/UrlObjects per object (one for each request being served at
+    once), all reading through one BlockCache. Requests that overlap - not just identical
+    ones - share the blocks they have in common, so the node reads each block of an object 
+    from the objectstore once, however many processes ask for it.
+
+    Clients (DaemonObject) send requests over a Unix socket and receive the name of a shared
+    memory block holding the result, which the daemon removes once the client has copied it.
+
+    Start the daemon with:
+        python CutoutDaemon.py --socket /tmp/objstore.sock --certs ~/my_certs.json
+
+    The protocol is one json request and one json reply (each a single line) per connection,
+    then a "done" line from the client once it has read a result from shared memory.
+'''
+import os
+import sys
+import json
+import socket
+import threading
+import socketserver
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    from ObjStore.CertsRegistry import getRegistry
+    from ObjStore.BlockCache import BlockCache
+except ModuleNotFoundError:
+    from CertsRegistry import getRegistry
+    from BlockCache import BlockCache
+
+DEFAULT_SOCKET = '/tmp/objstore-%s.sock' % os.getuid()
+ONE_M = 1024 ** 2
+ONE_G = 1024 ** 3
+
+
+def attachSharedMemory(name):
+    ''' Attach to an existing shared memory block without taking ownership of it (the daemon
+        unlinks its own blocks - an attached process must not remove them when it exits).
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name,track=False)
+    except TypeError: # python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name,'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+
+########################################################################################
+############################### CLASS CutoutDaemon #####################################
+########################################################################################
+class CutoutDaemon(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    ''' Serves cutout requests for any number of objects over a Unix socket.
+        Object blocks of 'block_size' bytes are cached, up to 'cache_bytes' in total (least
+        recently used blocks are removed first). A block being read for one request is 
+        waited for by any other request that needs it, rather than read again.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self,socket_path=DEFAULT_SOCKET,certfile=None,cache_bytes=4*ONE_G,num_threads=8,block_size=4*ONE_M):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.socket_path = socket_path
+        self.certfile = certfile
+        self.num_threads = num_threads
+        self.cache = BlockCache(cache_bytes,block_size)
+        self.__headers = {} # object id -> header
+        self.__idle = {} # object id -> objects not serving a request (holding its keys)
+        self.__lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self,socket_path,CutoutHandler)
+
+    def objectId(self,request):
+        ''' Key of the header and objects cached for a request. Objects hold the access keys
+            they were made with, so a request only reuses those of requests with the same
+            certs file, endpoint and project (or the same presigned URL).
+        '''
+        if "url" in request:
+            return ("url",request.get("project"),request["url"])
+        return (request.get("certs",self.certfile),request["endpoint"],request["project"],request["bucket"],request["key"])
+
+    def __getHeader(self,request):
+        ''' Return the header of a request's object, read on first use '''
+        objid = self.objectId(request)
+        with self.__lock:
+            if objid in self.__headers:
+                return self.__headers[objid]
+        if "url" in request:
+            try:
+                from ObjStore.FITSheader import FITSheaderFromURL
+            except ModuleNotFoundError:
+                from FITSheader import FITSheaderFromURL
+            hdr = FITSheaderFromURL(request["url"],request.get("project"))
+        else:
+            try:
+                from ObjStore.FITSheader import FITSheaderFromS3
+            except ModuleNotFoundError:
+                from FITSheader import FITSheaderFromS3
+            (certs,endpoint,project,bucket,key) = objid
+            (access_id,secret_id,quota) = getRegistry(certs).getAccessKeys(endpoint,project)
+            hdr = FITSheaderFromS3(endpoint,bucket,key,access_id,secret_id,project)
+        with self.__lock:
+            return self.__headers.setdefault(objid,hdr)
+
+    def __checkout(self,request):
+        ''' Return an object for a request to use on its own - an idle one, or a new one. 
+            Read geometry is kept on the object, so objects are never shared by requests 
+            being served at once. Give it back with __checkin() when done.
+        '''
+        objid = self.objectId(request)
+        with self.__lock:
+            if self.__idle.get(objid):
+                return self.__idle[objid].pop()
+        if "url" in request:
+            try:
+                from ObjStore.URLObject import UrlObject
+            except ModuleNotFoundError:
+                from URLObject import UrlObject
+            obj = UrlObject(request["url"],project=request.get("project"))
+        else:
+            try:
+                from ObjStore.S3Object import S3Object
+            except ModuleNotFoundError:
+                from S3Object import S3Object
+            (certs,endpoint,project,bucket,key) = objid
+            (access_id,secret_id,quota) = getRegistry(certs).getAccessKeys(endpoint,project)
+            obj = S3Object(bucket,key,access_id,secret_id,endpoint,project)
+        # blocks are the same whichever keys read them - and every request has read the header
+        # with its own keys (or URL) before it gets here
+        obj.setBlockCache(self.cache,("url",request["url"]) if "url" in request else (endpoint,bucket,key))
+        return obj
+
+    def __checkin(self,request,obj):
+        with self.__lock:
+            self.__idle.setdefault(self.objectId(request),[]).append(obj)
+
+    def __read(self,request):
+        ''' Read the data for a request, through the block cache '''
+        hdr = self.__getHeader(request)
+        obj = self.__checkout(request)
+        try:
+            threads = min(int(request.get("threads",self.num_threads)),self.num_threads)
+            op = request["op"]
+            if op == "partition":
+                channels = request.get("channels")
+                if isinstance(channels,dict):
+                    channels = slice(channels["start"],channels["stop"],channels["step"])
+                return [obj.getPartitionData(*request["box"],hdr,threads,channels)]
+            if op == "batch":
+                return obj.getPartitionDataBatch(request["boxes"],hdr,threads)
+            if op == "spectra":
+                return [obj.getSpectra(request["positions"],hdr,request.get("zmin"),request.get("zmax"),threads)]
+            raise ValueError("Unknown request '%s'" % op)
+        finally:
+            self.__checkin(request,obj)
+
+    @staticmethod
+    def share(arrays):
+        ''' Copy result arrays into one new shared memory block. Returns (SharedMemory,layout). '''
+        nbytes = sum([a.nbytes for a in arrays])
+        shm = shared_memory.SharedMemory(create=True,size=max(nbytes,1))
+        layout = []
+        offset = 0
+        for a in arrays:
+            np.ndarray(a.shape,dtype=a.dtype,buffer=shm.buf,offset=offset)[...] = a
+            layout.append({"offset":offset,"shape":list(a.shape),"dtype":a.dtype.str})
+            offset += a.nbytes
+        return (shm,layout)
+
+    def serve(self,request):
+        ''' Return (reply,SharedMemory) for a request: the reply gives the name and layout of
+            the shared memory block holding the result (None for a header request), which the
+            caller removes once the client has read it.
+        '''
+        if request["op"] == "header":
+            hdr = self.__getHeader(request)
+            return ({"header":hdr.rawHdrData().decode(),"length":hdr.len()},None)
+        (shm,layout) = self.share(self.__read(request))
+        return ({"shm":shm.name,"arrays":layout},shm)
+
+    def clear(self):
+        ''' Remove all cached blocks '''
+        self.cache.clear()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.clear()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class CutoutHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        shm = None
+        try:
+            request = json.loads(self.rfile.readline())
+            (reply,shm) = self.server.serve(request)
+        except Exception as e:
+            reply = {"error":"%s: %s" % (type(e).__name__,e)}
+        try:
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            if shm:
+                self.rfile.readline() # "done" - or end of file if the client went away
+        finally:
+            if shm:
+                shm.close()
+                shm.unlink()
+
+
+########################################################################################
+############################### CLASS DaemonObject #####################################
+########################################################################################
+class DaemonObject:
+    ''' Thin client for one object, served by a CutoutDaemon. Give either the S3 identity
+        (endpoint,project,bucket,key - the daemon looks up the keys in its certs file, or in
+        'certs' if given) or a presigned 'url'. Results are the same as from FitsObjStore.
+    '''
+
+    def __init__(self,endpoint=None,project=None,bucket=None,key=None,url=None,socket_path=DEFAULT_SOCKET,certs=None):
+        self.socket_path = socket_path
+        if url:
+            self.ident = {"url":url}
+        else:
+            self.ident = {"endpoint":endpoint,"project":project,"bucket":bucket,"key":key}
+            if certs:
+                self.ident["certs"] = os.path.abspath(os.path.expanduser(certs))
+
+    def __send(self,request):
+        ''' Send a request, and return (socket,reply) - the socket is left open '''
+        request.update(self.ident)
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            reply = b''
+            while not reply.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                reply += chunk
+            reply = json.loads(reply)
+        except Exception:
+            sock.close()
+            raise
+        if "error" in reply:
+            sock.close()
+            raise RuntimeError("Cutout daemon: %s" % reply["error"])
+        return (sock,reply)
+
+    def __request(self,request):
+        (sock,reply) = self.__send(request)
+        sock.close()
+        return reply
+
+    def __arrays(self,request):
+        ''' Send a request and copy the result arrays out of shared memory. The daemon keeps
+            the block until told that the copy is done (or the connection closes).
+        '''
+        (sock,reply) = self.__send(dict(request))
+        try:
+            shm = attachSharedMemory(reply["shm"])
+            try:
+                return [np.ndarray(a["shape"],dtype=a["dtype"],buffer=shm.buf,offset=a["offset"]).copy() for a in reply["arrays"]]
+            finally:
+                shm.close()
+        finally:
+            try:
+                sock.sendall(b'done\n')
+            except OSError:
+                pass
+            sock.close()
+
+    def getHeaderDict(self):
+        try:
+            from ObjStore.HeaderParser import parseHeader
+        except ModuleNotFoundError:
+            from HeaderParser import parseHeader
+        return parseHeader(self.__request({"op":"header"})["header"].encode())
+
+    def getPartitionData(self,xmin,xmax,ymin,ymax,zmin,zmax,hdr=None,num_threads=1,channels=None):
+        ''' See FitsObjStore.getPartitionData() - the header is held by the daemon, so 'hdr' is not used '''
+        if isinstance(channels,slice):
+            channels = {"start":channels.start,"stop":channels.stop,"step":channels.step}
+        elif channels is not None:
+            channels = [int(ch) for ch in channels]
+        request = {"op":"partition","box":[int(v) for v in (xmin,xmax,ymin,ymax,zmin,zmax)],"threads":num_threads,"channels":channels}
+        return self.__arrays(request)[0]
+
+    def getPartitionDataBatch(self,boxes,hdr=None,num_threads=1):
+        ''' See FitsObjStore.getPartitionDataBatch() '''
+        request = {"op":"batch","boxes":[[int(v) for v in box] for box in boxes],"threads":num_threads}
+        return self.__arrays(request)
+
+    def getSpectra(self,positions,hdr=None,zmin=None,zmax=None,num_threads=1):
+        ''' See FitsObjStore.getSpectra() '''
+        request = {"op":"spectra","positions":[[int(x),int(y)] for (x,y) in positions],"zmin":zmin,"zmax":zmax,"threads":num_threads}
+        return self.__arrays(request)[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Node-local objectstore cutout daemon")
+    parser.add_argument("--socket",default=DEFAULT_SOCKET,help="Unix socket to listen on")
+    parser.add_argument("--certs",default="~/my_certs.json",help="json certs file holding the access keys")
+    parser.add_argument("--cache",type=float,default=4.0,help="block cache size in Gb")
+    parser.add_argument("--block",type=float,default=4.0,help="cached block size in Mb")
+    parser.add_argument("--threads",type=int,default=8,help="maximum threads per request")
+    args = parser.parse_args()
+
+    daemon = CutoutDaemon(args.socket,args.certs,int(args.cache*ONE_G),args.threads,int(args.block*ONE_M))
+    print(f"Cutout daemon listening on {args.socket}",flush=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
@@ -1,7 +1,10 @@
 import sys
-import requests
-import boto3
-from astropy.io import fits
+try:
+    from ObjStore.HeaderParser import *
+    from ObjStore.RateLimiter import getLimiter
+except ModuleNotFoundError:
+    from HeaderParser import *
+    from RateLimiter import getLimiter
 
 ENDHEADER = b'END          '
 FITS_HEADER_BLOCK_SIZE = 2880
@@ -13,47 +16,152 @@ FITS_HEADER_VALUE_SIZE   = 70
 FITS_HEADER_FIXED_WIDTH  = 20
 FITS_FLOAT_SIZE = 4
 
+HEADER_READ = FITS_HEADER_BLOCK_SIZE * 64 # header bytes read from a local file at once
+METADATA_LIMIT = 2048 # S3 limit on the size of user metadata
+HEADER_SIDECAR_SUFFIX = '.hdr' # key suffix of the sidecar object holding a full raw header
+# Keywords that describe a datacube, for metadata where the whole header will not fit
+CUBE_KEYWORDS = ('SIMPLE','BITPIX','NAXIS*','CTYPE*','CRVAL*','CDELT*','CRPIX*','CUNIT*','BUNIT',
+                 'BMAJ','BMIN','BPA','RESTFRQ','RESTFREQ','SPECSYS','EQUINOX','RADESYS','OBJECT',
+                 'TELESCOP','DATE-OBS')
+
+########################################################################################
+############################### CLASS FITSheader #######################################
+########################################################################################
+class FITSheader:
+
+    '''Base class for a FITS header read from an object store or file - holds the raw header data,
+       and converts it to a <key><value> dictionary using HeaderParser.
+    '''
+
+    hdr_data = b''
+    length = 0
+    header = None
+    wcs = None
+
+    def rawHdrData(self):
+        return self.hdr_data
+    
+    def len(self):
+        return self.length
+
+    def getHeaderDict(self):
+        """ Convert the raw header data to key/value pairs. The raw data is parsed once. """
+        if self.header is None:
+            self.header = parseHeader(self.rawHdrData())
+        return dict(self.header)
+
+    def getWCS(self):
+        """ Return an astropy WCS for the header. This is built once and cached. """
+        if self.wcs is None:
+            from astropy.io import fits
+            from astropy.wcs import WCS
+            self.wcs = WCS(fits.Header.fromstring(self.rawHdrData().decode()))
+        return self.wcs
+    
+
 ########################################################################################
 ############################### CLASS FITSheaderFromFile ###############################
 ########################################################################################
-class FITSheaderFromFile:
-    '''Class to get and modify header from a fits file on the local filesystem using astropy '''
+class FITSheaderFromFile(FITSheader):
+
+    '''Class to get the primary header from a fits file on the local filesystem. Only the header
+       blocks are read (usually in one read), so this is fast even for huge cubes or files on
+       network filesystems. An astropy HDUList of the file is still available as 'hdul'.
+    '''
 
     def __init__(self,filepath):
+        self.filepath = filepath
+        self.hdr_data = b''
+        self.length = 0
+        self.__hdul = None
         try:
-            self.hdul = fits.open(filepath)
+            with open(filepath,'rb') as f:
+                data = f.read(HEADER_READ)
+                if data[:6] != b'SIMPLE':
+                    return # not a FITS file
+                end = self.__findEnd(data,0)
+                while end < 0:
+                    chunk = f.read(HEADER_READ)
+                    if not chunk:
+                        return # no END card
+                    start = len(data) - len(data) % FITS_HEADER_LINE_SIZE
+                    data += chunk
+                    end = self.__findEnd(data,start)
         except OSError:
-            self.hdul = None
+            return
+        self.length = -(-(end + FITS_HEADER_LINE_SIZE) // FITS_HEADER_BLOCK_SIZE) * FITS_HEADER_BLOCK_SIZE
+        self.hdr_data = data[:self.length]
+
+    @staticmethod
+    def __findEnd(data,start):
+        """ Return the position of the END card at or after 'start' (a card boundary), or -1 """
+        pos = data.find(ENDHEADER,start)
+        while pos >= 0 and pos % FITS_HEADER_LINE_SIZE:
+            pos = data.find(ENDHEADER,pos+1)
+        return pos
+
+    @property
+    def hdul(self):
+        """ astropy HDUList of the file, opened on first use (None if the file cannot be opened) """
+        if self.__hdul is None:
+            from astropy.io import fits
+            try:
+                self.__hdul = fits.open(self.filepath)
+            except OSError:
+                return None
+        return self.__hdul
 
-    def convert2dict(self,hdrpos=0):
+    def convert2dict(self,hdrpos=0,keywords=None,limit=METADATA_LIMIT):
         ''' Get the FITS header (by default the primary, hdul=0 one) from the file and 
-            convert to a flattened dictionary of strings.
+            convert to a flattened dictionary of strings, for use as object metadata.
+            'keywords' is a list of the keywords (or patterns, eg 'NAXIS*') to include, in order 
+            of priority - all keywords are used if None. Commentary keywords are left out, and 
+            keywords are dropped once the metadata would exceed 'limit' bytes. 
         '''
-        if self.hdul:
-            flatdict = {"Metadata":{}}
-            tmphdr = self.hdul[hdrpos].header
-            for key in self.hdul[hdrpos].header:
-                strval = str(self.hdul[hdrpos].header[key])
-                flatdict["Metadata"][key] = strval
-            return flatdict
-        return {}
+        import fnmatch
+        if hdrpos == 0:
+            if not self.hdr_data:
+                return {}
+            cards = [(key,value) for (key,value,comment) in parseCards(self.hdr_data)]
+        elif self.hdul:
+            cards = list(self.hdul[hdrpos].header.items())
+        else:
+            return {}
+        cards = [(key,str(value)) for (key,value) in cards if key not in ('','COMMENT','HISTORY')]
+        if keywords is not None:
+            cards = [(key,value) for pattern in keywords for (key,value) in cards if fnmatch.fnmatchcase(key,pattern)]
+        flatdict = {"Metadata":{}}
+        size = 0
+        for (key,strval) in cards:
+            if key in flatdict["Metadata"] or not (key + strval).isascii():
+                continue
+            size += len(key) + len(strval)
+            if limit and size > limit:
+                break
+            flatdict["Metadata"][key] = strval
+        return flatdict
 
 ########################################################################################
 ############################### CLASS FITSheaderFromS3 ################################
 ########################################################################################
-class FITSheaderFromS3:
+class FITSheaderFromS3(FITSheader):
 
     '''Class to extract the header from a binary FITS file stored in an object store, using the 
        Boto3 S3 API - data can be represented as a raw string or a <key><value> dictionary.
+       Reads are made within the rate limits of the endpoint and 'project' (see RateLimiter).
     '''
 
-    def __init__(self,endpoint,bucket,key,access_key_id,secret_access):
+    def __init__(self,endpoint,bucket,key,access_key_id,secret_access,project=None):
         self.bucket = bucket
         self.key = key
         self.endpoint = endpoint
 
+        import boto3
         self.session = boto3.session.Session()
         self.client = self.session.client(service_name='s3',aws_access_key_id=access_key_id, aws_secret_access_key=secret_access, endpoint_url=self.endpoint)
+        limiter = getLimiter(endpoint,project)
+        if limiter:
+            limiter.attach(self.client)
 
         in_hdr = True
         begin = 0
@@ -72,6 +180,7 @@ class FITSheaderFromS3:
         self.xsize=self.ysize=self.zsize=0
         self.channel_bytes=self.cube_bytes=0
         self.max_byte_no = 0
+        self.wcs = None
         return
 
     def __getData(self,length,start_pos):
@@ -83,61 +192,23 @@ class FITSheaderFromS3:
         self.__last_byte_pos = self.__last_byte_pos + length
         return obj_content
 
-    def rawHdrData(self):
-        return self.hdr_data
-    
-    def len(self):
-        return self.length
-    
-    def getHeaderDict(self):
-        """ Convert the raw header data to key/value pairs """
-        
-        header = {}
-        header["HISTORY"] = ""
-        header["ORIGIN"] = ""
-        hdr = self.rawHdrData()
-        hdrstr = hdr.decode()
-        comment_indx = 0
-        
-        for i in range(0,len(hdrstr),FITS_HEADER_LINE_SIZE):
-            str = hdrstr[i:i+FITS_HEADER_LINE_SIZE]
-            # Special cases - 'HISTORY' and 'ORIGIN'
-            if str.startswith('HISTORY'):
-                str = str[8:]
-                header["HISTORY"] += "\n    %s" % str
-            elif str.startswith('ORIGIN'):
-                str = str.split("=")[1]
-                header["ORIGIN"] += str
-            elif str.startswith('COMMENT'):
-                header["COMMENT_%s" % comment_indx] = str[6:]
-                comment_indx += 1
-            elif str.startswith('END'):
-                break
-            else:
-                if '=' not in str:
-                    continue
-                key = str.split("=")[0]
-                value = str.split('=')[1]
-                # Remove trailing '/' from value
-                value = value.replace("\\", "")
-                value = value.replace("/", "")
-                value = value.strip()
-                header[key.strip()] = value
-                
-        return header
-
 
 ########################################################################################
 ############################### CLASS FITSheaderFromURL ###############################
 ########################################################################################
 
-class FITSheaderFromURL:
+class FITSheaderFromURL(FITSheader):
 
     ''' Class to extract the header from a binary FITS file stored in an object store, using a 
         presigned URL - data can be represented as a raw string or a <key><value> dictionary.
+        Reads are made within the rate limits of the endpoint and 'project' (see RateLimiter).
     '''
-    def __init__(self,url):
+    def __init__(self,url,project=None):
+        import urllib3
+        from urllib.parse import urlsplit
         self.url = url
+        http = urllib3.PoolManager()
+        limiter = getLimiter("%s://%s" % urlsplit(url)[:2],project)
         in_hdr = True
         begin = 0
         stop = begin + FITS_HEADER_BLOCK_SIZE - 1
@@ -145,8 +216,11 @@ class FITSheaderFromURL:
         self.length = 0
         while in_hdr:
             headers={"Range":"bytes=%s-%s" % (begin,stop)}
-            r = requests.get(self.url,headers=headers)
-            chunk = r.content
+            if limiter:
+                r = limiter.request(http,"GET",self.url,FITS_HEADER_BLOCK_SIZE,headers=headers)
+            else:
+                r = http.request("GET",self.url,headers=headers)
+            chunk = r.data
             self.hdr_data += chunk
             begin += (FITS_HEADER_BLOCK_SIZE)
             stop += (FITS_HEADER_BLOCK_SIZE)
@@ -157,6 +231,7 @@ class FITSheaderFromURL:
         self.xsize=self.ysize=self.zsize=0
         self.channel_bytes=self.cube_bytes=0
         self.max_byte_no = 0
+        self.wcs = None
         return
 
     def __setCubeData(self,header):
@@ -175,47 +250,9 @@ class FITSheaderFromURL:
         self.max_byte_no = self.cube_bytes + self.len() - 1
 
 
-    def rawHdrData(self):
-        return self.hdr_data
-    
-    def len(self):
-        return self.length
-    
     def getHeaderDict(self):
         """ Convert the raw header data to key/value pairs """
-        
-        header = {}
-        header["HISTORY"] = ""
-        header["ORIGIN"] = ""
-        hdr = self.rawHdrData()
-        hdrstr = hdr.decode()
-        comment_indx = 0
-        
-        for i in range(0,len(hdrstr),FITS_HEADER_LINE_SIZE):
-            str = hdrstr[i:i+FITS_HEADER_LINE_SIZE]
-            # Special cases - 'HISTORY' and 'ORIGIN'
-            if str.startswith('HISTORY'):
-                str = str[8:]
-                header["HISTORY"] += "\n    %s" % str
-            elif str.startswith('ORIGIN'):
-                str = str.split("=")[1]
-                header["ORIGIN"] += str
-            elif str.startswith('COMMENT'):
-                header["COMMENT_%s" % comment_indx] = str[6:]
-                comment_indx += 1
-            elif str.startswith('END'):
-                break
-            else:
-                if '=' not in str:
-                    continue
-                key = str.split("=")[0]
-                value = str.split('=')[1]
-                # Remove trailing '/' from value
-                value = value.replace("\\", "")
-                value = value.replace("/", "")
-                value = value.strip()
-                header[key.strip()] = value
-                
+        header = FITSheader.getHeaderDict(self)
         self.__setCubeData(header)
         return header
 
@@ -0,0 +1,138 @@
+''' Parser for raw FITS header data (a bytes buffer of 80 byte cards).
+
+    All cards are split at once using fixed-width fields over the buffer, then each value
+    is converted to a python type (bool, int, float, complex or str). Quoted strings keep
+    any '/' characters, long strings split over CONTINUE cards are joined, and HIERARCH
+    keywords are supported.
+'''
+import numpy as np
+
+FITS_CARD_SIZE = 80
+
+CARD_DTYPE = np.dtype([('key','S8'),('ind','S2'),('val','S70')])
+
+COMMENTARY_KEYS = (b'COMMENT',b'HISTORY',b'')
+
+
+def __parseString(text):
+    ''' Parse a quoted FITS string from the start of 'text'. Returns (string,remainder) '''
+    chars = []
+    i = 1
+    while i < len(text):
+        if text[i] == "'":
+            if i+1 < len(text) and text[i+1] == "'":
+                chars.append("'") # doubled quote is a literal quote
+                i += 2
+                continue
+            break
+        chars.append(text[i])
+        i += 1
+    return (''.join(chars).rstrip(),text[i+1:])
+
+
+def __parseNumber(text):
+    ''' Convert a FITS logical/integer/real/complex value to a python type. Anything
+        unrecognised is returned as a stripped string.
+    '''
+    if text == 'T':
+        return True
+    if text == 'F':
+        return False
+    if text.startswith('(') and text.endswith(')'):
+        try:
+            (real,imag) = text[1:-1].split(',')
+            return complex(__parseNumber(real.strip()),__parseNumber(imag.strip()))
+        except (ValueError,TypeError):
+            return text
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace('D','E').replace('d','e'))
+    except ValueError:
+        return text
+
+
+def parseValue(text):
+    ''' Parse the value field of a card. Returns (value,comment) - value is None if undefined. '''
+    stripped = text.lstrip()
+    if stripped.startswith("'"):
+        (value,rest) = __parseString(stripped)
+        comment = rest.split('/',1)[1].strip() if '/' in rest else ''
+        return (value,comment)
+    if '/' in stripped:
+        (value,comment) = stripped.split('/',1)
+        comment = comment.strip()
+    else:
+        (value,comment) = (stripped,'')
+    value = value.strip()
+    if value == '':
+        return (None,comment)
+    return (__parseNumber(value),comment)
+
+
+def headerCards(raw):
+    ''' Split a raw header into a structured numpy array of cards (key, value indicator
+        and value fields), stopping at the END card.
+    '''
+    ncards = len(raw) // FITS_CARD_SIZE
+    cards = np.frombuffer(raw,dtype=CARD_DTYPE,count=ncards)
+    keys = np.char.rstrip(cards['key'])
+    ends = np.flatnonzero(keys == b'END')
+    if len(ends) > 0:
+        cards = cards[:ends[0]]
+        keys = keys[:ends[0]]
+    return (cards,keys)
+
+
+def parseCards(raw):
+    ''' Parse a raw header into a list of (keyword,value,comment) tuples, in card order.
+        Commentary cards (COMMENT, HISTORY and blank keywords) have their text as value.
+    '''
+    (cards,keys) = headerCards(raw)
+    has_value = cards['ind'] == b'= '
+    result = []
+    for key,valued,card in zip(keys.tolist(),has_value.tolist(),cards.tolist()):
+        key = key.decode('ascii')
+        field = (card[1] + card[2]).decode('ascii','replace')
+        if key == 'HIERARCH':
+            if '=' not in field:
+                continue
+            (key,field) = field.split('=',1)
+            (value,comment) = parseValue(field)
+            result.append((key.strip(),value,comment))
+        elif key == 'CONTINUE':
+            (value,comment) = parseValue(field)
+            if result and isinstance(result[-1][1],str) and result[-1][1].endswith('&'):
+                (prevkey,prevvalue,prevcomment) = result[-1]
+                comment = (prevcomment + ' ' + comment).strip()
+                result[-1] = (prevkey,prevvalue[:-1] + (value or ''),comment)
+        elif valued and key.encode() not in COMMENTARY_KEYS:
+            (value,comment) = parseValue(card[2].decode('ascii','replace'))
+            result.append((key,value,comment))
+        else:
+            result.append((key,field.rstrip(),''))
+    return result
+
+
+def parseHeader(raw):
+    ''' Convert raw header data to a dictionary of keyword/typed value pairs.
+        HISTORY cards are joined into a single "HISTORY" entry and COMMENT cards are
+        stored as "COMMENT_0", "COMMENT_1", ...
+    '''
+    header = {}
+    header["HISTORY"] = ""
+    header["ORIGIN"] = ""
+    comment_indx = 0
+    for (key,value,comment) in parseCards(raw):
+        if key == 'HISTORY':
+            header["HISTORY"] += "\n    %s" % value
+        elif key == 'COMMENT':
+            header["COMMENT_%s" % comment_indx] = value
+            comment_indx += 1
+        elif key == '':
+            continue
+        else:
+            header[key] = value
+    return header
@@ -0,0 +1,135 @@
+''' Lazy, numpy-like view of a remote FITS datacube.
+
+    LazyCube has shape, dtype and __getitem__, but reads nothing until it is sliced. A slice
+    is turned into planned range reads (one row span per channel, merged where close - see
+    FitsObjStore.getPartitionDataBatch()), so only the bytes needed are fetched.
+    to_dask() gives a dask array whose chunks each resolve to their own range reads, so slicing
+    and reductions run in parallel under the dask scheduler (and can be wrapped by xarray).
+'''
+import numpy as np
+
+try:
+    from ObjStore.FITSheader import *
+    from ObjStore.RangePlanner import *
+    from ObjStore.ObjStore import CUTOUT_READ
+except ModuleNotFoundError:
+    from FITSheader import *
+    from RangePlanner import *
+    from ObjStore import CUTOUT_READ
+
+CHUNK_BYTES = 64 * 1024 ** 2 # Default dask chunk size
+
+########################################################################################
+############################### CLASS LazyCube #########################################
+########################################################################################
+class LazyCube:
+    ''' Lazy (z,y,x) array view of a datacube held in an S3Object or UrlObject, given its header. '''
+
+    def __init__(self,obj,hdr,chunks=None,num_threads=1):
+        self.obj = obj
+        self.hdr = hdr
+        self.num_threads = num_threads
+        header = hdr.getHeaderDict()
+        xsize = int(header["NAXIS1"])
+        ysize = int(header["NAXIS2"])
+        if int(header["NAXIS"]) == 3:
+            zsize = int(header["NAXIS3"])
+        else:
+            zsize = int(header["NAXIS4"])
+        self.shape = (zsize,ysize,xsize)
+        self.dtype = np.dtype('>f4')
+        self.ndim = 3
+        self.chunks = tuple(chunks) if chunks else self.defaultChunks()
+
+    def __repr__(self):
+        return "LazyCube(shape=%s, dtype=%s, chunks=%s)" % (self.shape,self.dtype,self.chunks)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return self.shape[0]*self.shape[1]*self.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    def defaultChunks(self,chunk_bytes=CHUNK_BYTES):
+        ''' Chunks of whole channels where they fit in 'chunk_bytes', else bands of rows '''
+        (zsize,ysize,xsize) = self.shape
+        chbytes = ysize*xsize*FITS_FLOAT_SIZE
+        if chbytes <= chunk_bytes:
+            return (max(1,min(zsize,chunk_bytes // chbytes)),ysize,xsize)
+        return (1,max(1,min(ysize,chunk_bytes // (xsize*FITS_FLOAT_SIZE))),xsize)
+
+    def __normalise(self,key):
+        ''' Turn an index into a list of (indices,is_int) per axis '''
+        if not isinstance(key,tuple):
+            key = (key,)
+        if any([k is Ellipsis for k in key]):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),)*(self.ndim-len(key)+1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for a %s-dimensional cube" % self.ndim)
+        key = key + (slice(None),)*(self.ndim-len(key))
+        axes = []
+        for (k,n) in zip(key,self.shape):
+            if isinstance(k,slice):
+                axes.append((list(range(*k.indices(n))),False))
+            elif isinstance(k,(int,np.integer)):
+                k = int(k)
+                if k < -n or k >= n:
+                    raise IndexError("index %s is out of bounds for axis with size %s" % (k,n))
+                axes.append(([k % n],True))
+            else:
+                indices = [int(i) % n for i in np.asarray(k).ravel()]
+                axes.append((indices,False))
+        return axes
+
+    def __getitem__(self,key):
+        axes = self.__normalise(key)
+        (zs,ys,xs) = [indices for (indices,is_int) in axes]
+        shape = tuple([len(indices) for (indices,is_int) in axes])
+        if 0 in shape:
+            out = np.empty(shape,dtype=self.dtype)
+        else:
+            # Read the bounding rows/columns of each requested channel, then pick the pixels
+            (x0,x1,y0,y1) = (min(xs),max(xs),min(ys),max(ys))
+            boxes = [(x0,x1,y0,y1,z,z) for z in zs]
+            planes = self.obj.getPartitionDataBatch(boxes,self.hdr,self.num_threads)
+            yi = np.asarray(ys) - y0
+            xi = np.asarray(xs) - x0
+            out = np.stack([plane[0][np.ix_(yi,xi)] for plane in planes])
+        squeeze = tuple([axis for (axis,(indices,is_int)) in enumerate(axes) if is_int])
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+    def __array__(self,dtype=None,copy=None):
+        data = self[...]
+        return data.astype(dtype) if dtype is not None else data
+
+    def chunkBoxes(self):
+        ''' Return a dict of chunk index (i,j,k) -> (xmin,xmax,ymin,ymax,zmin,zmax) box '''
+        boxes = {}
+        (zc,yc,xc) = self.chunks
+        (zsize,ysize,xsize) = self.shape
+        for (i,z0) in enumerate(range(0,zsize,zc)):
+            for (j,y0) in enumerate(range(0,ysize,yc)):
+                for (k,x0) in enumerate(range(0,xsize,xc)):
+                    boxes[(i,j,k)] = (x0,min(x0+xc,xsize)-1,y0,min(y0+yc,ysize)-1,z0,min(z0+zc,zsize)-1)
+        return boxes
+
+    def chunkMap(self,gap=MERGE_GAP,maxread=CUTOUT_READ):
+        ''' Return a dict of chunk index (i,j,k) -> list of the RangeGroups (range reads) that
+            will be made to read the chunk.
+        '''
+        chunkmap = {}
+        for (index,box) in self.chunkBoxes().items():
+            (ranges,owners) = boxRanges([box],self.shape[2],self.shape[1],self.shape[0],self.hdr.len(),FITS_FLOAT_SIZE)
+            chunkmap[index] = coalesceRanges(ranges,gap=gap,maxlen=max(maxread,max([r[1] for r in ranges])))
+        return chunkmap
+
+    def to_dask(self):
+        ''' Return a dask array over the cube, with one task per chunk (requires dask) '''
+        import dask.array as da
+        return da.from_array(self,chunks=self.chunks,lock=False,asarray=False,meta=np.empty((0,0,0),dtype=self.dtype))
@@ -1,22 +1,37 @@
 import os
 import sys
-import logging
-import time
-import multiprocessing as mp
 import threading
 import numpy as np
-import boto3
-from boto3.s3.transfer import TransferConfig
-import urllib3.request
 try:
     from ObjStore.FITSheader import *
+    from ObjStore.RangePlanner import *
+    from ObjStore.WCSCutout import *
+    from ObjStore.SpectralReplica import replicaSpectrumRanges
+    from ObjStore.BufferPool import *
+    from ObjStore.BlockCache import *
+    from ObjStore.Checksums import *
+    from ObjStore.TiledCube import *
+    from ObjStore.CostPlanner import *
+    from ObjStore.RateLimiter import *
+    from ObjStore.RegionMask import *
 except ModuleNotFoundError:
     from FITSheader import *
+    from RangePlanner import *
+    from WCSCutout import *
+    from SpectralReplica import replicaSpectrumRanges
+    from BufferPool import *
+    from BlockCache import *
+    from Checksums import *
+    from TiledCube import *
+    from CostPlanner import *
+    from RateLimiter import *
+    from RegionMask import *
 
 # Gigabyte definitions:
 ONE_M = 1024 **2 # 1 Mb
 ONE_G = 1024 ** 3 # 1Gb
 ONE_G_9 = int(ONE_G * 1.9) # 1.9 Gb
+CUTOUT_READ = ONE_M * 64 # Largest read when merging many small cutouts
 TWO_G = ONE_G * 2 # 2Gb
 FOUR_G = ONE_G * 4 # 4Gb
 
@@ -39,6 +54,26 @@ class ProgressPercentage(object):
                     percentage))
             sys.stdout.flush()
 
+class MemoryBudget(object):
+    ''' Byte-counting semaphore - limits the memory held by reads in flight across threads.
+        A single request larger than the whole budget is let through on its own.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            while self.used > 0 and self.used + nbytes > self.limit:
+                self._cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
 ########################################################################################
 #
 ############################### CLASS FitsObjStore ########################################
@@ -67,28 +102,228 @@ class FitsObjStore:
         self.__last_byte_pos = -1 # Position of the last byte that was read (byte numbers start at 0)
         self.__end_header = 0
         self.__stride_len = 0
+        self.objsize = None
+        self.replica = None # (object,header) of a spectral-major replica, if any
+        self.max_memory = None # memory limit for getPartitionData(), see setMaxMemory()
+        self.bufferpool = None # BufferPool for range reads - the shared default pool if None
+        self.checksums = None # ObjectChecksums to check range reads against, see loadChecksums()
+        self.tileindex = None # TileIndex of a tile-compressed object, see getTileIndex()
+        self.profile = None # LinkProfile for estimating read times, see setLinkProfile()
+        self.limiter = None # RateLimiter for requests to the endpoint, see setRateLimiter()
+        self.blockcache = None # BlockCache shared with other objects, see setBlockCache()
+        self.cacheid = None # id of the object's blocks in the block cache
         self.DEBUG = False
  
-    def readData(self,start,length):
-        ''' Mode is dependent on child class '''
-        data = None
-        ranges = None
+    def readBytes(self,start,length):
+        ''' Return 'length' raw bytes of the object, starting at byte 'start'.
+            Mode is dependent on child class.
+        '''
         obj_content = None
-        hdr = {}
+        if self.blockcache:
+            buf = bytearray(length)
+            got = self.readBytesInto(start,buf)
+            return bytes(buf[:got])
         if self.mode == 's3': # Use Boto3 library
-            if not start:
-                start = self.__last_byte_pos+1
             ranges = "bytes=%s-%s" % (start,start+length-1)
             obj_content = self.client.get_object(Bucket = self.bucket, Key = self.obj,Range=ranges)['Body'].read()
-            self.__read_bytes += length
-            self.__last_byte_pos = self.__last_byte_pos + length
-            return np.frombuffer(obj_content,dtype='>f4',count=-1)
         else: # presigned URL
             if length > ONE_G_9:
                 raise ValueError("read request too large!!")
             hdr = {"Range":"bytes=%s-%s" % (start,start+length-1)}
-            stream = self.http.request("GET",self.url,headers=hdr)
-            return np.frombuffer(stream.data,dtype='>f4',count=-1)
+            obj_content = self.urlRequest("GET",self.url,length,headers=hdr).data
+        if self.checksums:
+            self.checksums.verify(start,obj_content)
+        self.__read_bytes += len(obj_content)
+        self.__last_byte_pos = start + len(obj_content) - 1
+        return obj_content
+
+    def readBytesInto(self,start,buf):
+        ''' Read len(buf) bytes of the object, starting at byte 'start', directly into the 
+            writable buffer 'buf' - no intermediate bytes object is created (unless the 
+            object has a block cache, when cached blocks are copied in).
+            Returns the number of bytes read.
+        '''
+        if self.blockcache:
+            return self.blockcache.readInto(self.cacheid,start,buf,self.__readRangeInto)
+        return self.__readRangeInto(start,buf)
+
+    def setBlockCache(self,cache,cacheid=None):
+        ''' Serve range reads through 'cache' (a BlockCache), which may be shared by several
+            objects. Objects with the same 'cacheid' (by default the key or URL) share blocks,
+            so should all be for the same object. None removes the cache.
+        '''
+        self.blockcache = cache
+        self.cacheid = cacheid or getattr(self,'obj',None) or getattr(self,'url',None)
+
+    def __readRangeInto(self,start,buf):
+        ''' Read len(buf) bytes from byte 'start' into 'buf' from the objectstore '''
+        mv = memoryview(buf).cast('B')
+        length = len(mv)
+        if self.mode == 's3': # Use Boto3 library
+            ranges = "bytes=%s-%s" % (start,start+length-1)
+            stream = self.client.get_object(Bucket = self.bucket, Key = self.obj,Range=ranges)['Body']
+        else: # presigned URL
+            if length > ONE_G_9:
+                raise ValueError("read request too large!!")
+            hdr = {"Range":"bytes=%s-%s" % (start,start+length-1)}
+            stream = self.urlRequest("GET",self.url,length,headers=hdr,preload_content=False)
+        got = 0
+        try:
+            while got < length:
+                if hasattr(stream,'readinto'):
+                    n = stream.readinto(mv[got:])
+                else:
+                    chunk = stream.read(min(length-got,ONE_M*8))
+                    n = len(chunk)
+                    mv[got:got+n] = chunk
+                if not n:
+                    break
+                got += n
+        finally:
+            if hasattr(stream,'release_conn'):
+                stream.release_conn()
+            else:
+                stream.close()
+            if self.checksums:
+                self.checksums.verify(start,mv[:got])
+            mv.release()
+        self.__read_bytes += got
+        self.__last_byte_pos = start + got - 1
+        return got
+
+    def setRateLimiter(self,limiter):
+        ''' Make all requests for this object within the limits of 'limiter' (a RateLimiter, 
+            usually shared by all objects on the endpoint - see RateLimiter.configureLimiter). 
+            None removes the limit.
+        '''
+        if self.mode == 's3':
+            if self.limiter is not None:
+                self.limiter.detach(self.client)
+            if limiter is not None:
+                limiter.attach(self.client)
+        self.limiter = limiter
+
+    def urlRequest(self,method,url,nbytes=0,http=None,**kwargs):
+        ''' Make a request with the object's urllib3 PoolManager (or 'http'), within the rate 
+            limits (if any)
+        '''
+        http = http or self.http
+        if self.limiter:
+            return self.limiter.request(http,method,url,nbytes,**kwargs)
+        return http.request(method,url,**kwargs)
+
+    def loadChecksums(self,url=None):
+        ''' Read the block checksums stored with the object (see Checksums), and check every 
+            range read against them from now on. For a UrlObject, 'url' is a presigned URL of 
+            the checksum sidecar. Returns False if the object has no checksums.
+        '''
+        try:
+            if self.mode == 's3':
+                manifest = self.client.get_object(Bucket = self.bucket, Key = self.obj + CHECKSUM_SUFFIX)['Body'].read()
+            else:
+                response = self.urlRequest("GET",url)
+                if response.status != 200:
+                    return False
+                manifest = response.data
+        except Exception as e:
+            if self.DEBUG:
+                print(f"No checksums for the object: {e}")
+            return False
+        self.checksums = ObjectChecksums(manifest)
+        return True
+
+    def getBufferPool(self):
+        ''' Return the BufferPool used for range reads '''
+        return self.bufferpool or defaultPool()
+
+    def setBufferPool(self,pool):
+        ''' Use 'pool' (a BufferPool) for range reads, eg one with hugepages=True. None selects the shared default pool. '''
+        self.bufferpool = pool
+
+    def readPooled(self,start,length):
+        ''' Read 'length' bytes from byte 'start' into a buffer from the pool. Returns (buffer,data)
+            where data is a float view of the buffer. Once data (and any views of it) is no longer 
+            used, the buffer must be given back with releaseBuffer().
+        '''
+        buf = self.getBufferPool().get(length)
+        try:
+            got = self.readBytesInto(start,memoryview(buf)[:length])
+        except Exception:
+            self.releaseBuffer(buf)
+            raise
+        return (buf,np.frombuffer(buf,dtype='>f4',count=got//FITS_FLOAT_SIZE))
+
+    def releaseBuffer(self,buf):
+        ''' Return a buffer from readPooled() to the pool '''
+        self.getBufferPool().put(buf)
+
+    def readData(self,start,length):
+        ''' Return 'length' bytes of the object from byte 'start' as big-endian floats.
+            If start is None, reading continues from the last byte read.
+        '''
+        if start is None:
+            start = self.__last_byte_pos+1
+        return np.frombuffer(self.readBytes(start,length),dtype='>f4',count=-1)
+
+    def getObjectSize(self):
+        ''' Return the size of the object in bytes (asked for once, then cached) '''
+        if self.objsize is None:
+            if self.mode == 's3':
+                self.objsize = int(self.client.head_object(Bucket = self.bucket, Key = self.obj)['ContentLength'])
+            else:
+                # A presigned URL is only valid for GET, so ask for one byte and read the total from Content-Range
+                stream = self.urlRequest("GET",self.url,1,headers={"Range":"bytes=0-0"})
+                self.objsize = int(stream.headers["Content-Range"].split('/')[-1])
+        return self.objsize
+
+    def rewind(self,indx=-1):
+        ''' Set the object position indx. '''
+        self.__last_byte_pos = indx
+        
+    def getReadPosition(self):
+        ''' Return the object position indx '''
+        return self.__last_byte_pos
+        
+    def getBytesFromLastPos(self,len):
+        """ Similar to a sequential 'read' - get len bytes starting from 
+            immediately after the last byte read.
+        """
+       
+        return self.readData(self.__last_byte_pos+1,len) 
+       
+    def stats(self):
+        """ Stats on how much has been read or written to the object. """
+        
+        print()
+        print("************************")
+        print("Number of bytes read: ",self.__read_bytes)
+        print("Number of bytes written: ",self.__write_bytes)
+        print("Last byte pos read/written: ",self.__last_byte_pos)
+        print("************************")
+
+    def open(self,blocksize=ONE_M,cacheblocks=32,maxreadahead=64):
+        ''' Return a seekable, buffered, read-only file object for the object, 
+            eg for use with astropy.io.fits.open() - see ObjectFile.ObjectRawIO
+        '''
+        try:
+            from ObjStore.ObjectFile import openObject
+        except ModuleNotFoundError:
+            from ObjectFile import openObject
+        return openObject(self,blocksize,cacheblocks,maxreadahead)
+
+    def setMaxMemory(self,max_memory=None):
+        ''' Limit the memory used by getPartitionData() - the result plus all reads in flight - 
+            to 'max_memory' bytes. None removes the limit.
+        '''
+        self.max_memory = max_memory
+
+    def asLazyArray(self,hdr,chunks=None,num_threads=1):
+        ''' Return a lazy, numpy-like (z,y,x) view of the cube - see LazyCube '''
+        try:
+            from ObjStore.LazyCube import LazyCube
+        except ModuleNotFoundError:
+            from LazyCube import LazyCube
+        return LazyCube(self,hdr,chunks,num_threads)
 
     def setDebugFlag(self):
         self.DEBUG = True
@@ -97,13 +332,21 @@ class FitsObjStore:
         self.DEBUG = False
 
     def getObjectHeaders(self,filtered='FITS'):
-        response = self.client.head_object(Bucket = self.bucket, Key = self.obj)['ResponseMetadata']['HTTPHeaders']
+        ''' Return the HTTP headers of the object. With filtered='FITS', only the user metadata
+            (x-amz-meta-*, eg the FITS keywords stored on upload) is returned, with upper case keys.
+        '''
+        if self.mode == "s3": # Use Boto3 library
+            response = self.client.head_object(Bucket = self.bucket, Key = self.obj)['ResponseMetadata']['HTTPHeaders']
+        else:
+            # A presigned URL is only valid for GET, so ask for one byte
+            stream = self.urlRequest("GET",self.url,1,headers={"Range":"bytes=0-0"})
+            response = dict([(key.lower(),val) for (key,val) in stream.headers.items()])
         flatdict = {}
         if filtered == 'FITS':
-            for key in response['ResponseMetadata']['HTTPHeaders']:
+            for key in response:
                 if key.startswith('x-amz-meta-'):
                     newkey = key.split('x-amz-meta-')[1].upper()
-                    flatdict[newkey] = response['ResponseMetadata']['HTTPHeaders'][key]
+                    flatdict[newkey] = response[key]
             return flatdict
         else:
             return response
@@ -114,11 +357,11 @@ class FitsObjStore:
         obj_content = None
         if self.mode == "s3": # Use Boto3 library
             obj_content = self.client.get_object(Bucket = self.bucket, Key = self.obj)['Body'].read()
+            if self.checksums:
+                self.checksums.verify(0,obj_content)
         else:
-            if length > ONE_G_9:
-                raise ValueError("read request too large!!")
             hdr = {}
-            obj_content = self.http.request("GET",self.url,headers=hdr)
+            obj_content = self.urlRequest("GET",self.url,self.getObjectSize(),headers=hdr)
         
         return obj_content
 
@@ -177,15 +420,42 @@ class FitsObjStore:
         startpos += FITS_FLOAT_SIZE*(ymin*self.xsize + xmin)
         # Get each row of the channel individually
         readsize = self.xlen*FITS_FLOAT_SIZE
-        jumpsize = (self.xsize-self.xlen)*FITS_FLOAT_SIZE
+        rowsize = self.xsize*FITS_FLOAT_SIZE
         data = self.readData(startpos,readsize)
         for i in range(self.ylen-1):
+            startpos += rowsize
             data = np.concatenate((data,self.readData(startpos,readsize)),axis=0)
-            startpos += jumpsize
         return data
 
-    def getPartitionDataByStrategy(self,xmin,xmax,ymin,ymax,zmin,zmax,hdr,strategy=2):
-        ''' This is NON-THREADED !!
+    def planPartitionData(self,xmin,xmax,ymin,ymax,zmin,zmax,hdr,num_threads=1,max_memory=None):
+        ''' Dry run: return {name: ReadPlan} giving the exact byte ranges, bytes, requests, peak
+            memory and estimated time (from the LinkProfile - see setLinkProfile()) of each way 
+            of reading the subcube: 'strategy1', 'strategy2', 'strategy3' (see 
+            getPartitionDataByStrategy), 'partition' (getPartitionData) and 'batch' 
+            (getPartitionDataBatch). Nothing is read. See CostPlanner.
+        '''
+        header = hdr.getHeaderDict()
+        if header.get("OSLAYOUT") == TILED_LAYOUT:
+            raise ValueError("Read plans are for the plain layout - a tile-compressed object is read with getTiledPartitionData()")
+        self.__setCubeGeometry(header,hdr.len())
+        box = (xmin,xmax,ymin,ymax,zmin,zmax)
+        (ranges,owners) = boxRanges([box],self.xsize,self.ysize,self.zsize,self.hdrsize,FITS_FLOAT_SIZE) # checks the bounds
+        return planCutout((self.xsize,self.ysize,self.zsize,self.hdrsize),box,num_threads,self.getLinkProfile(),
+                          ONE_G_9,CUTOUT_READ,MERGE_GAP,max_memory or self.max_memory)
+
+    def getLinkProfile(self):
+        ''' Return the LinkProfile used to estimate read times (a default one if not set) '''
+        return self.profile or LinkProfile()
+
+    def setLinkProfile(self,profile=None,samples=5):
+        ''' Set the LinkProfile used to estimate read times. If 'profile' is None it is 
+            measured by timing reads of this object (see CostPlanner.measureProfile).
+        '''
+        self.profile = profile or measureProfile(self,samples)
+        return self.profile
+
+    def getPartitionDataByStrategy(self,xmin,xmax,ymin,ymax,zmin,zmax,hdr,strategy=2,num_threads=1):
+        ''' This is NON-THREADED !! (except for strategy 'auto')
 
             Get the data representing a subcube from a larger datacube held in objectstore.
             This uses the presigned URL for access to the object. One of 3 read strategies can be 
@@ -194,13 +464,27 @@ class FitsObjStore:
                 Strategy 2: getChannelBatches - Read multiple channels at a time (limited by RAM size, and return only the required pixels
                 Strategy 3: getChannelByRow - Read ONLY the required pixels (requires multiple stream openings).
             Stragegy 2 is recommended.
+            With strategy='auto' the reader with the cheapest plan (see planPartitionData) is used,
+            including the threaded getPartitionData and getPartitionDataBatch readers.
+            The strategies read the plain layout, so tile-compressed objects are read with 
+            getPartitionData() whatever the strategy.
         '''
+        if hdr.getHeaderDict().get("OSLAYOUT") == TILED_LAYOUT:
+            print("Tile-compressed object: reading the tiles with getPartitionData()",flush=True)
+            return self.getPartitionData(xmin,xmax,ymin,ymax,zmin,zmax,hdr,num_threads)
+        if strategy == 'auto':
+            plan = cheapestPlan(self.planPartitionData(xmin,xmax,ymin,ymax,zmin,zmax,hdr,num_threads),self.max_memory)
+            print(f"Using {plan}",flush=True)
+            if plan.name == 'partition':
+                return self.getPartitionData(xmin,xmax,ymin,ymax,zmin,zmax,hdr,num_threads)
+            if plan.name == 'batch':
+                return np.ravel(self.getPartitionDataBatch([(xmin,xmax,ymin,ymax,zmin,zmax)],hdr,num_threads)[0])
+            strategy = int(plan.name[-1])
        
         data = None
         # Get the header data from the object store:
-        header = self.getHeaderDict()
-        hdrstr = self.getHeaderBytes().decode() 
-        self.hdrsize = self.getHeaderSize()
+        header = hdr.getHeaderDict()
+        self.hdrsize = hdr.len()
 
 
         self.xsize = int(header["NAXIS1"])
@@ -223,7 +507,7 @@ class FitsObjStore:
         if strategy == 1:
             data = self.getWholeChannel(xmin,xmax,ymin,ymax,zmin,zmax,0)
             for i in range(self.zlen-1):
-                data = np.concatenate((data,self.getWholeChannel(xmin,xmax,ymin,ymax,zmin,zmax,i)),axis=0)
+                data = np.concatenate((data,self.getWholeChannel(xmin,xmax,ymin,ymax,zmin,zmax,i+1)),axis=0)
                 if i % 10 == 0:
                     print("Got channel %s data" % (i+zmin+1),flush=True)
         elif strategy == 3:
@@ -237,79 +521,516 @@ class FitsObjStore:
             READ_LIMIT = ONE_G_9
             # Calc number of channels we can read at once (batchsize)
             batch = int(READ_LIMIT // (self.chsize*FITS_FLOAT_SIZE))
+            if batch < 1:
+                raise ValueError("A channel of %s bytes is larger than the read limit - use strategy 1 or 3" % (self.chsize*FITS_FLOAT_SIZE))
             # Calc number of reads
-            extra_batch = self.zlen % batch
-            num_reads = int(self.zlen // batch)
-            print("%s reads of batches of %s channels" % (num_reads,batch))
-            if extra_batch > 0:
-                print("Plus final read of %s" % extra_batch)
-            data = self.getChannelBatches(xmin,xmax,ymin,ymax,zmin,zmax,batch,0)
-            for i in range(num_reads-1):
-                data = np.concatenate((data,self.getChannelBatches(xmin,xmax,ymin,ymax,zmin,zmax,batch,i+1)),axis=0)
+            num_reads = -(-self.zlen // batch)
+            print("%s reads of batches of up to %s channels" % (num_reads,batch))
+            for (i,start_ch) in enumerate(range(zmin,zmax+1,batch)):
+                chdata = self.getChannelBatches(xmin,xmax,ymin,ymax,start_ch,zmax,min(batch,zmax+1-start_ch),0)
+                data = chdata if data is None else np.concatenate((data,chdata),axis=0)
                 print("Finished read %s / %s" % (i+1,num_reads))
-            if extra_batch > 0:
-                data = np.concatenate((data,self.getChannelBatches(xmin,xmax,ymin,ymax,zmin,zmax,extra_batch,i+1)),axis=0)
 
 
         return data
 
-    def getPartitionData(self,xmin,xmax,ymin,ymax,zmin,zmax,hdr,num_threads=1):
+    def __setCubeGeometry(self,header,hdrsize):
+        ''' Set the datacube dimensions from the header dict '''
+        self.hdrsize = hdrsize
+        self.xsize = int(header["NAXIS1"])
+        self.ysize = int(header["NAXIS2"])
+        self.zsize = 1
+
+        self.chsize = self.xsize * self.ysize
+
+        if int(header["NAXIS"]) == 3:
+            self.zsize = int(header["NAXIS3"])
+        else:
+            self.zsize = int(header["NAXIS4"])
+
+    def __setGeometry(self,header,hdrsize,xmin,xmax,ymin,ymax,zmin,zmax):
+        ''' Set the datacube and partition dimensions from the header dict '''
+        self.__setCubeGeometry(header,hdrsize)
+        self.xlen = xmax-xmin+1
+        self.ylen = ymax-ymin+1
+        self.zlen = zmax-zmin+1
+
+    def __poolSize(self,num_threads,num_tasks):
+        ''' num_threads should not be greater than the number of tasks, or the number of available threads! '''
+        num_threads = num_tasks if (num_threads > num_tasks) else num_threads
+        max_threads = max(os.cpu_count() - 2,1)
+        num_threads = max_threads if (num_threads > max_threads) else num_threads
+        return max(num_threads,1)
+
+    def __channelList(self,zmin,zmax,channels=None):
+        ''' Turn a channel selection into a list of channel numbers. 'channels' may be None 
+            (contiguous zmin..zmax), a slice (eg slice(0,6668,10) for every 10th channel) or 
+            a list of channel numbers.
+        '''
+        if channels is None:
+            return list(range(zmin,zmax+1))
+        if isinstance(channels,slice):
+            return list(range(*channels.indices(self.zsize)))
+        channels = [int(ch) for ch in channels]
+        for ch in channels:
+            if ch < 0 or ch >= self.zsize:
+                raise ValueError("Channel %s outside datacube (0 - %s)" % (ch,self.zsize-1))
+        return channels
+
+    def getChannelGroup(self,xmin,xmax,ymin,ymax,group,data,budget=None):
+        ''' Read a RangeGroup spanning one or more channels, and copy the required pixels of
+            each requested channel in the group straight into its place in 'data' (the flat 
+            result of getPartitionData). Returns the number of channels copied.
+            If a MemoryBudget is given, the read waits until its bytes fit in the budget.
+        '''
+        cutshape = (ymax-ymin+1,xmax-xmin+1)
+        cutsize = cutshape[0]*cutshape[1]
+        if budget:
+            budget.acquire(group.length())
+        try:
+            (buf,chdata) = self.readPooled(group.start,group.length())
+            count = 0
+            for (indx,offset,length) in group.offsets():
+                start = offset // FITS_FLOAT_SIZE
+                arr = chdata[start:start+self.chsize].reshape(self.ysize,self.xsize)
+                data[indx*cutsize:(indx+1)*cutsize].reshape(cutshape)[...] = arr[ymin:ymax+1,xmin:xmax+1]
+                count += 1
+            del chdata,arr
+            self.releaseBuffer(buf)
+        finally:
+            if budget:
+                budget.release(group.length())
+        if self.DEBUG:
+            print(f"Read {count} channels in {group.length()} bytes from byte {group.start}",flush=True)
+        return count
+
+    def getPartitionData(self,xmin,xmax,ymin,ymax,zmin,zmax,hdr,num_threads=1,channels=None,max_memory=None):
         ''' Get the data representing a subcube from a larger datacube held in objectstore.
             One of 3 read strategies could be employed:
             Stragegy 2 is used here, as it is the most efficient (see getPartitionDataByStrategy() for details).
+
+            By default channels zmin..zmax are returned. Alternatively 'channels' can be a slice
+            with a step (eg slice(0,6668,10)) or a list of channel numbers, in which case zmin and
+            zmax are ignored. Nearby channels are grouped into shared reads, isolated channels are
+            read individually, and all reads are scheduled on a single thread pool.
+            Data is returned per channel, in the order requested.
+
+            'max_memory' (or setMaxMemory()) limits the result plus all reads in flight to that many
+            bytes: the read size and the number of concurrent reads are chosen to fit, and reads 
+            wait on a MemoryBudget until there is room. The BufferPool is limited to the same read
+            budget, so it holds no more than that once the reads are done.
+
+            Tile-compressed objects (see TiledCube) are read with getTiledPartitionData(), 
+            fetching only the tiles that hold the requested channels, and give the same result.
         '''
         
         # STRATEGY = 2
-        tasks = []
-        rawdata = b''
         # Get the header data from the object store:
         header = hdr.getHeaderDict()
-        hdrstr = hdr.rawHdrData().decode() 
-        self.hdrsize = hdr.len()
+        if header.get("OSLAYOUT") == TILED_LAYOUT:
+            self.__setCubeGeometry(header,hdr.len())
+            channels = self.__channelList(zmin,zmax,channels)
+            # One box per run of consecutive channels - tiles shared by several runs are read once
+            ordered = sorted(set(channels))
+            runs = []
+            for ch in ordered:
+                if runs and runs[-1][1] == ch-1:
+                    runs[-1][1] = ch
+                else:
+                    runs.append([ch,ch])
+            planes = self.getTiledPartitionData([(xmin,xmax,ymin,ymax,z0,z1) for (z0,z1) in runs],hdr,num_threads)
+            planes = planes[0] if len(planes) == 1 else np.concatenate(planes)
+            if channels != ordered:
+                planes = planes[np.searchsorted(ordered,channels)]
+            return planes.ravel()
+        self.__setGeometry(header,hdr.len(),xmin,xmax,ymin,ymax,zmin,zmax)
         print(f"header size = {self.hdrsize}",flush=True)
 
-        self.xsize = int(header["NAXIS1"])
-        self.ysize = int(header["NAXIS2"])
-        self.zsize = 1
-        self.xlen = xmax-xmin+1
-        self.ylen = ymax-ymin+1
-        self.zlen = zmax-zmin+1
+        channels = self.__channelList(zmin,zmax,channels)
+        self.zlen = len(channels)
+        chbytes = self.chsize*FITS_FLOAT_SIZE
+        cutsize = self.xlen*self.ylen
 
-        self.chsize = self.xsize * self.ysize
-        gap_to_next_y = (self.xsize-xmax) + xmin
+        # Reads are at most ONE_G_9 bytes, or less if memory is limited
+        maxread = max(ONE_G_9,chbytes)
+        budget = None
+        max_memory = max_memory or self.max_memory
+        if max_memory:
+            reads_memory = max_memory - self.zlen*cutsize*FITS_FLOAT_SIZE
+            if reads_memory < chbytes:
+                raise ValueError("max_memory of %s bytes is too small: at least %s bytes are needed" % (max_memory,max_memory-reads_memory+chbytes))
+            # share the budget between the threads, but never read less than one channel
+            maxread = min(ONE_G_9,max(chbytes,reads_memory // max(num_threads,1)))
+            budget = MemoryBudget(reads_memory)
+            print(f"Memory limit {max_memory} bytes: reads of up to {maxread} bytes, {reads_memory} bytes in flight",flush=True)
 
-        if int(header["NAXIS"]) == 3:
-            self.zsize = int(header["NAXIS3"])
+        ranges = [(self.hdrsize + ch*chbytes,chbytes) for ch in channels]
+        tasks = coalesceRanges(ranges,gap=MERGE_GAP,maxlen=maxread)
+        print("%s reads for %s channels" % (len(tasks),self.zlen),flush=True)
+
+        # Sanity check - num_threads should not be greater than the number of tasks, or the number of available threads!
+        num_threads = self.__poolSize(num_threads,len(tasks))
+        if budget:
+            num_threads = min(num_threads,max(1,budget.limit // maxread))
+
+        from contextlib import nullcontext
+        from multiprocessing.pool import ThreadPool
+        # Pooled read buffers, in use or kept for reuse, stay within the read budget
+        with self.getBufferPool().limit(reads_memory) if budget else nullcontext():
+            pool = ThreadPool(processes=num_threads)
+            print(f"Thread pool created: {num_threads}",flush=True)
+            # Workers copy their channels straight into the result - no per-channel copies wait here
+            data = np.empty(self.zlen*cutsize,dtype='>f4')
+            result_objs = []
+            for task in tasks:
+                r = pool.apply_async(self.getChannelGroup,(xmin,xmax,ymin,ymax,task,data,budget))
+                result_objs.append(r)
+            for result in result_objs:
+                result.get()
+            pool.close()
+            pool.join()
+        return data
+
+    def getBoxGroup(self,group,owners,boxes,results):
+        ''' Read a RangeGroup holding the channels of one or more boxes, and copy each
+            box channel into its result array.
+        '''
+        (buf,data) = self.readPooled(group.start,group.length())
+        rowlen = self.xsize
+        for (indx,offset,length) in group.offsets():
+            (b,z) = owners[indx]
+            (xmin,xmax,ymin,ymax,zmin,zmax) = boxes[b]
+            start = offset // FITS_FLOAT_SIZE
+            span = data[start:start + length // FITS_FLOAT_SIZE]
+            # rows of the box are xsize floats apart within the span
+            plane = np.lib.stride_tricks.as_strided(span,shape=(ymax-ymin+1,xmax-xmin+1),strides=(rowlen*span.itemsize,span.itemsize))
+            results[b][z] = plane
+        del data,span,plane
+        self.releaseBuffer(buf)
+        if self.DEBUG:
+            print(f"Read {len(group.members)} box channels in {group.length()} bytes from byte {group.start}",flush=True)
+
+    def getPartitionDataBatch(self,boxes,hdr,num_threads=1,gap=MERGE_GAP,maxread=CUTOUT_READ):
+        ''' Get many subcubes from one datacube in a single pass, eg for the sources of a catalogue.
+            'boxes' is a list of (xmin,xmax,ymin,ymax,zmin,zmax) pixel bounds. Reads for overlapping 
+            or nearby boxes (less than 'gap' bytes apart) are merged, reads are made in object 
+            order, and all run on one thread pool - so the bytes read and the number of requests 
+            follow the union of the boxes rather than their sum.
+            Returns a list of arrays of shape (zlen,ylen,xlen), one per box.
+        '''
+        header = hdr.getHeaderDict()
+        if header.get("OSLAYOUT") == TILED_LAYOUT:
+            return self.getTiledPartitionData(boxes,hdr,num_threads,gap)
+        self.__setCubeGeometry(header,hdr.len())
+        boxes = [tuple(int(v) for v in box) for box in boxes]
+        if len(boxes) == 0:
+            return []
+
+        (ranges,owners) = boxRanges(boxes,self.xsize,self.ysize,self.zsize,self.hdrsize,FITS_FLOAT_SIZE)
+        tasks = coalesceRanges(ranges,gap=gap,maxlen=max(maxread,max([r[1] for r in ranges])))
+        print("%s reads (%s bytes) for %s boxes" % (len(tasks),totalBytes(tasks),len(boxes)),flush=True)
+
+        results = [np.empty((zmax-zmin+1,ymax-ymin+1,xmax-xmin+1),dtype='>f4') for (xmin,xmax,ymin,ymax,zmin,zmax) in boxes]
+        num_threads = self.__poolSize(num_threads,len(tasks))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=num_threads)
+        result_objs = [pool.apply_async(self.getBoxGroup,(task,owners,boxes,results)) for task in tasks]
+        for result in result_objs:
+            result.get()
+        pool.close()
+        pool.join()
+        return results
+
+    def getTileIndex(self,hdr):
+        ''' Return the TileIndex of a tile-compressed object (see TiledCube), reading the
+            trailer and index from the end of the object on first use.
+        '''
+        if self.tileindex is None:
+            size = self.getObjectSize()
+            (offset,length,ntiles) = parseTrailer(self.readBytes(size-TRAILER_SIZE,TRAILER_SIZE))
+            index = np.frombuffer(self.readBytes(offset,length),dtype=TILE_DTYPE,count=ntiles)
+            self.tileindex = TileIndex.fromHeader(hdr.getHeaderDict(),index)
+        return self.tileindex
+
+    def getTileGroup(self,group,tiles,members,boxes,results):
+        ''' Read a RangeGroup of compressed tiles, decompress each and copy the part of it
+            inside each box into that box's result array. members[tile number] lists the
+            boxes that overlap the tile.
+        '''
+        data = self.readBytes(group.start,group.length())
+        for (indx,offset,length) in group.offsets():
+            number = tiles[indx]
+            tile = self.tileindex.decompress(number,data[offset:offset+length])
+            (z0,z1,y0,y1,x0,x1) = self.tileindex.tileBox(number)
+            for b in members[number]:
+                (xmin,xmax,ymin,ymax,zmin,zmax) = boxes[b]
+                (za,zb) = (max(z0,zmin),min(z1,zmax+1))
+                (ya,yb) = (max(y0,ymin),min(y1,ymax+1))
+                (xa,xb) = (max(x0,xmin),min(x1,xmax+1))
+                if za < zb and ya < yb and xa < xb:
+                    results[b][za-zmin:zb-zmin,ya-ymin:yb-ymin,xa-xmin:xb-xmin] = tile[za-z0:zb-z0,ya-y0:yb-y0,xa-x0:xb-x0]
+
+    def getTiledPartitionData(self,boxes,hdr,num_threads=1,gap=0):
+        ''' Get subcubes from a tile-compressed object (see TiledCube). Only the compressed tiles 
+            overlapping the (xmin,xmax,ymin,ymax,zmin,zmax) boxes are read - tiles closer than 
+            'gap' bytes share a read - and each is decompressed once, on one of 'num_threads' 
+            threads (zlib and zstd release the GIL, so this uses several cores).
+            Returns a list of arrays of shape (zlen,ylen,xlen), one per box.
+        '''
+        tileindex = self.getTileIndex(hdr)
+        boxes = [tuple(int(v) for v in box) for box in boxes]
+        if len(boxes) == 0:
+            return []
+        (zsize,ysize,xsize) = tileindex.shape
+        for (xmin,xmax,ymin,ymax,zmin,zmax) in boxes:
+            if xmin < 0 or ymin < 0 or zmin < 0 or xmax >= xsize or ymax >= ysize or zmax >= zsize \
+                    or xmin > xmax or ymin > ymax or zmin > zmax:
+                raise ValueError("Box %s is not within the datacube" % ((xmin,xmax,ymin,ymax,zmin,zmax),))
+        members = {}
+        for (b,box) in enumerate(boxes):
+            for number in tileindex.tilesFor(*box):
+                members.setdefault(number,[]).append(b)
+        tiles = sorted(members)
+        ranges = [(int(tileindex.index[n]['offset']),int(tileindex.index[n]['length'])) for n in tiles]
+        tasks = coalesceRanges(ranges,gap=gap,maxlen=max(CUTOUT_READ,max([r[1] for r in ranges])))
+        print("%s reads (%s bytes) of %s compressed tiles for %s boxes" % (len(tasks),totalBytes(tasks),len(tiles),len(boxes)),flush=True)
+
+        results = [np.empty((zmax-zmin+1,ymax-ymin+1,xmax-xmin+1),dtype='>f4') for (xmin,xmax,ymin,ymax,zmin,zmax) in boxes]
+        num_threads = self.__poolSize(num_threads,len(tasks))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=num_threads)
+        result_objs = [pool.apply_async(self.getTileGroup,(task,tiles,members,boxes,results)) for task in tasks]
+        for result in result_objs:
+            result.get()
+        pool.close()
+        pool.join()
+        return results
+
+    def getSpectrumGroup(self,task,spectra):
+        ''' Read one range holding pixels of one or more spectra, and copy them into 'spectra' '''
+        (start,length,items,index) = task
+        (buf,data) = self.readPooled(start,length)
+        spectra.flat[items] = data[index]
+        del data
+        self.releaseBuffer(buf)
+
+    def getSpectra(self,positions,hdr,zmin=None,zmax=None,num_threads=1,gap=MERGE_GAP,maxread=CUTOUT_READ):
+        ''' Get the spectra (line-of-sight pixel values over channels zmin..zmax, all channels 
+            by default) at a list of (x,y) pixel positions. 
+            The pixel offsets of every position in every channel are grouped into range reads:
+            sparse positions give small reads of nearby pixels, while dense positions merge into 
+            reads of whole channel slabs. All reads run concurrently on one thread pool.
+            Returns an array of shape (npos,nchan).
+        '''
+        header = hdr.getHeaderDict()
+        self.__setCubeGeometry(header,hdr.len())
+        zmin = 0 if zmin is None else zmin
+        zmax = self.zsize-1 if zmax is None else zmax
+        if self.replica is not None:
+            (replica,replica_hdr) = self.replica
+            return replica.getReplicaSpectra(positions,replica_hdr,zmin,zmax,num_threads,gap,maxread)
+        positions = np.asarray(positions,dtype=np.int64).reshape(-1,2)
+        if np.any(positions < 0) or np.any(positions[:,0] >= self.xsize) or np.any(positions[:,1] >= self.ysize):
+            raise ValueError("Positions must be within the %s x %s channel" % (self.xsize,self.ysize))
+        if zmin < 0 or zmax >= self.zsize or zmin > zmax:
+            raise ValueError("Channels %s - %s not within the datacube (0 - %s)" % (zmin,zmax,self.zsize-1))
+        if header.get("OSLAYOUT") == TILED_LAYOUT:
+            # Each spectrum is a one pixel box - the tiles holding several are read once
+            boxes = [(x,x,y,y,zmin,zmax) for (x,y) in positions.tolist()]
+            spectra = self.getTiledPartitionData(boxes,hdr,num_threads,gap)
+            return np.array([s.ravel() for s in spectra],dtype='>f4').reshape(len(positions),zmax-zmin+1)
+
+        nchan = zmax-zmin+1
+        chbytes = self.chsize*FITS_FLOAT_SIZE
+        pixel = (positions[:,1]*self.xsize + positions[:,0])*FITS_FLOAT_SIZE
+        channel = self.hdrsize + np.arange(zmin,zmax+1,dtype=np.int64)*chbytes
+        offsets = pixel[:,None] + channel[None,:] # (npos,nchan)
+        tasks = coalesceOffsets(offsets,FITS_FLOAT_SIZE,gap=gap,maxlen=maxread)
+        print("%s reads (%s bytes) for %s spectra of %s channels" % (len(tasks),sum([t[1] for t in tasks]),len(positions),nchan),flush=True)
+
+        spectra = np.empty((len(positions),nchan),dtype='>f4')
+        num_threads = self.__poolSize(num_threads,len(tasks))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=num_threads)
+        result_objs = [pool.apply_async(self.getSpectrumGroup,(task,spectra)) for task in tasks]
+        for result in result_objs:
+            result.get()
+        pool.close()
+        pool.join()
+        return spectra
+
+    def setSpectralReplica(self,replica,replica_hdr):
+        ''' Send spectrum-shaped requests (getSpectra) to a spectral-major replica of this 
+            cube (see SpectralReplica), given as an S3Object/UrlObject and its header.
+            Image-shaped requests still read this object. Pass None to stop using the replica.
+        '''
+        self.replica = None if replica is None else (replica,replica_hdr)
+
+    def getReplicaSpectra(self,positions,hdr,zmin,zmax,num_threads=1,gap=MERGE_GAP,maxread=CUTOUT_READ):
+        ''' getSpectra() for an object holding a spectral-major replica - each spectrum is
+            a single contiguous range, and spectra of neighbouring pixels share reads.
+        '''
+        header = hdr.getHeaderDict()
+        nchan = int(header["NAXIS1"])
+        if zmin < 0 or zmax >= nchan or zmin > zmax:
+            raise ValueError("Channels %s - %s not within the datacube (0 - %s)" % (zmin,zmax,nchan-1))
+        ranges = replicaSpectrumRanges(np.asarray(positions,dtype=np.int64).reshape(-1,2),header,hdr.len(),zmin,zmax)
+        tasks = coalesceRanges(ranges,gap=gap,maxlen=max(maxread,(zmax-zmin+1)*FITS_FLOAT_SIZE))
+        print("%s replica reads (%s bytes) for %s spectra" % (len(tasks),totalBytes(tasks),len(ranges)),flush=True)
+
+        spectra = np.empty((len(ranges),zmax-zmin+1),dtype='>f4')
+        num_threads = self.__poolSize(num_threads,len(tasks))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=num_threads)
+        result_objs = [pool.apply_async(self.getReplicaGroup,(task,spectra)) for task in tasks]
+        for result in result_objs:
+            result.get()
+        pool.close()
+        pool.join()
+        return spectra
+
+    def getReplicaGroup(self,group,spectra):
+        ''' Read a RangeGroup of replica spectra and copy them into 'spectra' '''
+        (buf,data) = self.readPooled(group.start,group.length())
+        for (indx,offset,length) in group.offsets():
+            start = offset // FITS_FLOAT_SIZE
+            spectra[indx] = data[start:start + length // FITS_FLOAT_SIZE]
+        del data
+        self.releaseBuffer(buf)
+
+    def getSkyPartitionData(self,ra,dec,hdr,radius=None,box=None,spectral=None,num_threads=1):
+        ''' Get the subcube around a sky position (degrees), within a cone 'radius' or a 
+            (width,height) 'box' in degrees, and optionally a (low,high) frequency or velocity 
+            range - see WCSCutout.skyToPixelBounds().
+            Returns (bounds,data) where bounds is (xmin,xmax,ymin,ymax,zmin,zmax) and data has
+            shape (zlen,ylen,xlen), or (None,None) if the position is outside the datacube.
+        '''
+        return self.getSkyPartitionDataBatch([ra],[dec],hdr,radius,box,spectral,num_threads)[0]
+
+    def getSkyPartitionDataBatch(self,ras,decs,hdr,radius=None,box=None,spectral=None,num_threads=1):
+        ''' As getSkyPartitionData(), for a list of sky positions. The pixel bounds of all
+            positions are computed at once from the (cached) WCS of the header, and the
+            subcubes are read together with getPartitionDataBatch().
+            Returns a list of (bounds,data), one per position.
+        '''
+        bounds = skyToPixelBounds(hdr,ras,decs,radius=radius,box=box,spectral=spectral)
+        inside = [b for b in bounds if b is not None]
+        data = iter(self.getPartitionDataBatch(inside,hdr,num_threads))
+        return [(None,None) if b is None else (b,next(data)) for b in bounds]
+
+    def getRegionGroup(self,task,pixstart,runlen,out,outstart):
+        ''' Read a range holding one or more row runs of a region, and copy the pixels of 
+            runs first..last-1 to out.flat[outstart[run] ...]
+        '''
+        (start,length,first,last) = task
+        (buf,data) = self.readPooled(start,length)
+        n = runlen[first:last]
+        total = int(n.sum())
+        cum = np.cumsum(n) - n
+        steps = np.arange(total)
+        src = np.repeat(pixstart[first:last] - start // FITS_FLOAT_SIZE - cum,n) + steps
+        dst = np.repeat(outstart[first:last] - cum,n) + steps
+        out.flat[dst] = data[src]
+        del data
+        self.releaseBuffer(buf)
+
+    def getRegionData(self,region,hdr,zmin=None,zmax=None,origin=(0,0),channel_mask=None,output='packed',
+                      num_threads=1,gap=MERGE_GAP,maxread=CUTOUT_READ):
+        ''' Get the pixels of an irregular region over channels zmin..zmax (all by default).
+            'region' is a polygon - a list of (x,y) pixel vertices (see RegionMask.polygonMask,
+            and skyPolygonMask for (ra,dec) vertices) - or a 2D boolean mask with mask[0,0] at
+            pixel 'origin' (x0,y0). 'channel_mask' optionally gives a (zlen,ylen,xlen) boolean 
+            mask (same plane shape as the region mask) that further selects pixels per channel.
+            Only the row runs of selected pixels are read, merged into range reads where they 
+            are less than 'gap' bytes apart, on one thread pool. For a tile-compressed object 
+            the tiles holding selected pixels are read instead (see getTiledRegionData).
+            Returns, for output='packed', (coords,values) - an (n,3) array of (z,y,x) pixel 
+            coordinates and the n pixel values; for output='masked', (bounds,data) - the
+            (xmin,xmax,ymin,ymax,zmin,zmax) bounds of the region and a numpy masked array of
+            shape (zlen,ylen,xlen) with unselected pixels masked.
+        '''
+        if output not in ('packed','masked'):
+            raise ValueError("output must be 'packed' or 'masked'")
+        header = hdr.getHeaderDict()
+        self.__setCubeGeometry(header,hdr.len())
+        zmin = 0 if zmin is None else zmin
+        zmax = self.zsize-1 if zmax is None else zmax
+        if zmin < 0 or zmax >= self.zsize or zmin > zmax:
+            raise ValueError("Channels %s - %s not within the datacube (0 - %s)" % (zmin,zmax,self.zsize-1))
+        if isinstance(region,np.ndarray) and region.dtype == bool:
+            (mask,(x0,y0)) = (region,origin)
         else:
-            self.zsize = int(header["NAXIS4"])
+            (mask,(x0,y0)) = polygonMask(region,self.xsize,self.ysize)
+        (x0,y0) = (int(x0),int(y0))
+        if x0 < 0 or y0 < 0 or x0 + mask.shape[1] > self.xsize or y0 + mask.shape[0] > self.ysize:
+            raise ValueError("Region mask of shape %s at %s is not within the %s x %s channel" % (mask.shape,(x0,y0),self.xsize,self.ysize))
+        zlen = zmax-zmin+1
+        if channel_mask is not None:
+            channel_mask = np.asarray(channel_mask,dtype=bool)
+            if channel_mask.shape != (zlen,) + mask.shape:
+                raise ValueError("channel_mask must have shape %s" % ((zlen,) + mask.shape,))
+            cubemask = channel_mask & mask
+        else:
+            cubemask = np.broadcast_to(mask,(zlen,) + mask.shape)
+        bounds = (x0,x0+mask.shape[1]-1,y0,y0+mask.shape[0]-1,zmin,zmax)
 
-        # Calc number of channels we can read at once (batchsize)
-        batch = int(ONE_G_9 // (self.chsize*FITS_FLOAT_SIZE))
-        # Calc number of reads
-        extra_batch = int(self.zlen % batch)
-        num_reads = int(self.zlen // batch)
-        print("%s reads of channels in batches of %s" % (num_reads,batch),flush=True)
+        if header.get("OSLAYOUT") == TILED_LAYOUT:
+            data = self.getTiledRegionData(cubemask,bounds,hdr,num_threads)
+            if output == 'packed':
+                # np.nonzero order is (z,y,x) row order - the order of the row runs
+                return (np.argwhere(cubemask) + [zmin,y0,x0],data[cubemask])
+            return (bounds,np.ma.MaskedArray(data,mask=~cubemask))
 
-        # Define tasks
-        for i in range(num_reads):
-            tasks.append([batch,i])
-        if extra_batch > 0:
-            print("Plus final read of %s" % extra_batch,flush=True)
-            tasks.append([extra_batch,len(tasks)])
+        (zs,ys,xs,xe) = rowRuns(cubemask)
+        runlen = (xe - xs).astype(np.int64)
+        # item (float) number of the first pixel of each run in the object
+        pixstart = (self.hdrsize // FITS_FLOAT_SIZE) + ((zs + zmin).astype(np.int64)*self.chsize
+                    + (ys + y0).astype(np.int64)*self.xsize + xs + x0)
+        if output == 'packed':
+            outstart = np.cumsum(runlen) - runlen
+            out = np.empty(int(runlen.sum()),dtype='>f4')
+        else:
+            outstart = (zs.astype(np.int64)*mask.shape[0] + ys)*mask.shape[1] + xs
+            out = np.zeros(cubemask.shape,dtype='>f4')
+        tasks = coalesceSpans(pixstart*FITS_FLOAT_SIZE,runlen*FITS_FLOAT_SIZE,gap=gap,maxlen=maxread)
+        print("%s reads (%s bytes) for %s row runs (%s pixels) of a region" % (len(tasks),sum([t[1] for t in tasks]),len(runlen),int(runlen.sum())),flush=True)
 
-        # Sanity check - num_threads should not be greater than the number of tasks, or the number of available threads!
-        num_threads = len(tasks) if (num_threads > len(tasks)) else num_threads
-        max_threads = os.cpu_count() - 2
-        num_threads = max_threads if (num_threads > max_threads) else num_threads
+        if tasks:
+            num_threads = self.__poolSize(num_threads,len(tasks))
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(processes=num_threads)
+            result_objs = [pool.apply_async(self.getRegionGroup,(task,pixstart,runlen,out,outstart)) for task in tasks]
+            for result in result_objs:
+                result.get()
+            pool.close()
+            pool.join()
 
-        pool = mp.pool.ThreadPool(processes=num_threads)
-        print(f"Thread pool created: {num_threads}",flush=True)
-        result_objs = []
-        for task in tasks:
-            r = pool.apply_async(self.getChannelBatches,(xmin,xmax,ymin,ymax,zmin,zmax,task[0],task[1]))
-            result_objs.append(r)
-        data = np.concatenate([result.get() for result in result_objs])
-        return data
+        if output == 'packed':
+            # (z,y,x) of every pixel, in the order of the values
+            offsets = np.arange(out.size) - np.repeat(outstart,runlen)
+            coords = np.stack((np.repeat(zs + zmin,runlen),np.repeat(ys + y0,runlen),np.repeat(xs + x0,runlen) + offsets),axis=1)
+            return (coords,out)
+        return (bounds,np.ma.MaskedArray(out,mask=~cubemask))
+
+    def getTiledRegionData(self,cubemask,bounds,hdr,num_threads=1):
+        ''' Read the pixels selected by 'cubemask' (a (zlen,ylen,xlen) boolean mask of the
+            (xmin,xmax,ymin,ymax,zmin,zmax) 'bounds') from a tile-compressed object. Only tiles 
+            holding selected pixels are read. Returns an array of the shape of the mask, with
+            zeros at unselected pixels.
+        '''
+        (xmin,xmax,ymin,ymax,zmin,zmax) = bounds
+        (tz,ty,tx) = self.getTileIndex(hdr).tile
+        boxes = []
+        for z in range(zmin - zmin % tz,zmax+1,tz):
+            for y in range(ymin - ymin % ty,ymax+1,ty):
+                for x in range(xmin - xmin % tx,xmax+1,tx):
+                    box = (max(x,xmin),min(x+tx-1,xmax),max(y,ymin),min(y+ty-1,ymax),max(z,zmin),min(z+tz-1,zmax))
+                    if cubemask[box[4]-zmin:box[5]-zmin+1,box[2]-ymin:box[3]-ymin+1,box[0]-xmin:box[1]-xmin+1].any():
+                        boxes.append(box)
+        data = np.zeros(cubemask.shape,dtype='>f4')
+        for (box,part) in zip(boxes,self.getTiledPartitionData(boxes,hdr,num_threads)):
+            data[box[4]-zmin:box[5]-zmin+1,box[2]-ymin:box[3]-ymin+1,box[0]-xmin:box[1]-xmin+1] = part
+        return np.where(cubemask,data,0).astype('>f4')
 
 ########################################################################################
 ############################### END CLASS ##############################################
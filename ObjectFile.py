@@ -0,0 +1,115 @@
+''' A seekable, read-only file object over an S3Object or UrlObject.
+
+    Reads are served from a small LRU cache of fixed size blocks. Blocks are fetched
+    with range reads: sequential access doubles the readahead (up to 'maxreadahead'
+    blocks in one read), random access drops it back to a single block. Reads larger
+    than the readahead window go straight to the objectstore, bypassing the cache.
+    This lets libraries such as astropy.io.fits read an object lazily, without
+    downloading the whole file.
+'''
+import io
+from collections import OrderedDict
+
+ONE_M = 1024 ** 2 # 1 Mb
+
+########################################################################################
+############################### CLASS ObjectRawIO ######################################
+########################################################################################
+class ObjectRawIO(io.RawIOBase):
+    ''' io.RawIOBase interface to an object. 'obj' is any FitsObjStore (S3Object or UrlObject). '''
+
+    def __init__(self,obj,blocksize=ONE_M,cacheblocks=32,maxreadahead=64):
+        io.RawIOBase.__init__(self)
+        self.obj = obj
+        self.name = getattr(obj,'obj',None) or getattr(obj,'url','')
+        self.mode = 'rb'
+        self.blocksize = blocksize
+        self.cacheblocks = cacheblocks
+        self.maxreadahead = maxreadahead
+        self.size = obj.getObjectSize()
+        self.__pos = 0
+        self.__blocks = OrderedDict() # block number -> bytes, in LRU order
+        self.__readahead = 1
+        self.__next_block = None # block expected next if access is sequential
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__pos
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.__pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence (%s)" % whence)
+        if pos < 0:
+            raise ValueError("Negative seek position %s" % pos)
+        self.__pos = pos
+        return pos
+
+    def __fetch(self,block):
+        ''' Read 'block' (plus readahead) from the objectstore into the cache '''
+        if block == self.__next_block:
+            self.__readahead = min(self.__readahead*2,self.maxreadahead)
+        else:
+            self.__readahead = 1
+        nblocks = self.__readahead
+        start = block * self.blocksize
+        length = min(nblocks*self.blocksize,self.size-start)
+        data = self.obj.readBytes(start,length)
+        for i in range(0,len(data),self.blocksize):
+            self.__store(block + i//self.blocksize,data[i:i+self.blocksize])
+        self.__next_block = block + nblocks
+
+    def __store(self,block,data):
+        self.__blocks[block] = data
+        self.__blocks.move_to_end(block)
+        while len(self.__blocks) > self.cacheblocks:
+            self.__blocks.popitem(last=False)
+
+    def __getBlock(self,block):
+        if block not in self.__blocks:
+            self.__fetch(block)
+        else:
+            self.__blocks.move_to_end(block)
+        return self.__blocks[block]
+
+    def readinto(self,b):
+        mv = memoryview(b).cast('B')
+        length = min(len(mv),self.size - self.__pos)
+        if length <= 0:
+            return 0
+        if length >= self.blocksize * self.maxreadahead:
+            # Large read - fetch directly
+            data = self.obj.readBytes(self.__pos,length)
+            mv[:len(data)] = data
+            self.__pos += len(data)
+            self.__next_block = (self.__pos + self.blocksize - 1) // self.blocksize
+            return len(data)
+        done = 0
+        while done < length:
+            block,offset = divmod(self.__pos,self.blocksize)
+            data = self.__getBlock(block)
+            n = min(len(data) - offset,length - done)
+            if n <= 0:
+                break
+            mv[done:done+n] = data[offset:offset+n]
+            done += n
+            self.__pos += n
+        return done
+
+    def readall(self):
+        return self.read(self.size - self.__pos)
+
+
+def openObject(obj,blocksize=ONE_M,cacheblocks=32,maxreadahead=64):
+    ''' Return an io.BufferedReader over the object, eg fits.open(openObject(obj)) '''
+    return io.BufferedReader(ObjectRawIO(obj,blocksize,cacheblocks,maxreadahead),buffer_size=blocksize)
@@ -0,0 +1,137 @@
+''' Planning of byte-range reads against an object held in an objectstore.
+
+    Requested ranges that lie close together are grouped into a single range read,
+    (reading the small gap between them is cheaper than opening another stream),
+    while isolated ranges are read on their own.
+'''
+
+MERGE_GAP = 1024 ** 2 * 4 # Ranges closer than 4Mb share a read
+
+########################################################################################
+############################### CLASS RangeGroup #######################################
+########################################################################################
+class RangeGroup:
+    ''' A single range read from the object, covering one or more of the requested ranges.
+        'members' holds (index,start,length) for each requested range, where 'index' is the
+        position of the range in the original request.
+    '''
+
+    def __init__(self,start,end,members):
+        self.start = start # first byte of the read
+        self.end = end # one past the last byte of the read
+        self.members = members
+
+    def __repr__(self):
+        return "RangeGroup(%s-%s, %s ranges)" % (self.start,self.end-1,len(self.members))
+
+    def length(self):
+        return self.end - self.start
+
+    def offsets(self):
+        ''' Return (index,offset,length) for each member, with offset relative to the group start '''
+        return [(indx,start-self.start,length) for (indx,start,length) in self.members]
+
+
+def coalesceRanges(ranges,gap=MERGE_GAP,maxlen=None):
+    ''' Group a list of (start,length) byte ranges into RangeGroups, ordered by start.
+        Ranges separated by no more than 'gap' bytes share a read, as long as the read
+        does not grow beyond 'maxlen' bytes (no limit if None).
+    '''
+    order = sorted(range(len(ranges)),key=lambda i: ranges[i][0])
+    groups = []
+    current = None
+    for indx in order:
+        start,length = ranges[indx]
+        end = start + length
+        if current is not None and start - current.end <= gap \
+                and (maxlen is None or max(end,current.end) - current.start <= maxlen):
+            current.end = max(end,current.end)
+            current.members.append((indx,start,length))
+        else:
+            current = RangeGroup(start,end,[(indx,start,length)])
+            groups.append(current)
+    return groups
+
+
+def totalBytes(groups):
+    ''' Number of bytes that will be transferred to satisfy the given RangeGroups '''
+    return sum([group.length() for group in groups])
+
+
+def boxRanges(boxes,xsize,ysize,zsize,hdrsize,itemsize=4):
+    ''' Return the byte ranges needed to read a list of (xmin,xmax,ymin,ymax,zmin,zmax) boxes 
+        from a datacube with x varying fastest. Each box needs one range per channel, running 
+        from its first pixel (xmin,ymin) to its last pixel (xmax,ymax) in that channel.
+        Returns (ranges,owners) where owners[i] is the (box number,channel offset) of ranges[i].
+    '''
+    chbytes = xsize*ysize*itemsize
+    rowbytes = xsize*itemsize
+    ranges = []
+    owners = []
+    for (b,(xmin,xmax,ymin,ymax,zmin,zmax)) in enumerate(boxes):
+        if xmin < 0 or ymin < 0 or zmin < 0 or xmax >= xsize or ymax >= ysize or zmax >= zsize \
+                or xmin > xmax or ymin > ymax or zmin > zmax:
+            raise ValueError("Box %s %s is not within the datacube" % (b,(xmin,xmax,ymin,ymax,zmin,zmax)))
+        first = hdrsize + ymin*rowbytes + xmin*itemsize
+        length = (ymax-ymin)*rowbytes + (xmax-xmin+1)*itemsize
+        for z in range(zmin,zmax+1):
+            ranges.append((first + z*chbytes,length))
+            owners.append((b,z-zmin))
+    return (ranges,owners)
+
+
+def coalesceOffsets(offsets,itemsize=4,gap=MERGE_GAP,maxlen=None):
+    ''' Group a numpy array of item offsets (each 'itemsize' bytes long) into range reads.
+        This is the vectorised form of coalesceRanges(), for very many small items such 
+        as single pixels. Returns a list of (start,length,items,index) where 'items' are 
+        the positions of the grouped offsets in the input array, and 'index' is the item 
+        number of each within the read.
+    '''
+    import numpy as np
+    offsets = np.asarray(offsets,dtype=np.int64).ravel()
+    if offsets.size == 0:
+        return []
+    order = np.argsort(offsets,kind='stable')
+    ordered = offsets[order]
+    breaks = np.flatnonzero(np.diff(ordered) > gap + itemsize) + 1
+    if maxlen is not None:
+        # split long runs into reads of no more than maxlen bytes
+        seg = np.zeros(ordered.size,dtype=np.int64)
+        seg[breaks] = 1
+        seg = np.cumsum(seg)
+        segstart = np.concatenate(([0],breaks))[seg]
+        chunk = (ordered - ordered[segstart]) // max(maxlen-itemsize,itemsize)
+        breaks = np.union1d(breaks,np.flatnonzero(np.diff(chunk) != 0) + 1)
+    bounds = np.concatenate(([0],breaks,[ordered.size]))
+    groups = []
+    for i in range(len(bounds)-1):
+        lo,hi = bounds[i],bounds[i+1]
+        start = int(ordered[lo])
+        length = int(ordered[hi-1]) - start + itemsize
+        groups.append((start,length,order[lo:hi],(ordered[lo:hi]-start)//itemsize))
+    return groups
+
+
+def coalesceSpans(starts,lengths,gap=MERGE_GAP,maxlen=None):
+    ''' Group byte spans, given as numpy arrays of starts and lengths sorted by start and not
+        overlapping (eg the row runs of a region), into range reads. This is the vectorised 
+        form of coalesceRanges() for very many spans. A read is split once it reaches 'maxlen' 
+        bytes, so it can exceed 'maxlen' by at most one span. Returns a list of 
+        (start,length,first,last) where spans first..last-1 share the read.
+    '''
+    import numpy as np
+    starts = np.asarray(starts,dtype=np.int64).ravel()
+    lengths = np.asarray(lengths,dtype=np.int64).ravel()
+    if starts.size == 0:
+        return []
+    ends = starts + lengths
+    breaks = np.flatnonzero(starts[1:] - ends[:-1] > gap) + 1
+    if maxlen is not None:
+        seg = np.zeros(starts.size,dtype=np.int64)
+        seg[breaks] = 1
+        seg = np.cumsum(seg)
+        segstart = np.concatenate(([0],breaks))[seg]
+        chunk = (starts - starts[segstart]) // max(maxlen,1)
+        breaks = np.union1d(breaks,np.flatnonzero(np.diff(chunk) != 0) + 1)
+    bounds = np.concatenate(([0],breaks,[starts.size]))
+    return [(int(starts[lo]),int(ends[hi-1]-starts[lo]),int(lo),int(hi)) for (lo,hi) in zip(bounds[:-1],bounds[1:])]
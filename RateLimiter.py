@@ -0,0 +1,209 @@
+''' Request-rate and bandwidth limiting per objectstore endpoint (and project).
+
+    A RateLimiter is a pair of token buckets - requests per second and bytes per second.
+    Every read and upload takes one request token and its bytes before it is sent, waiting
+    if the buckets are empty. When the store answers with a throttle response (503 SlowDown,
+    429) the limiter halves its rates, then lets them recover linearly (AIMD), so jobs that
+    share an endpoint settle close to its limit rather than retrying in lock-step.
+
+    Limiters are shared by all objects in a process through the registry (configureLimiter /
+    getLimiter). Given a 'lockfile', the bucket state is kept in that file under an fcntl
+    lock, so all processes on a node that use the same file share one budget.
+
+    S3Objects pick up the limiter registered for their endpoint; limiter.attach(client)
+    hooks it into every call a boto3 client makes, including multipart transfers.
+'''
+import os
+import time
+import struct
+import threading
+
+THROTTLE_STATUS = (429,503)
+THROTTLE_CODES = ('SlowDown','Throttling','ThrottlingException','RequestLimitExceeded','TooManyRequests',
+                  'ServiceUnavailable','RequestThrottled','503')
+MIN_FACTOR = 1.0 / 64 # rates are never cut below this fraction of the configured rates
+RECOVERY = 0.05 # fraction of the configured rates recovered per second after a throttle
+COOLDOWN = 1.0 # seconds - throttles within this time of the last count once
+MAX_ATTEMPTS = 8 # attempts at a throttled request (URL reads and uploads)
+STATE = struct.Struct('=ddddd') # request tokens, byte tokens, last refill, rate factor, last throttle
+
+
+def backoff(attempt,base=0.1,cap=20.0):
+    ''' Seconds to wait before retry 'attempt' (1, 2, ...) of a throttled request - exponential, with jitter '''
+    import random
+    return random.uniform(0,min(cap,base * 2 ** attempt))
+
+
+########################################################################################
+############################### CLASS RateLimiter ######################################
+########################################################################################
+class RateLimiter:
+    ''' Token buckets of 'requests_per_s' requests and 'bytes_per_s' bytes per second (either
+        may be None for no limit), holding up to 'burst' seconds worth of tokens.
+    '''
+
+    def __init__(self,requests_per_s=None,bytes_per_s=None,burst=1.0,lockfile=None):
+        self.requests_per_s = requests_per_s
+        self.bytes_per_s = bytes_per_s
+        self.burst = burst
+        self.lockfile = lockfile
+        self.throttles = 0 # throttle responses seen by this process
+        self.waited = 0.0 # seconds spent waiting for tokens in this process
+        self.__lock = threading.Lock()
+        self.__state = (self.__capacity(requests_per_s),self.__capacity(bytes_per_s),time.time(),1.0,0.0)
+        self.__fd = None
+        if lockfile:
+            self.__fd = os.open(lockfile,os.O_RDWR | os.O_CREAT,0o666)
+
+    def __capacity(self,rate):
+        return rate*self.burst if rate else 0.0
+
+    def __update(self,change):
+        ''' Apply change(state) -> (new state,result) to the bucket state, under the thread
+            lock and (if shared) the lock file. Returns the result.
+        '''
+        with self.__lock:
+            if self.__fd is None:
+                (self.__state,result) = change(self.__state)
+                return result
+            import fcntl
+            fcntl.flock(self.__fd,fcntl.LOCK_EX)
+            try:
+                data = os.pread(self.__fd,STATE.size,0)
+                state = STATE.unpack(data) if len(data) == STATE.size else self.__state
+                (state,result) = change(state)
+                os.pwrite(self.__fd,STATE.pack(*state),0)
+                return result
+            finally:
+                fcntl.flock(self.__fd,fcntl.LOCK_UN)
+
+    def __refill(self,state,now):
+        (reqs,nbytes,last,factor,last_throttle) = state
+        elapsed = max(0.0,now - last)
+        factor = min(1.0,factor + RECOVERY*elapsed)
+        if self.requests_per_s:
+            reqs = min(self.__capacity(self.requests_per_s),reqs + elapsed*self.requests_per_s*factor)
+        if self.bytes_per_s:
+            nbytes = min(self.__capacity(self.bytes_per_s),nbytes + elapsed*self.bytes_per_s*factor)
+        return (reqs,nbytes,now,factor,last_throttle)
+
+    def acquire(self,nbytes=0,requests=1):
+        ''' Take tokens for 'requests' requests moving 'nbytes' bytes, waiting until they are
+            available. Large transfers borrow against the future, so the wait follows the
+            bytes actually moved. Returns the seconds waited.
+        '''
+        if not self.requests_per_s and not self.bytes_per_s:
+            return 0.0
+        def take(state):
+            (reqs,avail,now,factor,last_throttle) = self.__refill(state,time.time())
+            wait = 0.0
+            if self.requests_per_s:
+                reqs -= requests
+                wait = max(wait,-reqs/(self.requests_per_s*factor))
+            if self.bytes_per_s:
+                avail -= nbytes
+                wait = max(wait,-avail/(self.bytes_per_s*factor))
+            return ((reqs,avail,now,factor,last_throttle),wait)
+        wait = self.__update(take)
+        if wait > 0:
+            time.sleep(wait)
+            self.waited += wait
+        return wait
+
+    def throttled(self):
+        ''' Record a throttle response: the rates are halved (at most once per COOLDOWN seconds) '''
+        self.throttles += 1
+        def cut(state):
+            (reqs,nbytes,now,factor,last_throttle) = self.__refill(state,time.time())
+            if now - last_throttle > COOLDOWN:
+                factor = max(MIN_FACTOR,factor/2)
+                last_throttle = now
+            return ((min(reqs,0.0),min(nbytes,0.0),now,factor,last_throttle),factor)
+        return self.__update(cut)
+
+    def factor(self):
+        ''' Current fraction of the configured rates allowed (1 when not throttled) '''
+        def read(state):
+            state = self.__refill(state,time.time())
+            return (state,state[3])
+        return self.__update(read)
+
+    def attach(self,client):
+        ''' Make every request of a boto3 client take tokens, and throttle responses cut the rates '''
+        client.meta.events.register('before-send.s3',self.__beforeSend)
+        client.meta.events.register_first('needs-retry.s3',self.__needsRetry)
+
+    def detach(self,client):
+        client.meta.events.unregister('before-send.s3',self.__beforeSend)
+        client.meta.events.unregister('needs-retry.s3',self.__needsRetry)
+
+    def __beforeSend(self,request,**kwargs):
+        nbytes = 0
+        ranges = request.headers.get('Range')
+        if ranges:
+            if isinstance(ranges,bytes):
+                ranges = ranges.decode()
+            try:
+                (first,last) = ranges.split('=')[1].split('-')
+                nbytes = int(last) - int(first) + 1
+            except ValueError:
+                pass
+        elif request.headers.get('Content-Length'):
+            nbytes = int(request.headers.get('Content-Length'))
+        self.acquire(nbytes)
+        return None # carry on and send the request
+
+    def __needsRetry(self,response=None,**kwargs):
+        if response is not None:
+            (http,parsed) = response
+            code = (parsed or {}).get('Error',{}).get('Code')
+            if (http is not None and http.status_code in THROTTLE_STATUS) or code in THROTTLE_CODES:
+                self.throttled()
+        return None # let botocore decide whether (and when) to retry
+
+    def request(self,http,method,url,nbytes=0,**kwargs):
+        ''' Make a urllib3 request within the limits, retrying (with backoff) when throttled.
+            Returns the response of the last attempt.
+        '''
+        for attempt in range(1,MAX_ATTEMPTS+1):
+            self.acquire(nbytes)
+            response = http.request(method,url,**kwargs)
+            if response.status not in THROTTLE_STATUS or attempt == MAX_ATTEMPTS:
+                return response
+            response.drain_conn()
+            response.release_conn()
+            self.throttled()
+            time.sleep(backoff(attempt))
+
+
+__limiters = {}
+__limiters_lock = threading.Lock()
+
+def configureLimiter(endpoint,project=None,requests_per_s=None,bytes_per_s=None,burst=1.0,lockfile=None):
+    ''' Create (or replace) the limiter for an endpoint (and project), shared by all objects in
+        this process. With project=None it applies to any project on the endpoint that has no
+        limiter of its own. Give the same 'lockfile' in each process to share it across a node.
+    '''
+    limiter = RateLimiter(requests_per_s,bytes_per_s,burst,lockfile)
+    with __limiters_lock:
+        __limiters[(endpoint,project)] = limiter
+    return limiter
+
+
+def getLimiter(endpoint,project=None):
+    ''' Return the limiter for an endpoint and project (falling back to the endpoint's), or None '''
+    with __limiters_lock:
+        limiter = __limiters.get((endpoint,project)) or __limiters.get((endpoint,None))
+    return limiter or limiterFromEnvironment(endpoint)
+
+
+def limiterFromEnvironment(endpoint):
+    ''' Configure the endpoint limiter from OBJSTORE_REQUESTS_PER_S, OBJSTORE_BYTES_PER_S and
+        OBJSTORE_LIMIT_LOCKFILE, if set - so batch jobs can be limited without code changes.
+    '''
+    reqs = os.environ.get('OBJSTORE_REQUESTS_PER_S')
+    nbytes = os.environ.get('OBJSTORE_BYTES_PER_S')
+    if not reqs and not nbytes:
+        return None
+    return configureLimiter(endpoint,None,float(reqs) if reqs else None,float(nbytes) if nbytes else None,
+                            lockfile=os.environ.get('OBJSTORE_LIMIT_LOCKFILE'))
@@ -0,0 +1,62 @@
+''' Irregular regions of a datacube - polygons and masks - as runs of pixels along rows.
+
+    A region is a 2D boolean mask (from a polygon, or eg a source finder), optionally
+    combined with a mask per channel. Each row of each channel holds zero or more runs of
+    selected pixels, and each run is one contiguous byte span of the cube - so reading the
+    runs (merged into range reads where close, see FitsObjStore.getRegionData) moves bytes
+    in proportion to the area of the region rather than its bounding box.
+'''
+import numpy as np
+
+
+def polygonMask(vertices,xsize=None,ysize=None):
+    ''' Return (mask,(x0,y0)) for a polygon given as a list of (x,y) pixel vertices: 'mask' 
+        covers the bounding box of the polygon (clipped to xsize,ysize if given) and selects 
+        the pixels whose centres lie inside it (even-odd rule), and (x0,y0) is the pixel at 
+        mask[0,0].
+    '''
+    vertices = np.asarray(vertices,dtype=np.float64).reshape(-1,2)
+    if len(vertices) < 3:
+        raise ValueError("A polygon needs at least 3 vertices")
+    x0 = max(int(np.floor(vertices[:,0].min())),0)
+    y0 = max(int(np.floor(vertices[:,1].min())),0)
+    x1 = int(np.ceil(vertices[:,0].max()))
+    y1 = int(np.ceil(vertices[:,1].max()))
+    if xsize is not None:
+        x1 = min(x1,xsize-1)
+    if ysize is not None:
+        y1 = min(y1,ysize-1)
+    if x1 < x0 or y1 < y0:
+        return (np.zeros((0,0),dtype=bool),(x0,y0))
+    (y,x) = np.mgrid[y0:y1+1,x0:x1+1]
+    inside = np.zeros(x.shape,dtype=bool)
+    (xj,yj) = vertices[-1]
+    for (xi,yi) in vertices:
+        if yi != yj:
+            crosses = (yi > y) != (yj > y)
+            inside ^= crosses & (x < (xj - xi)*(y - yi)/(yj - yi) + xi)
+        (xj,yj) = (xi,yi)
+    return (inside,(x0,y0))
+
+
+def skyPolygonMask(hdr,ras,decs):
+    ''' As polygonMask(), for a polygon of (ra,dec) vertices in degrees, using the WCS of the header '''
+    header = hdr.getHeaderDict()
+    celestial = hdr.getWCS().celestial
+    (px,py) = celestial.wcs_world2pix(np.asarray(ras,dtype=np.float64),np.asarray(decs,dtype=np.float64),0)
+    if celestial.wcs.lng == 1:
+        (px,py) = (py,px)
+    return polygonMask(np.stack((px,py),axis=1),int(header["NAXIS1"]),int(header["NAXIS2"]))
+
+
+def rowRuns(mask):
+    ''' Return the runs of True pixels along the rows of a 3D (z,y,x) mask, as arrays 
+        (z,y,xstart,xend) with xend exclusive, in (z,y,x) order.
+    '''
+    mask = np.asarray(mask,dtype=bool)
+    padded = np.zeros(mask.shape[:2] + (mask.shape[2]+2,),dtype=np.int8)
+    padded[:,:,1:-1] = mask
+    edges = np.diff(padded,axis=2)
+    (zs,ys,xs) = np.nonzero(edges == 1)
+    (ze,ye,xe) = np.nonzero(edges == -1)
+    return (zs,ys,xs,xe)
@@ -1,36 +1,17 @@
 import os
+import io
 import sys
-import logging
 import time
-from time import perf_counter
-
-import threading
-import io
 import numpy as np
 
-import signal
-from builtins import TypeError
-from os import environ
-import calendar
-from _operator import pos
-import asyncio
-import multiprocessing as mp
-from posix import fdatasync
-
-import boto3
-from boto3.s3.transfer import TransferConfig
-import urllib.request
-
-path = os.path.abspath(os.path.dirname(__file__))
-if not path in sys.path:
-    sys.path.append(path)
-
 try:
     from ObjStore.ObjStore import *
     from ObjStore.FITSheader import *
+    from ObjStore.SpectralReplica import *
 except ModuleNotFoundError:
     from ObjStore import *
     from FITSheader import *
+    from SpectralReplica import *
 
 PID = os.getpid()
 
@@ -40,6 +21,8 @@ OS_AUTH_VER = '3'
 
 CHUNK16 = ONE_M * 16 # 16Mb
 CHUNK128 = ONE_M * 128 # 128Mb
+MIN_PART = ONE_M * 5 # Smallest multipart part (except the last)
+MAX_PART = ONE_G * 5 # Largest multipart part
 MAX_MEM = ONE_G * 4 # 4Gb for downloading file to memory
 
 
@@ -52,14 +35,16 @@ class S3Object(FitsObjStore):
         Inherits from ObjStore.FitsObjStore
     '''
     
-    def __init__(self,bucket,obj,access_key_id,secret_access,endpoint="https://nimbus.pawsey.org.au:8080"):
+    def __init__(self,bucket,obj,access_key_id,secret_access,endpoint="https://nimbus.pawsey.org.au:8080",project=None):
         FitsObjStore.__init__(self,mode='s3')
         self.endpoint = endpoint
+        self.project = project # objectstore project, for its rate limits (see RateLimiter)
         self.access =access_key_id # AWS access id number
         self.secret = secret_access # AWS secret key
         self.session = None
         self.client = None
         self.resource = None
+        import boto3 # only loaded for 's3' mode
         self.session = boto3.session.Session()
         self.client = self.__setClient()
         self.resource = self.__setResource()
@@ -68,6 +53,9 @@ class S3Object(FitsObjStore):
         self.threads = 20
         self.bucket = bucket
         self.obj = obj
+        limiter = getLimiter(endpoint,project)
+        if limiter:
+            self.setRateLimiter(limiter)
        
        
 ########################################################################################################################
@@ -109,51 +97,443 @@ class S3Object(FitsObjStore):
         except:
             pass 
         
-    def uploadFile(self,path,filename,ExtraArgs={"ContentType":"binary/octet-stream"},progress=True):
+    def uploadFile(self,path,filename,ExtraArgs={"ContentType":"binary/octet-stream"},progress=True,checksum=False):
         ''' Upload file to object store. If larger than 4G, this will 'chunk'
             the file into 'chunksize' bits and upload them in parallel.
+            With checksum=True the checksums are checked and stored once the file is uploaded 
+            (see loadChecksums); otherwise any checksums stored for an earlier upload are removed.
+            Known limitation: with checksum=True the file is read twice - once to checksum it,
+            then by upload_file, which reads each part from disk as it is sent. Checksumming 
+            in-line (uploadChecked) reads it once, but boto3 then holds up to 10 parts in
+            memory, as it does for any stream. 
             This will overwrite the original object!
         '''
+        from boto3.s3.transfer import TransferConfig
         print(f'path: {path}, filename: {filename}, objname: {self.obj}')
         config = TransferConfig(multipart_threshold=self.threshold, max_concurrency=self.threads, multipart_chunksize=self.chunksize, use_threads=True)
         myfile = path + '/' + filename
+        if checksum:
+            # A separate pass keeps upload_file, which reads each part from disk when it is sent
+            # (a stream would make boto3 hold the parts in flight in memory)
+            checksums = checksumFile(myfile,config.multipart_chunksize)
+            ExtraArgs = self.__checksumArgs(ExtraArgs,checksums)
+        else:
+            stale = self.hasChecksums()
         if progress:
             self.client.upload_file(myfile,self.bucket,self.obj,ExtraArgs=ExtraArgs,Config=config,Callback=ProgressPercentage(myfile))
         else:
             self.client.upload_file(myfile,self.bucket,self.obj,ExtraArgs=ExtraArgs,Config=config)
+        if checksum:
+            return self.__storeChecksums(checksums,config)
+        if stale:
+            self.dropChecksums()
+
+    def uploadHeader(self,hdr,key=None):
+        ''' Store the raw header of a FITS header object (eg FITSheaderFromFile) as a small
+            sidecar object (default key: this object's key + HEADER_SIDECAR_SUFFIX), so the
+            full header is available when only some keywords fit in the object metadata.
+        '''
+        key = key or self.obj + HEADER_SIDECAR_SUFFIX
+        self.client.put_object(Bucket=self.bucket,Key=key,Body=hdr.rawHdrData(),ContentType="text/plain",
+                               Metadata={"objstore-source":self.obj})
+        return key
+
+    def uploadStream(self,stream,ExtraArgs={"ContentType":"binary/octet-stream"},chunksize=CHUNK128,checksum=False):
+        ''' Upload a (non-seekable) file-like stream to the object, using multipart upload
+            with parts of 'chunksize' bytes. At most 'threads' parts are held in memory.
+            With checksum=True the stream is checksummed as it is uploaded (see uploadChecked);
+            otherwise any checksums stored for an earlier upload are removed.
+            This will overwrite the original object!
+        '''
+        from boto3.s3.transfer import TransferConfig
+        config = TransferConfig(multipart_threshold=chunksize, max_concurrency=self.threads, multipart_chunksize=chunksize, use_threads=True)
+        if checksum:
+            return self.uploadChecked(stream,ExtraArgs,config)
+        stale = self.hasChecksums()
+        self.client.upload_fileobj(stream,self.bucket,self.obj,ExtraArgs=ExtraArgs,Config=config)
+        if stale:
+            self.dropChecksums()
+
+    def uploadTiled(self,path,filename,tile=DEFAULT_TILE,codec=DEFAULT_CODEC,quantize=None,num_threads=1,chunksize=CHUNK128,checksum=False):
+        ''' Upload a local FITS cube in the tile-compressed layout (see TiledCube): tiles are
+            compressed on 'num_threads' threads as the file is read, and streamed through 
+            multipart upload. 'quantize' (eg 16) quantises to steps of noise/quantize (lossy);
+            None keeps the floats exactly. Cutouts of the object are then read with 
+            getPartitionData() as usual, fetching only the compressed tiles they need.
+            With checksum=True the tiled object is checksummed as it is uploaded.
+        '''
+        myfile = path + '/' + filename
+        (hdr,data) = localCube(myfile)
+        stream = TiledStream(data,hdr.rawHdrData(),tile,codec,quantize,num_threads)
+        extra = {"ContentType":"binary/octet-stream","Metadata":{"objstore-layout":TILED_LAYOUT}}
+        print(f"Uploading {myfile} as {self.obj} in {codec} compressed tiles of {tile}",flush=True)
+        self.uploadStream(io.BufferedReader(stream,buffer_size=chunksize),ExtraArgs=extra,chunksize=chunksize,checksum=checksum)
+        self.tileindex = stream.tiles
+        self.objsize = None
+        return stream.tiles
+
+    def uploadChecked(self,stream,ExtraArgs,config,callback=None):
+        ''' Upload a stream, computing block CRCs and part MD5s as the bytes are read (each is
+            read once). The composite MD5 is checked against the ETag of the stored object,
+            and the checksums are stored as a sidecar object (this object's key + CHECKSUM_SUFFIX)
+            for checking later reads - see FitsObjStore.loadChecksums().
+            Returns the ObjectChecksums of the object.
+        '''
+        checksum = StreamChecksum(config.multipart_chunksize)
+        reader = io.BufferedReader(ChecksumReader(stream,checksum),buffer_size=ONE_M*8)
+        self.client.upload_fileobj(reader,self.bucket,self.obj,ExtraArgs=self.__checksumArgs(ExtraArgs,checksum),Config=config,Callback=callback)
+        return self.__storeChecksums(checksum,config)
+
+    def __checksumArgs(self,ExtraArgs,checksum):
+        ''' Return the upload ExtraArgs with the checksum metadata entry added '''
+        extra = dict(ExtraArgs)
+        extra["Metadata"] = dict(extra.get("Metadata",{}))
+        extra["Metadata"][CHECKSUM_KEY] = "%s/%s" % (checksum.algorithm,checksum.blocksize)
+        return extra
+
+    def __storeChecksums(self,checksum,config):
+        ''' Check the StreamChecksum of an upload against the ETag of the stored object, and 
+            store its checksums as the sidecar object. Returns the ObjectChecksums.
+        '''
+        etag = self.client.head_object(Bucket=self.bucket,Key=self.obj)['ETag'].strip('"')
+        # Below the threshold the bytes are sent in one put - the ETag is then the MD5 of the whole.
+        # Above 10000 parts boto3 picks a larger part size, so the ETag cannot be compared.
+        comparable = (checksum.size >= config.multipart_threshold or checksum.size <= checksum.partsize) \
+                     and checksum.size <= checksum.partsize * 10000
+        if comparable and etag != checksum.md5():
+            raise ChecksumError("Object %s was stored with ETag %s, but the bytes sent give %s" % (self.obj,etag,checksum.md5()))
+        manifest = checksum.manifest()
+        self.client.put_object(Bucket=self.bucket,Key=self.obj+CHECKSUM_SUFFIX,Body=manifest,
+                               ContentType="binary/octet-stream",Metadata={"objstore-source":self.obj})
+        self.objsize = checksum.size
+        checksums = ObjectChecksums(manifest)
+        if self.checksums is not None:
+            self.checksums = checksums
+        return checksums
+
+    def storedChecksums(self,key=None):
+        ''' Return the ObjectChecksums stored for object 'key' (default: this object), or None '''
+        key = key or self.obj
+        try:
+            manifest = self.client.get_object(Bucket=self.bucket,Key=key+CHECKSUM_SUFFIX)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return ObjectChecksums(manifest)
+
+    def hasChecksums(self,key=None):
+        ''' Return True if object 'key' (default: this object) was stored with checksums - its
+            metadata names the checksum sidecar (see uploadChecked). False if it does not exist.
+        '''
+        key = key or self.obj
+        if key == self.obj and self.checksums is not None:
+            return True
+        try:
+            metadata = self.client.head_object(Bucket=self.bucket,Key=key).get('Metadata',{})
+        except self.client.exceptions.ClientError:
+            return False
+        return CHECKSUM_KEY in metadata
+
+    def dropChecksums(self,key=None):
+        ''' Remove the checksum sidecar of object 'key' (default: this object), after it has
+            been written without checksums - so later reads are not checked against a stale table.
+            A sidecar that cannot be removed (eg no delete permission) is reported, not raised.
+        '''
+        key = key or self.obj
+        if key == self.obj:
+            self.checksums = None
+        try:
+            self.client.delete_object(Bucket=self.bucket,Key=key+CHECKSUM_SUFFIX)
+        except self.client.exceptions.ClientError as e:
+            print(f"Could not remove the checksums of {key}: {e}",file=sys.stderr,flush=True)
+
+    def __refreshChecksums(self,checksums,changes,etag):
+        ''' Recompute the stored block checksums covering the changed (start,end) ranges of this 
+            object from its new contents, and store the table again.
+        '''
+        bs = checksums.blocksize
+        blocks = sorted(set([b for (start,end) in changes for b in range(start//bs,(end-1)//bs+1)]))
+        runs = []
+        for b in blocks:
+            if runs and runs[-1][1] == b and runs[-1][1] - runs[-1][0] < CHUNK128 // bs:
+                runs[-1][1] = b+1
+            else:
+                runs.append([b,b+1])
+        for (first,last) in runs:
+            (start,end) = (first*bs,min(last*bs,checksums.size))
+            # Read directly - readBytes() would check the bytes against the old table
+            data = self.client.get_object(Bucket=self.bucket,Key=self.obj,Range="bytes=%s-%s" % (start,end-1))['Body'].read()
+            checksums.updateBlocks(start,data)
+        # The object was rebuilt from different parts, so record its new ETag
+        (checksums.md5,checksums.partsize) = (etag.strip('"'),None)
+        self.client.put_object(Bucket=self.bucket,Key=self.obj+CHECKSUM_SUFFIX,Body=checksums.manifest(),
+                               ContentType="binary/octet-stream",Metadata={"objstore-source":self.obj})
+        if self.checksums is not None:
+            self.checksums = checksums
+
+    def buildSpectralReplica(self,hdr,key=None,max_memory=ONE_G,num_threads=1,chunksize=CHUNK128):
+        ''' Build a spectral-major replica of this cube (see SpectralReplica) in the same bucket,
+            as object 'key' (default: this object's key + REPLICA_SUFFIX). The cube is read in 
+            bands of rows that fit in 'max_memory', transposed and streamed through multipart upload.
+            Returns the S3Object of the replica.
+        '''
+        key = key or self.obj + REPLICA_SUFFIX
+        replica = S3Object(self.bucket,key,self.access,self.secret,self.endpoint,self.project)
+        replica.setConfig(chunksize,chunksize,self.threads)
+        stream = TransposedStream(self,hdr,max_memory,num_threads)
+        extra = {"ContentType":"binary/octet-stream","Metadata":{"objstore-layout":REPLICA_LAYOUT,"objstore-source":self.obj}}
+        print(f"Building spectral-major replica {key} in bands of {stream.band} rows",flush=True)
+        replica.uploadStream(io.BufferedReader(stream,buffer_size=chunksize),ExtraArgs=extra,chunksize=chunksize)
+        return replica
+
+    def attachSpectralReplica(self,key=None):
+        ''' Look for a spectral-major replica of this cube (default key: this object's key + 
+            REPLICA_SUFFIX) and, if found, use it for spectrum requests (see setSpectralReplica).
+            Returns True if a replica was attached.
+        '''
+        key = key or self.obj + REPLICA_SUFFIX
+        try:
+            meta = self.client.head_object(Bucket = self.bucket, Key = key)['Metadata']
+        except self.client.exceptions.ClientError:
+            return False
+        if meta.get("objstore-layout") != REPLICA_LAYOUT:
+            return False
+        replica = S3Object(self.bucket,key,self.access,self.secret,self.endpoint,self.project)
+        replica_hdr = FITSheaderFromS3(self.endpoint,self.bucket,key,self.access,self.secret,self.project)
+        self.setSpectralReplica(replica,replica_hdr)
+        return True
+
+    def splitCopyRange(self,start,end,chunksize=None):
+        ''' Split bytes start..end-1 into (start,length) parts of about 'chunksize' bytes that
+            are all within the multipart limits (MIN_PART - MAX_PART) - parts are made equal 
+            in size, so none is left below MIN_PART unless the whole range is.
+        '''
+        chunksize = min(max(chunksize or self.chunksize,2*MIN_PART),MAX_PART)
+        total = end - start
+        if total <= 0:
+            return []
+        nparts = -(-total // chunksize)
+        size = -(-total // nparts)
+        return [(pos,min(size,end-pos)) for pos in range(start,end,size)]
+
+    def __uploadPart(self,key,upload_id,number,part,copy_source):
+        if part[0] == 'copy':
+            source_range = "bytes=%s-%s" % (part[1],part[1]+part[2]-1)
+            response = self.client.upload_part_copy(Bucket=self.bucket,Key=key,UploadId=upload_id,PartNumber=number,CopySource=copy_source,CopySourceRange=source_range)
+            return {'ETag':response['CopyPartResult']['ETag'],'PartNumber':number}
+        response = self.client.upload_part(Bucket=self.bucket,Key=key,UploadId=upload_id,PartNumber=number,Body=part[1])
+        return {'ETag':response['ETag'],'PartNumber':number}
+
+    def composeObject(self,key,parts,ExtraArgs={"ContentType":"binary/octet-stream"},num_threads=None,version=None):
+        ''' Build object 'key' in this bucket with a multipart upload, from a list of parts:
+                ('data',bytes)           - uploaded from the client
+                ('copy',start,length)    - copied server-side (UploadPartCopy) from this object,
+                                           or from 'version' of it if given
+            Parts are sent in parallel. All parts but the last must be at least MIN_PART bytes.
+            Any checksums stored for 'key' are removed (see dropChecksums), unless the ExtraArgs
+            metadata names them - the caller then updates the sidecar (see updateRanges).
+            Returns the complete_multipart_upload response.
+        '''
+        for part in parts[:-1]:
+            size = len(part[1]) if part[0] == 'data' else part[2]
+            if size < MIN_PART:
+                raise ValueError("Multipart part of %s bytes is below the %s byte minimum" % (size,MIN_PART))
+        copy_source = {'Bucket':self.bucket,'Key':self.obj}
+        if version:
+            copy_source['VersionId'] = version
+        stale = CHECKSUM_KEY not in ExtraArgs.get("Metadata",{}) and self.hasChecksums(key)
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket,Key=key,**ExtraArgs)['UploadId']
+        num_threads = num_threads or self.threads
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=max(1,min(num_threads,len(parts))))
+        try:
+            result_objs = [pool.apply_async(self.__uploadPart,(key,upload_id,n+1,part,copy_source)) for (n,part) in enumerate(parts)]
+            completed = [result.get() for result in result_objs]
+            response = self.client.complete_multipart_upload(Bucket=self.bucket,Key=key,UploadId=upload_id,MultipartUpload={'Parts':completed})
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket,Key=key,UploadId=upload_id)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        if stale:
+            self.dropChecksums(key)
+        return response
+
+    def copyChannelSlab(self,key,zmin,zmax,hdr,num_threads=None,ExtraArgs={"ContentType":"binary/octet-stream"}):
+        ''' Create object 'key' in this bucket holding channels zmin..zmax of this cube as a FITS
+            file. The new header and the first few Mb of data are uploaded; the rest of the 
+            channel range is copied server-side with UploadPartCopy, so very little data passes 
+            through the client. Returns the S3Object of the new cube.
+        '''
+        from astropy.io import fits
+        header = hdr.getHeaderDict()
+        naxis = int(header["NAXIS"])
+        zaxis = 3 if naxis == 3 else 4
+        zsize = int(header["NAXIS%s" % zaxis])
+        if zmin < 0 or zmax >= zsize or zmin > zmax:
+            raise ValueError("Channels %s - %s not within the datacube (0 - %s)" % (zmin,zmax,zsize-1))
+        chbytes = int(header["NAXIS1"])*int(header["NAXIS2"])*FITS_FLOAT_SIZE
+        if naxis > 3:
+            chbytes *= int(header["NAXIS3"])
+
+        newhdr = fits.Header.fromstring(hdr.rawHdrData().decode())
+        newhdr["NAXIS%s" % zaxis] = zmax-zmin+1
+        if "CRPIX%s" % zaxis in newhdr:
+            newhdr["CRPIX%s" % zaxis] = newhdr["CRPIX%s" % zaxis] - zmin
+        newhdr = newhdr.tostring().encode()
+
+        start = hdr.len() + zmin*chbytes
+        end = hdr.len() + (zmax+1)*chbytes
+        padding = b'\0' * ((-(end-start)) % FITS_HEADER_BLOCK_SIZE)
+        if end - start < 2*MIN_PART:
+            # Small slab - just upload it
+            parts = [('data',newhdr + self.readBytes(start,end-start) + padding)]
+        else:
+            # The first part must reach MIN_PART, so carries the start of the data with the header
+            # (a header of MIN_PART or more is a part on its own - an empty range read would
+            # be ignored by the objectstore, returning the whole object)
+            first = MIN_PART - len(newhdr) if len(newhdr) < MIN_PART else 0
+            parts = [('data',newhdr + self.readBytes(start,first) if first else newhdr)]
+            parts += [('copy',pos,length) for (pos,length) in self.splitCopyRange(start+first,end)]
+            if padding:
+                parts.append(('data',padding))
+        print(f"Creating {key} from channels {zmin} - {zmax}: {len(parts)} parts, {end-start} data bytes",flush=True)
+        self.composeObject(key,parts,ExtraArgs,num_threads)
+        return S3Object(self.bucket,key,self.access,self.secret,self.endpoint,self.project)
+
+    def __planUpdate(self,size,changes):
+        ''' Plan the parts of an updated object of 'size' bytes, given sorted, non-overlapping 
+            (start,end) changed ranges. Returns a list of ('copy'|'data',start,end) segments, 
+            where unchanged bytes next to small changes are moved into 'data' segments so that 
+            every segment but the last is at least MIN_PART bytes.
+        '''
+        segments = []
+        pos = 0
+        for (start,end) in changes:
+            if start > pos:
+                segments.append(['copy',pos,start])
+            segments.append(['data',start,end])
+            pos = end
+        if pos < size:
+            segments.append(['copy',pos,size])
+
+        def merge(segments):
+            merged = []
+            for seg in segments:
+                if merged and merged[-1][0] == seg[0]:
+                    merged[-1][2] = seg[2]
+                elif seg[2] > seg[1]:
+                    merged.append(seg)
+            return merged
+
+        # Unchanged gaps too small to copy are downloaded instead
+        for seg in segments[:-1]:
+            if seg[0] == 'copy' and seg[2]-seg[1] < MIN_PART:
+                seg[0] = 'data'
+        segments = merge(segments)
+        # Grow small data segments into the following unchanged bytes
+        i = 0
+        while i < len(segments) - 1:
+            seg = segments[i]
+            if seg[0] == 'data' and seg[2]-seg[1] < MIN_PART:
+                following = segments[i+1]
+                needed = MIN_PART - (seg[2]-seg[1])
+                if following[2]-following[1]-needed >= MIN_PART or i+1 == len(segments)-1:
+                    seg[2] = following[1] = min(following[1]+needed,following[2])
+                else:
+                    following[0] = 'data'
+                segments = merge(segments)
+                continue
+            i += 1
+        return [tuple(seg) for seg in segments]
+
+    def updateRanges(self,replacements,num_threads=None,ExtraArgs=None):
+        ''' Replace byte ranges of this object without uploading it again. 'replacements' is a
+            list of (offset,bytes) pairs, which must not overlap or run past the end of the object.
+            A new version of the object is built by multipart upload: unchanged regions are 
+            copied server-side (UploadPartCopy) from the current version, and only the changed 
+            regions (plus any unchanged bytes needed to reach the 5Mb part minimum) are uploaded.
+            With versioning enabled on the bucket (setVersioning()), the previous version is kept.
+            If the object has stored checksums, those of the changed blocks are recomputed.
+            Returns the VersionId of the new object (None if versioning is not enabled).
+        '''
+        head = self.client.head_object(Bucket = self.bucket, Key = self.obj)
+        size = int(head['ContentLength'])
+        version = head.get('VersionId')
+        if version == 'null':
+            version = None
+        if ExtraArgs is None:
+            ExtraArgs = {"ContentType":head.get("ContentType","binary/octet-stream"),"Metadata":head.get("Metadata",{})}
+
+        replacements = sorted([(int(offset),memoryview(data).cast('B')) for (offset,data) in replacements],key=lambda r: r[0])
+        changes = []
+        for (offset,data) in replacements:
+            if offset < 0 or offset + len(data) > size:
+                raise ValueError("Replacement at %s of %s bytes is outside the object (%s bytes)" % (offset,len(data),size))
+            if changes and offset < changes[-1][1]:
+                raise ValueError("Replacement at %s overlaps the previous one" % offset)
+            changes.append((offset,offset+len(data)))
+
+        parts = []
+        for (kind,start,end) in self.__planUpdate(size,[c for c in changes if c[1] > c[0]]):
+            if kind == 'copy':
+                parts += [('copy',pos,length) for (pos,length) in self.splitCopyRange(start,end)]
+                continue
+            # Build the data part: original bytes overlaid with the replacements
+            buf = bytearray(end-start)
+            pos = start
+            for (offset,data) in replacements:
+                if offset + len(data) <= start or offset >= end:
+                    continue
+                if offset > pos:
+                    buf[pos-start:offset-start] = self.readBytes(pos,offset-pos)
+                lo = max(offset,start)
+                hi = min(offset+len(data),end)
+                buf[lo-start:hi-start] = data[lo-offset:hi-offset]
+                pos = hi
+            if pos < end:
+                buf[pos-start:] = self.readBytes(pos,end-pos)
+            parts.append(('data',bytes(buf)))
+
+        uploaded = sum([len(p[1]) for p in parts if p[0] == 'data'])
+        print(f"Updating {self.obj}: {len(parts)} parts, {uploaded} bytes uploaded, {size-uploaded} bytes copied",flush=True)
+        checksums = self.storedChecksums()
+        if checksums is not None:
+            # keep naming the sidecar, which is updated below rather than removed
+            ExtraArgs = dict(ExtraArgs,Metadata=dict(ExtraArgs.get("Metadata",{}),**{CHECKSUM_KEY:"%s/%s" % (CHECKSUM_ALGORITHM,checksums.blocksize)}))
+        elif CHECKSUM_KEY in ExtraArgs.get("Metadata",{}):
+            ExtraArgs = dict(ExtraArgs,Metadata=dict([(k,v) for (k,v) in ExtraArgs["Metadata"].items() if k != CHECKSUM_KEY]))
+        response = self.composeObject(self.obj,parts,ExtraArgs,num_threads,version)
+        if checksums is not None:
+            self.__refreshChecksums(checksums,changes,response['ETag'])
+        self.objsize = None
+        return response.get('VersionId')
+
+    def updateChannels(self,channels,hdr,num_threads=None):
+        ''' Replace channels of this cube without uploading it again (see updateRanges()).
+            'channels' is a list of (zstart,data) pairs, where data holds one or more whole 
+            channels starting at channel zstart, eg [(120,fixed[0:3])] replaces channels 120-122.
+            Returns the VersionId of the new object.
+        '''
+        header = hdr.getHeaderDict()
+        chsize = int(header["NAXIS1"])*int(header["NAXIS2"])
+        zsize = int(header["NAXIS3"]) if int(header["NAXIS"]) == 3 else int(header["NAXIS4"])
+        replacements = []
+        for (zstart,data) in channels:
+            data = np.ascontiguousarray(data,dtype='>f4').ravel()
+            if data.size % chsize != 0:
+                raise ValueError("Data for channel %s is not a whole number of %s pixel channels" % (zstart,chsize))
+            if zstart < 0 or zstart + data.size//chsize > zsize:
+                raise ValueError("Channels %s - %s not within the datacube (0 - %s)" % (zstart,zstart+data.size//chsize-1,zsize-1))
+            replacements.append((hdr.len() + zstart*chsize*FITS_FLOAT_SIZE,data))
+        return self.updateRanges(replacements,num_threads)
 
     def getObject(self):
         ''' Return the object (or a part of it in bytes) to caller '''
         tobj = self.readWholeObject()
         return tobj
  
-    def rewind(self,indx=-1):
-        ''' Set the object position indx. '''
-        self.__last_byte_pos = indx
-        
-    def getReadPosition(self):
-        ''' Return the object position indx '''
-        return self.__last_byte_pos
-        
-    def getBytesFromLastPos(self,len):
-        """ Similar to a sequential 'read' - get len bytes starting from 
-            immediately after the last byte read.
-        """
-       
-        return self.readData(self.__last_byte_pos+1,len) 
-       
-    def stats(self):
-        """ Stats on how much has been read or written to the object. """
-        
-        print()
-        print("************************")
-        print("Number of bytes read: ",self.__read_bytes)
-        print("Number of bytes written: ",self.__write_bytes)
-        print("Last byte pos read/written: ",self.__last_byte_pos)
-        print("************************")
 
-   
-      
 ########################################################################################################################
 ######################### END OsS3Object ###############################################################################
 ########################################################################################################################
@@ -178,10 +558,10 @@ if __name__ == "__main__":
 
 
     # Create a header object from objectstore data
-    hdr = FITSheaderFromS3(endpoint,bucket,key,ja3_access_id,ja3_secret_id)
+    hdr = FITSheaderFromS3(endpoint,bucket,key,ja3_access_id,ja3_secret_id,project)
 
     # Create an S3Object for access to acacia:
-    obj = S3Object(bucket,key,ja3_access_id,ja3_secret_id,endpoint)
+    obj = S3Object(bucket,key,ja3_access_id,ja3_secret_id,endpoint,project)
 
     if LOADFILE:
         # Upload a test datacube (851Gb) with default chunk size = 2Gb:
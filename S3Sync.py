@@ -0,0 +1,236 @@
+''' Sync a local directory tree to a bucket in an objectstore.
+
+    The bucket listing is split by key prefix and read in parallel, then compared with the
+    local tree: files that are new, or whose size or modification time differ (or, with
+    checksum=True, whose MD5/ETag differs) are uploaded. One boto3 client and one pool of
+    worker threads are shared by all files - small files are uploaded concurrently with a
+    single put each, large ones through multipart upload. FITS files carry their header
+    keywords as object metadata (as many as fit), and their full header as a sidecar object.
+'''
+import os
+import sys
+import time
+import hashlib
+
+try:
+    from ObjStore.FITSheader import *
+    from ObjStore.RateLimiter import getLimiter
+    from ObjStore.Checksums import CHECKSUM_SUFFIX
+    from ObjStore.SpectralReplica import REPLICA_SUFFIX
+    from ObjStore.TiledCube import TILED_SUFFIX
+except ModuleNotFoundError:
+    from FITSheader import *
+    from RateLimiter import getLimiter
+    from Checksums import CHECKSUM_SUFFIX
+    from SpectralReplica import REPLICA_SUFFIX
+    from TiledCube import TILED_SUFFIX
+
+ONE_M = 1024 ** 2
+SYNC_PARTSIZE = ONE_M * 64 # files larger than this use multipart upload, in parts of this size
+MTIME_KEY = 'objstore-mtime'
+FITS_SUFFIXES = ('.fits','.fit','.fts')
+
+
+def fileETag(path,partsize=SYNC_PARTSIZE):
+    ''' Return the ETag the objectstore gives a file uploaded in parts of 'partsize' bytes: the
+        MD5 of the file if it fits in one part, else the MD5 of the part MD5s + '-<no. of parts>'.
+    '''
+    digests = []
+    with open(path,'rb') as f:
+        while True:
+            data = f.read(partsize)
+            if not data:
+                break
+            digests.append(hashlib.md5(data).digest())
+    if len(digests) <= 1:
+        return digests[0].hex() if digests else hashlib.md5(b'').hexdigest()
+    return "%s-%s" % (hashlib.md5(b''.join(digests)).hexdigest(),len(digests))
+
+
+def derivedKeys(key):
+    ''' Return the keys of the objects stored alongside object 'key': its checksum and header
+        sidecars, and its spectral-major replica and tiled copy (with their own sidecars).
+    '''
+    keys = [key + CHECKSUM_SUFFIX,key + HEADER_SIDECAR_SUFFIX]
+    for derived in (key + REPLICA_SUFFIX,key + TILED_SUFFIX):
+        keys += [derived,derived + CHECKSUM_SUFFIX,derived + HEADER_SIDECAR_SUFFIX]
+    return keys
+
+
+def __listPrefix(client,bucket,prefix,delimiter=None):
+    ''' List the keys under a prefix. Returns ({key: (size,etag,mtime)},[common prefixes]) '''
+    paginator = client.get_paginator('list_objects_v2')
+    args = {"Bucket":bucket,"Prefix":prefix}
+    if delimiter:
+        args["Delimiter"] = delimiter
+    objects = {}
+    prefixes = []
+    for page in paginator.paginate(**args):
+        for item in page.get('Contents',[]):
+            objects[item['Key']] = (item['Size'],item['ETag'].strip('"'),item['LastModified'].timestamp())
+        prefixes += [p['Prefix'] for p in page.get('CommonPrefixes',[])]
+    return (objects,prefixes)
+
+
+def listObjects(client,bucket,prefix="",num_threads=8):
+    ''' Return {key: (size,etag,last modified)} for all objects under 'prefix'. The top level
+        of the prefix is listed first, then each 'subdirectory' below it is listed in parallel.
+    '''
+    (objects,prefixes) = __listPrefix(client,bucket,prefix,delimiter='/')
+    if prefixes:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=max(1,min(num_threads,len(prefixes))))
+        for (subobjects,subprefixes) in pool.starmap(__listPrefix,[(client,bucket,p) for p in prefixes]):
+            objects.update(subobjects)
+        pool.close()
+        pool.join()
+    return objects
+
+
+########################################################################################
+############################### CLASS DirectorySync ####################################
+########################################################################################
+class DirectorySync:
+    ''' Sync local directories to keys under a prefix in one bucket, with 'num_threads' workers '''
+
+    def __init__(self,bucket,access_key_id,secret_access,endpoint="https://nimbus.pawsey.org.au:8080",num_threads=8,project=None):
+        import boto3
+        from botocore.config import Config
+        self.bucket = bucket
+        self.endpoint = endpoint
+        self.num_threads = num_threads
+        self.partsize = SYNC_PARTSIZE
+        self.keywords = None # FITS keywords to store as metadata (all that fit if None)
+        self.concurrency = num_threads # threads for each multipart upload (set by sync for its workers)
+        # Enough connections for every worker, plus the multipart uploads within them
+        config = Config(max_pool_connections=max(10,2*num_threads))
+        self.client = boto3.session.Session().client(service_name='s3',aws_access_key_id=access_key_id,
+                                                     aws_secret_access_key=secret_access,endpoint_url=endpoint,config=config)
+        limiter = getLimiter(endpoint,project)
+        if limiter:
+            limiter.attach(self.client)
+
+    def listBucket(self,prefix=""):
+        ''' Return {key: (size,etag,last modified)} for all objects under 'prefix' (see listObjects) '''
+        return listObjects(self.client,self.bucket,prefix,self.num_threads)
+
+    def scanDirectory(self,localpath):
+        ''' Return {relative path: (size,mtime)} for all files below 'localpath' '''
+        files = {}
+        for (root,dirs,filenames) in os.walk(localpath):
+            dirs.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(root,filename)
+                if not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                files[os.path.relpath(path,localpath).replace(os.sep,'/')] = (stat.st_size,stat.st_mtime)
+        return files
+
+    def plan(self,localpath,prefix="",checksum=False):
+        ''' Compare the local tree with the bucket. Returns (uploads,unchanged,extra) where
+            uploads is a list of (relative path,key) to upload, unchanged a list of keys that
+            are up to date and extra a list of keys with no local file. Objects stored alongside
+            a local file's object (see derivedKeys) are never extra.
+        '''
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        local = self.scanDirectory(localpath)
+        remote = self.listBucket(prefix)
+        uploads = []
+        unchanged = []
+        for (relpath,(size,mtime)) in local.items():
+            key = prefix + relpath
+            if key not in remote or remote[key][0] != size:
+                uploads.append((relpath,key))
+            elif checksum:
+                if fileETag(os.path.join(localpath,relpath),self.partsize) != remote[key][1]:
+                    uploads.append((relpath,key))
+                else:
+                    unchanged.append(key)
+            elif remote[key][2] < mtime:
+                # Same size, but modified since it was uploaded - check the recorded mtime
+                metadata = self.client.head_object(Bucket=self.bucket,Key=key).get('Metadata',{})
+                if metadata.get(MTIME_KEY) == repr(mtime):
+                    unchanged.append(key)
+                else:
+                    uploads.append((relpath,key))
+            else:
+                unchanged.append(key)
+        keys = set([prefix + relpath for relpath in local])
+        keys.update([derived for key in list(keys) for derived in derivedKeys(key)])
+        extra = sorted([key for key in remote if key not in keys])
+        return (uploads,unchanged,extra)
+
+    def __uploadFile(self,path,key,fitsheaders):
+        ''' Upload one file - small files in a single put, large ones with multipart upload '''
+        stat = os.stat(path)
+        metadata = {}
+        if fitsheaders and path.lower().endswith(FITS_SUFFIXES):
+            hdr = FITSheaderFromFile(path)
+            if hdr.len():
+                metadata.update(hdr.convert2dict(keywords=self.keywords,limit=METADATA_LIMIT-256).get("Metadata",{}))
+                self.client.put_object(Bucket=self.bucket,Key=key+HEADER_SIDECAR_SUFFIX,Body=hdr.rawHdrData(),
+                                       ContentType="text/plain",Metadata={"objstore-source":key})
+        metadata[MTIME_KEY] = repr(stat.st_mtime)
+        extra = {"ContentType":"binary/octet-stream","Metadata":metadata}
+        if stat.st_size <= self.partsize:
+            with open(path,'rb') as f:
+                self.client.put_object(Bucket=self.bucket,Key=key,Body=f,**extra)
+        else:
+            from boto3.s3.transfer import TransferConfig
+            config = TransferConfig(multipart_threshold=self.partsize,multipart_chunksize=self.partsize,
+                                    max_concurrency=self.concurrency,use_threads=True)
+            self.client.upload_file(path,self.bucket,key,ExtraArgs=extra,Config=config)
+        return stat.st_size
+
+    def sync(self,localpath,prefix="",checksum=False,delete=False,fitsheaders=True,dryrun=False):
+        ''' Upload new and changed files below 'localpath' to keys under 'prefix'. With
+            delete=True, objects under the prefix with no local file are removed.
+            Returns a dict summarising what was (or, with dryrun=True, would be) done.
+        '''
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        start = time.time()
+        (uploads,unchanged,extra) = self.plan(localpath,prefix,checksum)
+        summary = {"uploaded":[key for (relpath,key) in uploads],"unchanged":len(unchanged),
+                   "deleted":extra if delete else [],"bytes":0,"failed":{}}
+        print(f"{len(uploads)} files to upload, {len(unchanged)} unchanged, {len(extra)} not in {localpath}",flush=True)
+        if dryrun:
+            return summary
+
+        if uploads:
+            from multiprocessing.pool import ThreadPool
+            workers = max(1,min(self.num_threads,len(uploads)))
+            pool = ThreadPool(processes=workers)
+            # Share the threads among the files being uploaded at once, so that multipart 
+            # uploads in every worker still use num_threads threads in all (not num_threads**2)
+            self.concurrency = max(1,self.num_threads // workers)
+            # Largest first, so the multipart uploads overlap the many small puts
+            uploads.sort(key=lambda u: -os.path.getsize(os.path.join(localpath,u[0])))
+            result_objs = [(key,pool.apply_async(self.__uploadFile,(os.path.join(localpath,relpath),key,fitsheaders))) for (relpath,key) in uploads]
+            for (key,result) in result_objs:
+                try:
+                    summary["bytes"] += result.get()
+                except Exception as e:
+                    summary["failed"][key] = "%s: %s" % (type(e).__name__,e)
+                    print(f"Upload of {key} failed: {e}",file=sys.stderr,flush=True)
+            pool.close()
+            pool.join()
+            summary["uploaded"] = [key for key in summary["uploaded"] if key not in summary["failed"]]
+            # Checksums stored for the old contents of replaced objects no longer apply
+            stale = [key + CHECKSUM_SUFFIX for key in summary["uploaded"]]
+            for i in range(0,len(stale),1000):
+                self.client.delete_objects(Bucket=self.bucket,Delete={"Objects":[{"Key":key} for key in stale[i:i+1000]],"Quiet":True})
+
+        if delete:
+            for i in range(0,len(extra),1000):
+                self.client.delete_objects(Bucket=self.bucket,Delete={"Objects":[{"Key":key} for key in extra[i:i+1000]],"Quiet":True})
+        elapsed = time.time() - start
+        print(f"Uploaded {len(summary['uploaded'])} files ({summary['bytes']} bytes) in {elapsed:.1f}s",flush=True)
+        return summary
+
+
+def syncDirectory(localpath,bucket,prefix,access_key_id,secret_access,endpoint="https://nimbus.pawsey.org.au:8080",num_threads=8,project=None,**kwargs):
+    ''' Sync 'localpath' to 'prefix' in 'bucket' - see DirectorySync.sync() for the options '''
+    return DirectorySync(bucket,access_key_id,secret_access,endpoint,num_threads,project).sync(localpath,prefix,**kwargs)
@@ -0,0 +1,126 @@
+''' Spectral-major (transposed) replica of a FITS datacube held in an objectstore.
+
+    The replica is a FITS file with the spectral axis first - NAXIS1 = channels,
+    NAXIS2 = x and NAXIS3 = y - so the spectrum at any (x,y) is one contiguous range
+    of bytes. It is built by reading bands of rows of the original cube, transposing
+    them and streaming the result through the S3 multipart upload, so memory use is
+    bounded by 'max_memory' and the whole cube is never held in RAM.
+'''
+import io
+import numpy as np
+
+try:
+    from ObjStore.FITSheader import *
+except ModuleNotFoundError:
+    from FITSheader import *
+
+REPLICA_SUFFIX = '.specmajor.fits'
+REPLICA_LAYOUT = 'spectral-major'
+
+ONE_G = 1024 ** 3
+
+
+def replicaHeader(raw,spectral_axis=3):
+    ''' Return the raw header of the replica, given the raw header of the original cube.
+        The axes are reordered (spectral,x,y) and per-axis WCS keywords follow them.
+    '''
+    from astropy.io import fits
+    header = fits.Header.fromstring(raw.decode())
+    naxis = int(header["NAXIS"])
+    # new axis n <- old axis order[n-1]
+    order = [spectral_axis,1,2] + [n for n in range(3,naxis+1) if n != spectral_axis]
+    newaxis = dict([(old,new+1) for (new,old) in enumerate(order)])
+    perkey = ('NAXIS','CTYPE','CRVAL','CDELT','CRPIX','CUNIT','CROTA','CNAME','CRDER','CSYER')
+    old = header.copy()
+    for n in range(1,naxis+1):
+        for key in perkey:
+            if "%s%s" % (key,n) in header:
+                del header["%s%s" % (key,n)]
+    for n in range(1,naxis+1):
+        for key in perkey:
+            if "%s%s" % (key,n) in old:
+                header["%s%s" % (key,newaxis[n])] = old["%s%s" % (key,n)]
+    for prefix in ('PC','CD'):
+        cards = [(i,j) for i in range(1,naxis+1) for j in range(1,naxis+1) if "%s%s_%s" % (prefix,i,j) in old]
+        for (i,j) in cards:
+            del header["%s%s_%s" % (prefix,i,j)]
+        for (i,j) in cards:
+            header["%s%s_%s" % (prefix,newaxis[i],newaxis[j])] = old["%s%s_%s" % (prefix,i,j)]
+    header["OSLAYOUT"] = (REPLICA_LAYOUT,'ObjStore spectral-major replica')
+    return header.tostring().encode()
+
+
+########################################################################################
+############################### CLASS TransposedStream #################################
+########################################################################################
+class TransposedStream(io.RawIOBase):
+    ''' Read-only stream of the replica FITS file (header, transposed data and padding),
+        generated band by band from the original cube.
+    '''
+
+    def __init__(self,obj,hdr,max_memory=ONE_G,num_threads=1):
+        io.RawIOBase.__init__(self)
+        self.obj = obj
+        self.hdr = hdr
+        self.num_threads = num_threads
+        header = hdr.getHeaderDict()
+        self.xsize = int(header["NAXIS1"])
+        self.ysize = int(header["NAXIS2"])
+        if int(header["NAXIS"]) == 3:
+            self.zsize = int(header["NAXIS3"])
+        else:
+            self.zsize = int(header["NAXIS4"])
+        self.spectral_axis = 3 if int(header["NAXIS"]) == 3 else 4
+        # Rows per band - the band is held twice (as read and transposed)
+        rowbytes = self.xsize*self.zsize*FITS_FLOAT_SIZE
+        self.band = int(max(1,min(self.ysize,max_memory // (2*rowbytes))))
+        databytes = self.xsize*self.ysize*self.zsize*FITS_FLOAT_SIZE
+        self.padding = (-databytes) % FITS_HEADER_BLOCK_SIZE
+        self.__buffer = memoryview(replicaHeader(hdr.rawHdrData(),self.spectral_axis))
+        self.__pos = 0
+        self.__next_row = 0
+        self.__done = False
+
+    def readable(self):
+        return True
+
+    def __nextBuffer(self):
+        if self.__next_row >= self.ysize:
+            self.__buffer = memoryview(b'\0' * self.padding)
+            self.__done = True
+        else:
+            ymin = self.__next_row
+            ymax = min(ymin + self.band,self.ysize) - 1
+            print("Transposing rows %s - %s of %s" % (ymin,ymax,self.ysize),flush=True)
+            data = self.obj.getPartitionDataBatch([(0,self.xsize-1,ymin,ymax,0,self.zsize-1)],self.hdr,self.num_threads)[0]
+            # (z,y,x) -> (y,x,z)
+            self.__buffer = memoryview(np.ascontiguousarray(data.transpose(1,2,0))).cast('B')
+            self.__next_row = ymax + 1
+        self.__pos = 0
+
+    def readinto(self,b):
+        mv = memoryview(b).cast('B')
+        while self.__pos >= len(self.__buffer):
+            if self.__done:
+                return 0
+            self.__nextBuffer()
+        n = min(len(mv),len(self.__buffer) - self.__pos)
+        mv[:n] = self.__buffer[self.__pos:self.__pos+n]
+        self.__pos += n
+        return n
+
+
+def replicaSpectrumRanges(positions,header,hdrsize,zmin,zmax):
+    ''' Return the (start,length) byte range of the spectrum (channels zmin..zmax) at each
+        (x,y) position, in a replica with the given header dict.
+    '''
+    nchan = int(header["NAXIS1"])
+    xsize = int(header["NAXIS2"])
+    ysize = int(header["NAXIS3"])
+    ranges = []
+    for (x,y) in positions:
+        if x < 0 or y < 0 or x >= xsize or y >= ysize:
+            raise ValueError("Position %s not within the %s x %s channel" % ((x,y),xsize,ysize))
+        start = hdrsize + ((int(y)*xsize + int(x))*nchan + zmin)*FITS_FLOAT_SIZE
+        ranges.append((start,(zmax-zmin+1)*FITS_FLOAT_SIZE))
+    return ranges
@@ -0,0 +1,233 @@
+''' Tile-compressed layout of a FITS datacube held in an objectstore.
+
+    The cube is cut into tiles of (z,y,x) = 'tile' pixels, and each tile is compressed on its
+    own: the big-endian floats are (optionally) quantised to integers, byte-shuffled so the
+    bytes of equal significance lie together, and compressed with zstd (if the 'zstandard'
+    package is installed) or zlib. The object holds:
+
+        the original FITS header, with OSLAYOUT = 'tiled' and the tiling keywords added
+        the compressed tiles, in (z,y,x) tile order
+        the tile index - TILE_DTYPE entries (offset, length, scale, zero) per tile
+        a TRAILER_SIZE byte trailer giving the offset and length of the index
+
+    A cutout reads only the compressed tiles it overlaps (see FitsObjStore.getTiledPartitionData),
+    which are decompressed in parallel - so far fewer bytes cross the network for noisy cubes.
+    Quantisation (quantize=q) is lossy: values are rounded to steps of (noise / q), where the
+    noise is estimated per tile, like the FITS tile-compression convention.
+'''
+import io
+import zlib
+import struct
+
+import numpy as np
+
+try:
+    from ObjStore.FITSheader import *
+except ModuleNotFoundError:
+    from FITSheader import *
+
+try:
+    import zstandard
+    DEFAULT_CODEC = 'zstd'
+except ModuleNotFoundError:
+    zstandard = None
+    DEFAULT_CODEC = 'zlib'
+
+TILED_LAYOUT = 'tiled'
+TILED_SUFFIX = '.tiled.fits'
+DEFAULT_TILE = (8,128,128) # (z,y,x) pixels per tile - 512Kb of floats
+TILE_DTYPE = np.dtype([('offset','>i8'),('length','>i8'),('scale','>f8'),('zero','>f8')])
+TRAILER_MAGIC = b'OSTILEIX'
+TRAILER_SIZE = 32 # magic, index offset, index length, number of tiles
+NULL_VALUE = -2147483647 # quantised value of NaNs
+
+
+def __shuffle(raw,itemsize=4):
+    return np.frombuffer(raw,dtype=np.uint8).reshape(-1,itemsize).T.tobytes()
+
+
+def __unshuffle(raw,itemsize=4):
+    return np.frombuffer(raw,dtype=np.uint8).reshape(itemsize,-1).T.tobytes()
+
+
+def compressTile(data,codec=DEFAULT_CODEC,quantize=None,level=3):
+    ''' Compress one tile of floats. Returns (compressed bytes,scale,zero) - scale is 0 if the
+        floats are stored losslessly.
+    '''
+    data = np.ascontiguousarray(data,dtype='>f4')
+    (scale,zero) = (0.0,0.0)
+    if quantize:
+        finite = np.isfinite(data)
+        values = data[finite].astype(np.float64)
+        if values.size > 1:
+            # Noise from the median absolute difference of neighbouring pixels
+            noise = 1.4826 * np.median(np.abs(np.diff(values))) / np.sqrt(2.0)
+            if noise > 0:
+                scale = float(noise / quantize)
+                zero = float(np.median(values))
+        if scale > 0:
+            ints = np.clip(np.round((np.where(finite,data,0).astype(np.float64) - zero) / scale),NULL_VALUE+1,2**31-1)
+            ints = np.where(finite,ints,NULL_VALUE).astype('>i4')
+            data = ints
+    raw = __shuffle(data.tobytes())
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ModuleNotFoundError("The zstd codec needs the 'zstandard' package")
+        return (zstandard.ZstdCompressor(level=level).compress(raw),scale,zero)
+    if codec == 'zlib':
+        return (zlib.compress(raw,level),scale,zero)
+    raise ValueError("Unknown codec '%s'" % codec)
+
+
+def decompressTile(compressed,shape,codec,scale=0.0,zero=0.0):
+    ''' Decompress one tile to a (z,y,x) array of big-endian floats '''
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ModuleNotFoundError("The zstd codec needs the 'zstandard' package")
+        raw = zstandard.ZstdDecompressor().decompress(compressed,max_output_size=int(np.prod(shape))*4)
+    else:
+        raw = zlib.decompress(compressed)
+    raw = __unshuffle(raw)
+    if scale > 0:
+        ints = np.frombuffer(raw,dtype='>i4').reshape(shape)
+        data = (ints * scale + zero).astype('>f4')
+        data[ints == NULL_VALUE] = np.nan
+        return data
+    return np.frombuffer(raw,dtype='>f4').reshape(shape)
+
+
+def tiledHeader(raw,tile,codec,quantize):
+    ''' Return the raw header of the tiled object, given the raw header of the original cube '''
+    from astropy.io import fits
+    header = fits.Header.fromstring(raw.decode())
+    header["OSLAYOUT"] = (TILED_LAYOUT,'ObjStore tile-compressed layout')
+    (header["OSTILEZ"],header["OSTILEY"],header["OSTILEX"]) = tile
+    header["OSCODEC"] = (codec,'tile compression')
+    header["OSQUANT"] = (float(quantize or 0),'quantisation (noise/step), 0 = lossless')
+    return header.tostring().encode()
+
+
+########################################################################################
+############################### CLASS TileIndex ########################################
+########################################################################################
+class TileIndex:
+    ''' Tiling of a cube (shape (z,y,x)) and the position of each compressed tile '''
+
+    def __init__(self,shape,tile,codec,index=None):
+        self.shape = tuple(shape)
+        self.tile = tuple(tile)
+        self.codec = codec
+        self.ntiles = tuple([-(-n // t) for (n,t) in zip(self.shape,self.tile)])
+        self.index = index
+
+    @staticmethod
+    def fromHeader(header,index=None):
+        xsize = int(header["NAXIS1"])
+        ysize = int(header["NAXIS2"])
+        zsize = int(header["NAXIS3"]) if int(header["NAXIS"]) == 3 else int(header["NAXIS4"])
+        tile = (int(header["OSTILEZ"]),int(header["OSTILEY"]),int(header["OSTILEX"]))
+        return TileIndex((zsize,ysize,xsize),tile,header["OSCODEC"],index)
+
+    def tileNumber(self,k,j,i):
+        return (k*self.ntiles[1] + j)*self.ntiles[2] + i
+
+    def tileBox(self,number):
+        ''' Return the (z0,z1,y0,y1,x0,x1) slice bounds (end exclusive) of a tile '''
+        i = number % self.ntiles[2]
+        j = (number // self.ntiles[2]) % self.ntiles[1]
+        k = number // (self.ntiles[2]*self.ntiles[1])
+        (tz,ty,tx) = self.tile
+        return (k*tz,min((k+1)*tz,self.shape[0]),j*ty,min((j+1)*ty,self.shape[1]),i*tx,min((i+1)*tx,self.shape[2]))
+
+    def tilesFor(self,xmin,xmax,ymin,ymax,zmin,zmax):
+        ''' Return the numbers of the tiles overlapping a box (inclusive pixel bounds) '''
+        (tz,ty,tx) = self.tile
+        return [self.tileNumber(k,j,i) for k in range(zmin // tz,zmax // tz + 1)
+                                       for j in range(ymin // ty,ymax // ty + 1)
+                                       for i in range(xmin // tx,xmax // tx + 1)]
+
+    def decompress(self,number,compressed):
+        (z0,z1,y0,y1,x0,x1) = self.tileBox(number)
+        entry = self.index[number]
+        return decompressTile(compressed,(z1-z0,y1-y0,x1-x0),self.codec,float(entry['scale']),float(entry['zero']))
+
+
+def parseTrailer(trailer):
+    ''' Return (index offset,index length,number of tiles) from the trailer of a tiled object '''
+    if trailer[:8] != TRAILER_MAGIC:
+        raise ValueError("Not a tiled object (no tile index trailer)")
+    return struct.unpack('>qqq',trailer[8:TRAILER_SIZE])
+
+
+########################################################################################
+############################### CLASS TiledStream ######################################
+########################################################################################
+class TiledStream(io.RawIOBase):
+    ''' Read-only stream of the tiled object (header, compressed tiles, index and trailer),
+        generated from a (z,y,x) array-like (eg a numpy memmap of a local FITS file) one band
+        of tiles at a time. The tiles of a band are compressed on 'num_threads' threads.
+    '''
+
+    def __init__(self,data,rawheader,tile=DEFAULT_TILE,codec=DEFAULT_CODEC,quantize=None,num_threads=1):
+        io.RawIOBase.__init__(self)
+        self.data = data
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.tiles = TileIndex(data.shape,tile,codec,np.zeros(int(np.prod([-(-n // t) for (n,t) in zip(data.shape,tile)])),dtype=TILE_DTYPE))
+        self.__buffer = memoryview(tiledHeader(rawheader,tile,codec,quantize))
+        self.__offset = len(self.__buffer) # object offset of the next tile
+        self.__band = 0 # next (z,y) band of tiles
+        self.__pos = 0
+        self.__done = False
+
+    def readable(self):
+        return True
+
+    def __compress(self,number):
+        (z0,z1,y0,y1,x0,x1) = self.tiles.tileBox(number)
+        return compressTile(self.data[z0:z1,y0:y1,x0:x1],self.tiles.codec,self.quantize)
+
+    def __nextBuffer(self):
+        (nz,ny,nx) = self.tiles.ntiles
+        if self.__band >= nz*ny:
+            index = self.tiles.index.tobytes()
+            trailer = TRAILER_MAGIC + struct.pack('>qqq',self.__offset,len(index),len(self.tiles.index))
+            self.__buffer = memoryview(index + trailer)
+            self.__done = True
+        else:
+            numbers = [self.__band*nx + i for i in range(nx)]
+            if self.num_threads > 1:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(processes=min(self.num_threads,nx))
+                compressed = pool.map(self.__compress,numbers)
+                pool.close()
+                pool.join()
+            else:
+                compressed = [self.__compress(number) for number in numbers]
+            for (number,(tile,scale,zero)) in zip(numbers,compressed):
+                self.tiles.index[number] = (self.__offset,len(tile),scale,zero)
+                self.__offset += len(tile)
+            self.__buffer = memoryview(b''.join([tile for (tile,scale,zero) in compressed]))
+            self.__band += 1
+        self.__pos = 0
+
+    def readinto(self,b):
+        mv = memoryview(b).cast('B')
+        while self.__pos >= len(self.__buffer):
+            if self.__done:
+                return 0
+            self.__nextBuffer()
+        n = min(len(mv),len(self.__buffer) - self.__pos)
+        mv[:n] = self.__buffer[self.__pos:self.__pos+n]
+        self.__pos += n
+        return n
+
+
+def localCube(path,hdr=None):
+    ''' Return (header object,(z,y,x) memmap) of the data of a local FITS cube '''
+    hdr = hdr or FITSheaderFromFile(path)
+    header = hdr.getHeaderDict()
+    xsize = int(header["NAXIS1"])
+    ysize = int(header["NAXIS2"])
+    zsize = int(header["NAXIS3"]) if int(header["NAXIS"]) == 3 else int(header["NAXIS4"])
+    return (hdr,np.memmap(path,dtype='>f4',mode='r',offset=hdr.len(),shape=(zsize,ysize,xsize)))
@@ -1,21 +1,10 @@
 import os
 import sys
-import logging
 import time
-import multiprocessing as mp
-import threading
+import base64
+import hashlib
 import numpy as np
 
-path = os.path.abspath(os.path.dirname(__file__))
-if not path in sys.path:
-    sys.path.append(path)
-
-
-import boto3
-from boto3.s3.transfer import TransferConfig
-import urllib3.request
-import requests
-
 try:
     from ObjStore.ObjStore import *
     from ObjStore.FITSheader import *
@@ -25,6 +14,9 @@ except ModuleNotFoundError:
     from FITSheader import *
     from get_access_keys import *
 
+MULTIPART_SIZE = ONE_M * 64 # default part size for presigned multipart uploads
+MAX_PARTS = 10000 # S3 limit on the number of parts
+
 ########################################################################################
 #
 ############################### CLASS URLObject ########################################
@@ -37,9 +29,11 @@ class UrlObject(FitsObjStore):
         Inherits from ObjStore.FitsObjStore
     '''
  
-    def __init__(self,url=None,readsize = ONE_G_9):
+    def __init__(self,url=None,readsize = ONE_G_9,project=None):
         """ Unless generating a URL with one of the below class 'create_' methods, 
-            you would normally pass in a URL that has been given to you. """
+            you would normally pass in a URL that has been given to you. 
+            'project' selects the rate limits of that project on the endpoint (see RateLimiter). """
+        import urllib3
         FitsObjStore.__init__(self,mode="url",readsize=readsize)
         self.url = url
         self.http = urllib3.PoolManager()
@@ -48,6 +42,12 @@ class UrlObject(FitsObjStore):
         self.last_read_size = 0
         self.rawdata = b''
         self.upload_dict = None
+        self.project = project
+        if url:
+            from urllib.parse import urlsplit
+            limiter = getLimiter("%s://%s" % urlsplit(url)[:2],project)
+            if limiter:
+                self.setRateLimiter(limiter)
 
     def set_read_sizes(self,bytes_to_read):
         self.whole_reads = int(bytes_to_read // self.readsize)
@@ -61,14 +61,21 @@ class UrlObject(FitsObjStore):
     def create_presigned_url_download(self,certfile, endpoint, project, bucket, key, expiry=8640000):
         """ Create a presigned URL for downloading from objectstore"""
 
+        import boto3
         (access_id,secret_id,quota) = get_access_keys(certfile,endpoint,project)
-        client = boto3.client(service_name='s3',aws_access_key_id=ja3_access_id,aws_secret_access_key=ja3_secret_id, endpoint_url=endpoint)
+        client = boto3.client(service_name='s3',aws_access_key_id=access_id,aws_secret_access_key=secret_id, endpoint_url=endpoint)
         url = client.generate_presigned_url( ClientMethod='get_object', Params={ 'Bucket': bucket, 'Key': key}, ExpiresIn=expiry)
         self.url = url
         return url
 
-    def create_presigned_url_upload(self,certfile, endpoint, project, bucket, key, expiry=8640000):
-        """ Create an upload dict containing a presigned URL for uploading a file to the objectstore"""
+    def create_presigned_url_upload(self,certfile, endpoint, project, bucket, key, expiry=8640000, filesize=None, partsize=MULTIPART_SIZE):
+        """ Create an upload dict containing a presigned URL for uploading a file to the objectstore.
+            If 'filesize' is given and the file is larger than one part, a presigned multipart
+            upload bundle is created instead - see create_presigned_multipart_upload().
+        """
+        if filesize and filesize > partsize:
+            return self.create_presigned_multipart_upload(certfile,endpoint,project,bucket,key,filesize,partsize,expiry)
+        import boto3
         (access_id,secret_id,quota) = get_access_keys(certfile,endpoint,project)
         client = boto3.client(service_name='s3',aws_access_key_id=access_id,aws_secret_access_key=secret_id, endpoint_url=endpoint)
         response = client.generate_presigned_post(bucket,key,ExpiresIn=expiry)
@@ -76,23 +83,146 @@ class UrlObject(FitsObjStore):
         self.upload_dict = response
         return response
 
+    def create_presigned_multipart_upload(self,certfile, endpoint, project, bucket, key, filesize, partsize=MULTIPART_SIZE, expiry=8640000):
+        """ Start a multipart upload of a 'filesize' byte file, and return an upload dict holding
+            presigned URLs for each part, and to list, complete or abort the upload. The bucket
+            owner can give this dict to a collaborator (eg in their certs file), who can then
+            upload in parallel with upload_via_URL() without access keys.
+        """
+        import boto3
+        partsize = max(partsize,-(-filesize // MAX_PARTS),ONE_M*5)
+        nparts = max(1,-(-filesize // partsize))
+        (access_id,secret_id,quota) = get_access_keys(certfile,endpoint,project)
+        client = boto3.client(service_name='s3',aws_access_key_id=access_id,aws_secret_access_key=secret_id, endpoint_url=endpoint)
+        upload_id = client.create_multipart_upload(Bucket=bucket,Key=key)['UploadId']
+        params = {'Bucket': bucket, 'Key': key, 'UploadId': upload_id}
+        sign = lambda method, extra={}: client.generate_presigned_url(ClientMethod=method, Params=dict(params,**extra), ExpiresIn=expiry)
+        upload_dict = {
+            'url': endpoint + '/' + bucket,
+            'multipart': {
+                'key': key,
+                'upload_id': upload_id,
+                'filesize': filesize,
+                'partsize': partsize,
+                'parts': [sign('upload_part',{'PartNumber': n+1}) for n in range(nparts)],
+                'list': sign('list_parts'),
+                'complete': sign('complete_multipart_upload'),
+                'abort': sign('abort_multipart_upload'),
+            }
+        }
+        self.url = upload_dict['url']
+        self.upload_dict = upload_dict
+        return upload_dict
+
     def download_via_URL(self,url=None):
+        import requests
         if not url:
             url = self.url
         tobj = requests.get(url)
         return tobj.content
 
-    def upload_via_URL(self,filename, upload_dict=None):
+    def upload_via_URL(self,filename, upload_dict=None, num_threads=8):
+        """ Upload a file using a presigned upload dict. Multipart upload dicts (see 
+            create_presigned_multipart_upload()) are uploaded in parallel parts.
+        """
         if not upload_dict:
             upload_dict = self.upload_dict
+        if upload_dict and 'multipart' in upload_dict:
+            return self.upload_via_multipart_URL(filename,upload_dict,num_threads)
         if upload_dict:
+            import requests
             with open(filename, 'rb') as f:
                 files = {'file': (filename, f)}
                 print('Expecting 204 response')
                 response = requests.post(upload_dict['url'], data=upload_dict['fields'],files=files)
                 print(f'File upload HTTP status code: {response.status_code}')
-        
 
+    def __listUploadedParts(self,http,multipart):
+        """ Return {part number: ETag} of the parts already uploaded """
+        import xml.etree.ElementTree as ET
+        response = self.urlRequest("GET",multipart['list'],http=http)
+        if response.status != 200:
+            return {}
+        uploaded = {}
+        for elem in ET.fromstring(response.data).iter():
+            if elem.tag.endswith('Part'):
+                number = etag = None
+                for child in elem:
+                    if child.tag.endswith('PartNumber'):
+                        number = int(child.text)
+                    elif child.tag.endswith('ETag'):
+                        etag = child.text.strip('"')
+                if number:
+                    uploaded[number] = etag
+        return uploaded
+
+    def __uploadPart(self,http,filename,multipart,number,uploaded):
+        """ Upload part 'number' of the file (unless an identical part is already uploaded).
+            Returns the part ETag.
+        """
+        start = (number-1)*multipart['partsize']
+        with open(filename,'rb') as f:
+            f.seek(start)
+            data = f.read(multipart['partsize'])
+        md5 = hashlib.md5(data)
+        if number in uploaded and uploaded[number] == md5.hexdigest():
+            return uploaded[number]
+        # The objectstore rejects the part if it does not match Content-MD5, and its ETag is the part MD5
+        headers = {"Content-Length":str(len(data)),"Content-MD5":base64.b64encode(md5.digest()).decode()}
+        response = self.urlRequest("PUT",multipart['parts'][number-1],len(data),http,body=data,headers=headers)
+        if response.status != 200:
+            raise IOError("Upload of part %s failed with HTTP status %s: %s" % (number,response.status,response.data[:200]))
+        etag = response.headers['ETag'].strip('"')
+        if etag != md5.hexdigest():
+            raise ChecksumError("Part %s was stored with ETag %s, but its MD5 is %s" % (number,etag,md5.hexdigest()))
+        return etag
+
+    def upload_via_multipart_URL(self,filename,upload_dict=None,num_threads=8):
+        """ Upload a file in parallel parts using a presigned multipart upload dict, over a 
+            pool of 'num_threads' connections. If an earlier attempt failed part way, parts 
+            that were already uploaded (with matching checksums) are skipped, so rerunning 
+            resumes the upload. Returns the HTTP status of the completion request.
+        """
+        import urllib3
+        if not upload_dict:
+            upload_dict = self.upload_dict
+        multipart = upload_dict['multipart']
+        filesize = os.path.getsize(filename)
+        if filesize != multipart['filesize']:
+            raise ValueError("File is %s bytes, but the upload was created for %s bytes" % (filesize,multipart['filesize']))
+        http = urllib3.PoolManager(maxsize=num_threads)
+        if self.limiter is None:
+            from urllib.parse import urlsplit
+            self.limiter = getLimiter("%s://%s" % urlsplit(multipart['parts'][0])[:2],self.project)
+        uploaded = self.__listUploadedParts(http,multipart)
+        nparts = len(multipart['parts'])
+        print(f"Uploading {filename} in {nparts} parts of {multipart['partsize']} bytes ({len(uploaded)} already uploaded)",flush=True)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=max(1,min(num_threads,nparts)))
+        result_objs = [pool.apply_async(self.__uploadPart,(http,filename,multipart,n+1,uploaded)) for n in range(nparts)]
+        etags = [result.get() for result in result_objs]
+        pool.close()
+        pool.join()
+
+        body = "<CompleteMultipartUpload>" + "".join(["<Part><PartNumber>%s</PartNumber><ETag>\"%s\"</ETag></Part>" % (n+1,etag) for (n,etag) in enumerate(etags)]) + "</CompleteMultipartUpload>"
+        response = self.urlRequest("POST",multipart['complete'],http=http,body=body.encode(),headers={"Content-Type":"application/xml"})
+        if response.status != 200 or b'<Error>' in response.data:
+            raise IOError("Completing multipart upload failed with HTTP status %s: %s" % (response.status,response.data[:200]))
+        # The object ETag is the MD5 of the part MD5s - check it matches the parts sent
+        expected = compositeMD5([bytes.fromhex(etag) for etag in etags])
+        stored = response.data.split(b'<ETag>')[-1].split(b'</ETag>')[0].decode().replace('&quot;','').strip('"')
+        if b'<ETag>' in response.data and '-' in stored and stored != expected:
+            raise ChecksumError("Uploaded object has ETag %s, but the parts sent give %s" % (stored,expected))
+        print(f'File upload HTTP status code: {response.status}')
+        return response.status
+
+    def abort_via_URL(self,upload_dict=None):
+        """ Abandon a presigned multipart upload, removing any parts already uploaded """
+        if not upload_dict:
+            upload_dict = self.upload_dict
+        response = self.urlRequest("DELETE",upload_dict['multipart']['abort'])
+        return response.status
 
 ########################################################################################
 ############################### END CLASS ##############################################
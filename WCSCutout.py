@@ -0,0 +1,98 @@
+''' Conversion of world-coordinate cutout requests (RA/Dec and frequency or velocity)
+    into the pixel bounds used by FitsObjStore.getPartitionData().
+
+    The WCS is taken from the header object (see getWCS() in FITSheader), which builds it
+    once and caches it, so batches of positions need no further header work.
+'''
+import numpy as np
+
+
+def __cubeSize(header):
+    ''' Return (xsize,ysize,zsize) of the datacube, as used by FitsObjStore '''
+    xsize = int(header["NAXIS1"])
+    ysize = int(header["NAXIS2"])
+    zsize = 1
+    if int(header["NAXIS"]) == 3:
+        zsize = int(header["NAXIS3"])
+    elif int(header["NAXIS"]) > 3:
+        zsize = int(header["NAXIS4"])
+    return (xsize,ysize,zsize)
+
+
+def __pixelRange(pix,size):
+    ''' Convert the min/max of a set of pixel coordinates (pixel centres at integers)
+        into an inclusive integer range clipped to the axis, or None if off the axis.
+        Coordinates that do not project (NaN, eg on the far side of the sky) are ignored.
+    '''
+    if not np.isfinite(pix).any():
+        return None
+    pmin = int(np.floor(np.nanmin(pix)+0.5))
+    pmax = int(np.floor(np.nanmax(pix)+0.5))
+    if pmax < 0 or pmin > size-1:
+        return None
+    return (max(pmin,0),min(pmax,size-1))
+
+
+def __spectralValues(wcs,spectral,doppler='radio'):
+    ''' Return the spectral range in the units of the spectral axis. If the range is given
+        as astropy Quantities, frequencies and velocities are converted using the rest
+        frequency in the header and the 'doppler' convention (radio, optical or relativistic).
+    '''
+    lo,hi = spectral
+    if not hasattr(lo,'unit'):
+        return (float(lo),float(hi))
+    from astropy import units as u
+    unit = u.Unit(wcs.wcs.cunit[0])
+    equiv = []
+    if wcs.wcs.restfrq:
+        equiv = getattr(u,'doppler_%s' % doppler)(wcs.wcs.restfrq * u.Hz)
+    elif wcs.wcs.restwav:
+        equiv = getattr(u,'doppler_%s' % doppler)(wcs.wcs.restwav * u.m)
+    return (lo.to_value(unit,equivalencies=equiv),hi.to_value(unit,equivalencies=equiv))
+
+
+def skyToPixelBounds(hdr,ra,dec,radius=None,box=None,spectral=None,doppler='radio'):
+    ''' Return a list of pixel bounds (xmin,xmax,ymin,ymax,zmin,zmax) for one or more sky
+        positions, suitable for getPartitionData(). Positions that fall outside the datacube
+        give None.
+
+            ra, dec  : position(s) in degrees - scalars or arrays
+            radius   : cone radius in degrees (the bounding box of the cone is returned)
+            box      : (width,height) in degrees, as an alternative to radius
+            spectral : (low,high) range as astropy Quantities (frequency or velocity) or
+                       as values in the units of the spectral axis. All channels if None.
+    '''
+    header = hdr.getHeaderDict()
+    (xsize,ysize,zsize) = __cubeSize(header)
+    wcs = hdr.getWCS()
+
+    if radius is not None:
+        half_w = half_h = float(radius)
+    elif box is not None:
+        half_w = float(box[0])/2.0
+        half_h = float(box[1])/2.0
+    else:
+        raise ValueError("One of radius or box must be given")
+
+    ra,dec = np.broadcast_arrays(np.atleast_1d(np.asarray(ra,dtype=float)),np.atleast_1d(np.asarray(dec,dtype=float)))
+    # Sample the corners and edge midpoints of each box, widening RA with declination
+    dra = half_w / np.maximum(np.cos(np.radians(dec)),1e-6)
+    ras = np.stack([ra-dra,ra+dra,ra-dra,ra+dra,ra,ra,ra-dra,ra+dra])
+    decs = np.stack([dec-half_h,dec-half_h,dec+half_h,dec+half_h,dec-half_h,dec+half_h,dec,dec])
+    px,py = wcs.celestial.world_to_pixel_values(ras,decs)
+
+    zrange = (0,zsize-1)
+    if spectral is not None:
+        spec = wcs.spectral
+        pz = spec.world_to_pixel_values(np.array(__spectralValues(spec,spectral,doppler)))
+        zrange = __pixelRange(pz,zsize)
+
+    bounds = []
+    for i in range(ra.shape[0]):
+        xrange = __pixelRange(px[:,i],xsize)
+        yrange = __pixelRange(py[:,i],ysize)
+        if xrange is None or yrange is None or zrange is None:
+            bounds.append(None)
+        else:
+            bounds.append(xrange+yrange+zrange)
+    return bounds
@@ -57,12 +57,12 @@ USEURL = False
 
 if USEURL: # local(6 threads): 856sec carnaby(24 threads):10sec
     url = get_download_URL(certfile,endpoint,project,bucket,key)
-    hdr = FITSheaderFromURL(url)
-    obj = UrlObject(url)
+    hdr = FITSheaderFromURL(url,project)
+    obj = UrlObject(url,project=project)
 else: # local(6 threads): 814sec carnaby(24 threads):10sec 
     (access_id,secret_id,quota) = get_access_keys(certfile,endpoint,project)
-    hdr = FITSheaderFromS3(endpoint,bucket,key,access_id,secret_id)
-    obj = S3Object(bucket,key,access_id,secret_id,endpoint)
+    hdr = FITSheaderFromS3(endpoint,bucket,key,access_id,secret_id,project)
+    obj = S3Object(bucket,key,access_id,secret_id,endpoint,project)
 
 start_time = time.time() 
 
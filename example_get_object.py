@@ -32,7 +32,7 @@ if not USEURL:
     localpath = "./test.cfg"
     (access_id,secret_id,quota) = get_access_keys(certfile,endpoint,project)
 
-    obj = S3.S3Object(bucket,key,access_id,secret_id,endpoint)
+    obj = S3.S3Object(bucket,key,access_id,secret_id,endpoint,project)
     my_object = obj.getObject()
 else:
     bucket = "aussrc"
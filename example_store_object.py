@@ -52,6 +52,8 @@ else:
     hdrdict = {}
     # If we're storing a FITS file, get the FITS header from file
     hdr = FITSheaderFromFile(localpath+'/'+keyname)
+    # Only keywords that fit in the 2Kb metadata limit are kept - choose which with eg
+    # hdr.convert2dict(keywords=CUBE_KEYWORDS)
     hdrdict = hdr.convert2dict()
 
     # Add data type to header
@@ -62,12 +64,15 @@ if not USEURL:
     (access_id,secret_id,quota) = get_access_keys(certfile,endpoint,project)
     # Upload using the Boto3 S3 API and access/secret id's
     # Create an instance of the object class:
-    obj = S3.S3Object(bucket,objname,access_id,secret_id,endpoint)
+    obj = S3.S3Object(bucket,objname,access_id,secret_id,endpoint,project)
     # You can set defaults like this (but the normal defaults are fastest for most uses):
     #obj.setConfig(file_thresholdsize, file_chunksize, num_threads)
 
     # Upload to store - files larger than 5G will be 'chunked' - for batch jobs, set progress=False
     obj.uploadFile(localpath,keyname,ExtraArgs=hdrdict,progress=True)
+    # Store the full FITS header alongside, as object objname + '.hdr'
+    if hdr.len():
+        obj.uploadHeader(hdr)
 else:
     # Alternative upload using an upload dictionary with a presigned URL.
     obj = URL.UrlObject()
@@ -89,3 +94,9 @@ else:
     obj.upload_via_URL(localpath+"/"+keyname,upload_dict)
 
 
+
+    # To upload a whole directory tree of files (only those that are new or have changed since
+    # the last sync are sent), use S3Sync rather than one S3Object per file:
+    #
+    # from S3Sync import syncDirectory
+    # syncDirectory(localpath,bucket,storepath,access_id,secret_id,endpoint,num_threads=16)
@@ -1,59 +1,31 @@
-import json
-import ast
-import time
-
-def __checkURLexpiry(url):
-    stamp = float(url.split("Expires=")[1])
-    now = time.time()
-    if now > stamp:
-        return False
-    return True
+try:
+    from ObjStore.CertsRegistry import getRegistry
+except ModuleNotFoundError:
+    from CertsRegistry import getRegistry
 
 def get_access_keys(filename,endpoint,project):
     ''' Given a json file, endpoint url and project name, 
         return the access key, secret key and quota
     '''
-    access_id = ""
-    secret_id = ""
-    quota = ""
-
-    with open(filename,'r') as cert_file:
-        cert_data = json.load(cert_file)
-        access = cert_data["endpoints"][endpoint]["projects"][project]
-        access_id = access["access"]
-        secret_id = access["secret"]
-        quota = access["quota"]
-
-    return (access_id,secret_id,quota)
+    return getRegistry(filename).getAccessKeys(endpoint,project)
 
 def get_download_URL(filename,endpoint,project,bucket,objname):
     ''' Given a json file and endpoint, return the 
-        download URL, if defined. '''
-
-    url = ""
-    with open(filename,'r') as cert_file:
-        cert_data = json.load(cert_file)
-        url = cert_data["endpoints"][endpoint]["projects"][project]["bucket"][bucket]["download_urls"][objname]
-        if url == "":
-            raise ValueError("URL for download not found")
-        if not __checkURLexpiry(url):
-            raise ValueError("URL has expired")
-    return url
+        download URL, if defined. If the project keys are in the file,
+        an expired (or nearly expired) URL is replaced by a new one. '''
+
+    return getRegistry(filename).getDownloadURL(endpoint,project,bucket,objname)
+
+def get_download_URLs(filename,endpoint,project,bucket,objnames):
+    ''' As get_download_URL(), for a list of objects in the bucket. '''
+
+    return getRegistry(filename).getDownloadURLs(endpoint,project,bucket,objnames)
 
 def get_upload_URL(filename,endpoint,project,bucket,objname):
     ''' Given a json file and endpoint, return the 
         upload dict containing the URL, if defined. '''
 
-    upload_dict = {}
-    upload_str = ""
-    with open(filename,'r') as cert_file:
-        cert_data = json.load(cert_file)
-        upload_str = cert_data["endpoints"][endpoint]["projects"][project]["bucket"][bucket]["upload_urls"][objname]
-        if upload_str == "":
-            raise ValueError("URL for upload not found")
-        upload_dict = ast.literal_eval(upload_str)
-
-    return upload_dict
+    return getRegistry(filename).getUploadDict(endpoint,project,bucket,objname)
     
 
     
@@ -0,0 +1,82 @@
+''' Shared fixtures: a local moto S3 server, and small FITS cubes to store in it '''
+import os
+import sys
+import uuid
+
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ACCESS = 'testing'
+SECRET = 'testing'
+
+
+@pytest.fixture(scope='session')
+def endpoint():
+    ''' URL of a moto S3 server running for the whole session '''
+    moto_server = pytest.importorskip('moto.server')
+    os.environ.setdefault('AWS_DEFAULT_REGION','us-east-1')
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1',port=0)
+    server.start()
+    (host,port) = server.get_host_and_port()
+    yield "http://%s:%s" % (host,port)
+    server.stop()
+
+
+@pytest.fixture
+def bucket(endpoint):
+    ''' A new, empty bucket '''
+    import boto3
+    name = 'test-%s' % uuid.uuid4().hex[:12]
+    client = boto3.client('s3',aws_access_key_id=ACCESS,aws_secret_access_key=SECRET,endpoint_url=endpoint,region_name='us-east-1')
+    client.create_bucket(Bucket=name)
+    return name
+
+
+def writeCube(path,shape=(20,40,30),seed=0):
+    ''' Write a (z,y,x) cube of random big-endian floats as a FITS file, and return the data '''
+    from astropy.io import fits
+    data = np.random.default_rng(seed).normal(size=shape).astype('>f4')
+    fits.PrimaryHDU(data).writeto(path,overwrite=True)
+    return data
+
+
+def writeWCSCube(path,shape=(20,40,30),seed=0,ra=150.0,dec=-30.0,cdelt=0.01):
+    ''' Write a (z,y,x) cube with a RA---SIN/DEC--SIN/FREQ WCS centred on (ra,dec), with
+        channels 1MHz apart from 1.4GHz, and return the data
+    '''
+    from astropy.io import fits
+    (nz,ny,nx) = shape
+    data = np.random.default_rng(seed).normal(size=shape).astype('>f4')
+    hdu = fits.PrimaryHDU(data)
+    for (axis,ctype,crpix,crval,cdelt_,cunit) in [(1,'RA---SIN',(nx+1)/2,ra,-cdelt,'deg'),
+                                                   (2,'DEC--SIN',(ny+1)/2,dec,cdelt,'deg'),
+                                                   (3,'FREQ',1,1.4e9,1e6,'Hz')]:
+        hdu.header['CTYPE%s' % axis] = ctype
+        hdu.header['CRPIX%s' % axis] = crpix
+        hdu.header['CRVAL%s' % axis] = crval
+        hdu.header['CDELT%s' % axis] = cdelt_
+        hdu.header['CUNIT%s' % axis] = cunit
+    hdu.header['RESTFRQ'] = 1.420405752e9
+    hdu.header['SPECSYS'] = 'TOPOCENT'
+    hdu.writeto(path,overwrite=True)
+    return data
+
+
+@pytest.fixture
+def cube(tmp_path):
+    ''' (directory,filename,data) of a small local FITS cube '''
+    data = writeCube(str(tmp_path / 'cube.fits'))
+    return (str(tmp_path),'cube.fits',data)
+
+
+@pytest.fixture
+def s3cube(endpoint,bucket,cube):
+    ''' (S3Object,header,data) of the small cube stored in a new bucket '''
+    from S3Object import S3Object
+    from FITSheader import FITSheaderFromS3
+    (path,filename,data) = cube
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.uploadFile(path,filename,progress=False)
+    return (obj,FITSheaderFromS3(endpoint,bucket,filename,ACCESS,SECRET),data)
@@ -0,0 +1,42 @@
+''' Many small boxes from one cube in a single pass of merged reads '''
+import numpy as np
+import pytest
+
+from S3Object import *
+
+
+def test_box_ranges():
+    # a 10x8x5 cube of 4 byte pixels after a 2880 byte header: rows are 40 bytes, channels 320
+    (ranges,owners) = boxRanges([(2,4,1,2,3,4),(0,9,7,7,0,0)],10,8,5,2880)
+    assert ranges == [(2880+3*320+1*40+2*4,1*40+3*4),(2880+4*320+1*40+2*4,1*40+3*4),(2880+7*40,40)]
+    assert owners == [(0,0),(0,1),(1,0)]
+    for box in [(0,10,0,0,0,0),(0,0,-1,0,0,0),(0,0,0,0,3,2)]:
+        with pytest.raises(ValueError,match="not within"):
+            boxRanges([box],10,8,5,2880)
+
+
+def test_batch_matches_the_data(s3cube):
+    (obj,hdr,data) = s3cube
+    boxes = [(0,29,0,39,0,19),(5,9,5,9,3,3),(6,10,4,8,2,5),(29,29,39,39,19,19),(5,9,5,9,3,3)]
+    results = obj.getPartitionDataBatch(boxes,hdr,2)
+    for ((xmin,xmax,ymin,ymax,zmin,zmax),result) in zip(boxes,results):
+        assert result.shape == (zmax-zmin+1,ymax-ymin+1,xmax-xmin+1)
+        assert np.array_equal(result,data[zmin:zmax+1,ymin:ymax+1,xmin:xmax+1])
+    assert obj.getPartitionDataBatch([],hdr) == []
+
+
+def test_overlapping_boxes_share_reads(s3cube):
+    (obj,hdr,data) = s3cube
+    reads = []
+    read = obj.readPooled
+    def recordRead(start,length):
+        reads.append((start,length))
+        return read(start,length)
+    obj.readPooled = recordRead
+    # the same rows of channel 4 three times, and channel 15 far away (with no gap allowed)
+    boxes = [(0,9,10,12,4,4),(5,20,11,12,4,4),(3,3,10,10,4,4),(0,0,0,0,15,15)]
+    results = obj.getPartitionDataBatch(boxes,hdr,1,gap=0)
+    chbytes = 30*40*4
+    first = hdr.len() + 4*chbytes + 10*30*4
+    assert sorted(reads) == [(first,(2*30+21)*4),(hdr.len() + 15*chbytes,4)]
+    assert np.array_equal(results[1],data[4:5,11:13,5:21])
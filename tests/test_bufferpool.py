@@ -0,0 +1,49 @@
+''' Buffer pool retention, with and without a memory limit '''
+from conftest import ACCESS,SECRET
+
+from S3Object import *
+
+
+def test_pool_keeps_up_to_max_bytes():
+    pool = BufferPool(max_bytes=ONE_M*4)
+    bufs = [pool.get(ONE_M) for i in range(6)]
+    assert pool.used_bytes == ONE_M*6
+    for buf in bufs:
+        pool.put(buf)
+    assert pool.used_bytes == 0
+    assert pool.free_bytes == ONE_M*4
+    assert pool.get(ONE_M) is not None and pool.reused == 1
+
+
+def test_limit_releases_and_caps_free_buffers():
+    pool = BufferPool(max_bytes=ONE_M*64)
+    for buf in [pool.get(ONE_M*8) for i in range(4)]:
+        pool.put(buf)
+    assert pool.free_bytes == ONE_M*32
+    with pool.limit(ONE_M*10):
+        assert pool.free_bytes <= ONE_M*10
+        held = [pool.get(ONE_M*2) for i in range(4)]
+        assert pool.free_bytes == 0
+        for buf in held:
+            pool.put(buf)
+        assert pool.free_bytes <= ONE_M*10
+    # nothing grows back once the limit is gone, until the pool is used again
+    assert pool.free_bytes <= ONE_M*10
+
+
+def test_partition_read_keeps_pool_within_budget(endpoint,bucket,cube):
+    (path,filename,data) = cube
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.uploadFile(path,filename,progress=False)
+    hdr = FITSheaderFromS3(endpoint,bucket,filename,ACCESS,SECRET)
+    pool = BufferPool()
+    for buf in [pool.get(ONE_M*16) for i in range(4)]:
+        pool.put(buf)
+    obj.setBufferPool(pool)
+    (z,y,x) = data.shape
+    result = z*y*x*FITS_FLOAT_SIZE
+    max_memory = result + ONE_M*2
+    out = obj.getPartitionData(0,x-1,0,y-1,0,z-1,hdr,4,max_memory=max_memory)
+    assert (out == data.ravel()).all()
+    assert pool.used_bytes == 0
+    assert pool.free_bytes <= max_memory - result
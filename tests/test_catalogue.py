@@ -0,0 +1,65 @@
+''' The bucket catalogue: incremental updates by ETag, and sky and spectral queries '''
+import numpy as np
+import pytest
+
+from conftest import ACCESS,SECRET,writeWCSCube
+
+from S3Object import *
+from Catalogue import Catalogue
+
+
+def putCube(client,bucket,path,key,ra,crval3=1.4e9,seed=0):
+    ''' Write a cube at 'ra' (dec -30) whose 20 1MHz channels start at 'crval3', and store it '''
+    from astropy.io import fits
+    writeWCSCube(path,shape=(20,20,30),seed=seed,ra=ra)
+    fits.setval(path,'CRVAL3',value=crval3)
+    with open(path,'rb') as f:
+        client.put_object(Bucket=bucket,Key=key,Body=f.read())
+
+
+def test_update_and_query(endpoint,bucket,tmp_path):
+    from astropy import units as u
+    obj = S3Object(bucket,'a.fits',ACCESS,SECRET,endpoint)
+    client = obj.client
+    putCube(client,bucket,str(tmp_path / 'a.fits'),'a.fits',150.0)
+    putCube(client,bucket,str(tmp_path / 'b.fits'),'b.fits',0.05,crval3=1.5e9,seed=1) # spans RA 0
+    # the header of a.fits also comes from its sidecar
+    obj.uploadHeader(FITSheaderFromFile(str(tmp_path / 'a.fits')))
+    client.put_object(Bucket=bucket,Key='notes.txt',Body=b'not a cube')
+
+    catalogue = Catalogue(str(tmp_path / 'cat.db'),bucket,ACCESS,SECRET,endpoint,num_threads=4)
+    try:
+        assert catalogue.update() == (2,0)
+        assert catalogue.keys() == ['a.fits','b.fits']
+        assert catalogue.getHeader('a.fits').getHeaderDict()['CRVAL1'] == 150.0
+
+        # sky positions - b.fits covers RA 359.9 to 0.2
+        assert catalogue.query(ra=150.0,dec=-30.0) == ['a.fits']
+        assert catalogue.query(ra=359.95,dec=-30.0) == ['b.fits']
+        assert catalogue.query(ra=0.1,dec=-30.0) == ['b.fits']
+        assert catalogue.query(ra=150.0,dec=-20.0) == []
+        assert catalogue.query(ra=150.3,dec=-30.0) == []
+        assert catalogue.query(ra=150.3,dec=-30.0,radius=0.2) == ['a.fits']
+        assert catalogue.query(dec=-30.1) == ['a.fits','b.fits']
+
+        # spectral ranges, in the units of the cubes or as quantities
+        assert catalogue.query(spectral=(1.405e9,1.41e9)) == ['a.fits']
+        assert catalogue.query(spectral=(1.41e9,1.51e9)) == ['a.fits','b.fits']
+        assert catalogue.query(spectral=(1.505,1.506)*u.GHz) == ['b.fits']
+        assert catalogue.query(spectral=(21,21.2)*u.cm) == ['a.fits'] # 1.414-1.428GHz
+        assert catalogue.query(spectral=(2000,2500)*u.km/u.s) == ['a.fits'] # radio velocity from RESTFRQ
+        assert catalogue.query(ra=0.0,dec=-30.0,spectral=(1.405e9,1.41e9)) == []
+
+        # unchanged objects are not read again
+        assert catalogue.update() == (0,0)
+
+        # a changed object is refreshed (its ETag differs), a removed one dropped
+        putCube(client,bucket,str(tmp_path / 'b.fits'),'b.fits',0.05,crval3=1.6e9,seed=1)
+        client.delete_object(Bucket=bucket,Key='a.fits')
+        assert catalogue.update() == (1,1)
+        assert catalogue.keys() == ['b.fits']
+        assert catalogue.query(spectral=(1.505e9,1.506e9)) == []
+        assert catalogue.query(spectral=(1.605e9,1.606e9)) == ['b.fits']
+        assert catalogue.update() == (0,0)
+    finally:
+        catalogue.close()
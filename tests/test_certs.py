@@ -0,0 +1,82 @@
+''' The certs registry: URL expiry, reloading the certs file and re-signing expired URLs '''
+import json
+import os
+import time
+import urllib.request
+
+import pytest
+
+from conftest import ACCESS,SECRET
+
+from CertsRegistry import *
+
+
+def test_url_expiry_v2_and_v4():
+    assert urlExpiry("https://host/bucket/key?AWSAccessKeyId=abc&Signature=xyz&Expires=1700000000") == 1700000000
+    v4 = "https://host/bucket/key?X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Date=20240102T030405Z&X-Amz-Expires=3600&X-Amz-Signature=abc"
+    assert urlExpiry(v4) == calendar.timegm((2024,1,2,3,4,5)) + 3600
+    assert urlExpiry("https://host/bucket/key") is None
+
+
+def test_upload_expiry_from_policy():
+    policy = base64.b64encode(json.dumps({"expiration":"2024-05-05T04:53:42Z","conditions":[]}).encode()).decode()
+    assert uploadExpiry({"url":"https://host/bucket","fields":{"policy":policy}}) == calendar.timegm((2024,5,5,4,53,42))
+    assert uploadExpiry({"url":"https://host/bucket","fields":{}}) is None
+
+
+def writeCerts(path,endpoint,access,secret,urls={}):
+    with open(path,'w') as f:
+        json.dump({"endpoints":{endpoint:{"projects":{"proj":{"access":access,"secret":secret,"quota":"1TB",
+                   "bucket":{"bkt":{"download_urls":urls}}}}}}},f)
+
+
+def test_registry_reloads_when_the_file_changes(tmp_path):
+    path = str(tmp_path / 'certs.json')
+    writeCerts(path,'https://store','one','first')
+    registry = CertsRegistry(path)
+    assert registry.getAccessKeys('https://store','proj')[:2] == ('one','first')
+    writeCerts(path,'https://store','two','second')
+    # unchanged mtime - the file is not read again
+    os.utime(path,(os.stat(path).st_atime,registry._CertsRegistry__mtime))
+    assert registry.getAccessKeys('https://store','proj')[:2] == ('one','first')
+    os.utime(path,(time.time(),registry._CertsRegistry__mtime + 10))
+    assert registry.getAccessKeys('https://store','proj')[:2] == ('two','second')
+    assert getRegistry(path) is getRegistry(path)
+
+
+def test_expired_urls_are_signed_again_in_bulk(endpoint,bucket,tmp_path):
+    import boto3
+    client = boto3.client('s3',aws_access_key_id=ACCESS,aws_secret_access_key=SECRET,endpoint_url=endpoint,region_name='us-east-1')
+    for n in range(4):
+        client.put_object(Bucket=bucket,Key='obj%s' % n,Body=('object %s' % n).encode())
+    now = int(time.time())
+    expired = "%s/%s/%%s?AWSAccessKeyId=abc&Signature=old&Expires=%s" % (endpoint,bucket,now-100)
+    valid = client.generate_presigned_url(ClientMethod='get_object',Params={'Bucket':bucket,'Key':'obj0'},ExpiresIn=86400)
+    urls = {"obj0":valid,"obj1":expired % 'obj1',"obj2":expired % 'obj2'}
+    path = str(tmp_path / 'certs.json')
+    with open(path,'w') as f:
+        json.dump({"endpoints":{endpoint:{"projects":{"proj":{"access":ACCESS,"secret":SECRET,
+                   "bucket":{bucket:{"download_urls":urls}}}}}}},f)
+    registry = CertsRegistry(path)
+    signed = []
+    registry._CertsRegistry__client(endpoint,'proj').meta.events.register('before-sign.s3.GetObject',lambda **kwargs: signed.append(1))
+    result = registry.getDownloadURLs(endpoint,'proj',bucket,['obj0','obj1','obj2','obj3'])
+    assert result[0] == valid # still valid - kept
+    assert len(signed) == 3 # the expired ones and the one with no entry, signed together
+    for (n,url) in enumerate(result):
+        assert urlExpiry(url) > now + 3600
+        with urllib.request.urlopen(url) as response:
+            assert response.read() == ('object %s' % n).encode()
+    # cached from now on
+    assert registry.getDownloadURLs(endpoint,'proj',bucket,['obj1','obj3']) == [result[1],result[3]]
+    assert len(signed) == 3
+
+
+def test_expired_url_without_keys(tmp_path):
+    path = str(tmp_path / 'certs.json')
+    writeCerts(path,'https://store','****','****',{"old":"https://store/bkt/old?Expires=1000&Signature=x"})
+    registry = CertsRegistry(path)
+    with pytest.raises(ValueError,match="expired"):
+        registry.getDownloadURL('https://store','proj','bkt','old')
+    with pytest.raises(ValueError,match="not found"):
+        registry.getDownloadURL('https://store','proj','bkt','missing')
@@ -0,0 +1,50 @@
+''' Partition reads of strided and sparse channel selections '''
+import numpy as np
+import pytest
+
+from S3Object import *
+
+
+def recordReads(obj):
+    ''' Record the (start,length) of each read the object makes '''
+    reads = []
+    read = obj.readPooled
+    def recordRead(start,length):
+        reads.append((start,length))
+        return read(start,length)
+    obj.readPooled = recordRead
+    return reads
+
+
+def test_strided_and_listed_channels(s3cube):
+    (obj,hdr,data) = s3cube
+    box = (3,25,5,37)
+    cut = data[:,5:38,3:26]
+    for channels in (slice(1,20,6),slice(None,None,-3),[17,2,3,3,0],np.array([19,4])):
+        got = obj.getPartitionData(*box,0,0,hdr,2,channels=channels)
+        expected = cut[np.arange(20)[channels] if isinstance(channels,slice) else channels]
+        assert np.array_equal(got,expected.ravel())
+    # zmin and zmax are ignored once channels are given
+    assert np.array_equal(obj.getPartitionData(*box,5,9,hdr,channels=[1]),cut[1].ravel())
+    with pytest.raises(ValueError,match="outside datacube"):
+        obj.getPartitionData(*box,0,0,hdr,channels=[3,20])
+
+
+def test_nearby_channels_share_reads(s3cube):
+    (obj,hdr,data) = s3cube
+    reads = recordReads(obj)
+    obj.getPartitionData(0,29,0,39,0,0,hdr,2,channels=[0,2,19])
+    # the small cube fits in one read, from the first channel to the end of the last
+    chbytes = 30*40*4
+    assert reads == [(hdr.len(),20*chbytes)]
+
+
+def test_coalesce_ranges():
+    ranges = [(MERGE_GAP*10,100),(0,100),(150,50),(100+MERGE_GAP,10)]
+    groups = coalesceRanges(ranges)
+    assert [(g.start,g.end) for g in groups] == [(0,110+MERGE_GAP),(MERGE_GAP*10,MERGE_GAP*10+100)]
+    assert groups[0].offsets() == [(1,0,100),(2,150,50),(3,100+MERGE_GAP,10)]
+    assert totalBytes(groups) == 110+MERGE_GAP+100
+    # a read is not allowed to grow beyond maxlen
+    groups = coalesceRanges(ranges,maxlen=1000)
+    assert [(g.start,g.end) for g in groups] == [(0,200),(100+MERGE_GAP,110+MERGE_GAP),(MERGE_GAP*10,MERGE_GAP*10+100)]
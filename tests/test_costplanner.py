@@ -0,0 +1,69 @@
+''' Dry-run read plans: the planned reads are the reads made, and the cheapest plan is chosen '''
+import numpy as np
+import pytest
+
+from S3Object import *
+
+
+def recordReads(obj):
+    ''' Record the (start,length) of every range read the object makes '''
+    reads = []
+    for name in ('readBytes','readPooled'):
+        def record(start,length,read=getattr(obj,name)):
+            reads.append((start,length))
+            return read(start,length)
+        setattr(obj,name,record)
+    return reads
+
+
+def test_link_profile_estimate():
+    profile = LinkProfile(latency=0.1,bandwidth=100.0,max_bandwidth=250.0)
+    assert profile.estimate([]) == 0.0
+    assert profile.estimate([100,100,100]) == pytest.approx(3*1.1)
+    # two streams, each limited by its own bandwidth
+    assert profile.estimate([100,100,100,100],num_threads=2) == pytest.approx(2*1.1)
+    # four streams, limited by the total bandwidth
+    assert profile.estimate([100,100,100,100],num_threads=4) == pytest.approx(400/250.0)
+    # no faster than the longest read
+    assert profile.estimate([1000,10],num_threads=2) == pytest.approx(10.1)
+
+
+def test_plans_are_the_reads_made(s3cube):
+    (obj,hdr,data) = s3cube
+    box = (3,25,5,37,2,17)
+    plans = obj.planPartitionData(*box,hdr,num_threads=2)
+    assert sorted(plans) == ['batch','partition','strategy1','strategy2','strategy3']
+    chbytes = 30*40*4
+    assert plans['strategy1'].ranges == [(hdr.len() + z*chbytes,chbytes) for z in range(2,18)]
+    assert plans['strategy3'].requests == 16*33
+    readers = {'partition': lambda: obj.getPartitionData(*box,hdr,2),
+               'batch': lambda: obj.getPartitionDataBatch([box],hdr,2),
+               'strategy3': lambda: obj.getPartitionDataByStrategy(*box,hdr,3)}
+    for (name,read) in readers.items():
+        reads = recordReads(obj)
+        read()
+        assert sorted(reads) == sorted(plans[name].ranges), name
+        plan = plans[name]
+        assert (plan.nbytes,plan.requests) == (sum([r[1] for r in reads]),len(reads))
+    with pytest.raises(ValueError):
+        obj.planPartitionData(0,30,0,0,0,0,hdr)
+
+
+def test_cheapest_plan():
+    geometry = (1000,1000,100,2880)
+    box = (10,19,10,19,0,99)
+    # with slow requests the fewest reads win, with a slow link the fewest bytes
+    plans = planCutout(geometry,box,profile=LinkProfile(latency=10.0,bandwidth=1e12,max_bandwidth=1e12),maxread=400*1024**2)
+    assert cheapestPlan(plans).requests == 1
+    plans = planCutout(geometry,box,profile=LinkProfile(latency=1e-9,bandwidth=1e3,max_bandwidth=1e3),maxread=400*1024**2)
+    assert cheapestPlan(plans).name == 'strategy3'
+    assert cheapestPlan(plans).nbytes == 10*10*100*4
+    # plans that need more memory are left out
+    result = 10*10*100*4
+    assert cheapestPlan(plans,max_memory=3*result).name == 'strategy3'
+    with pytest.raises(ValueError):
+        cheapestPlan(plans,max_memory=result)
+    # a partition read within a memory limit reads one channel at a time
+    plans = planCutout(geometry,box,num_threads=4,maxread=400*1024**2,max_memory=result + 2*4*10**6)
+    assert plans['partition'].num_threads == 2
+    assert max([length for (start,length) in plans['partition'].ranges]) == 4*10**6
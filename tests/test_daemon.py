@@ -0,0 +1,110 @@
+''' The cutout daemon: a block cache shared by overlapping requests, one object per request '''
+import json
+import shutil
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import ACCESS,SECRET
+
+from S3Object import *
+from CutoutDaemon import CutoutDaemon,DaemonObject
+
+
+def test_block_cache_serves_overlapping_reads():
+    source = bytes(range(256)) * 4000 # 1024000 bytes
+    reads = []
+    def fetch(start,buf):
+        data = source[start:start+len(buf)]
+        buf[:len(data)] = data
+        reads.append((start,len(data)))
+        return len(data)
+    cache = BlockCache(max_bytes=ONE_M,block_size=64*1024)
+    buf = bytearray(300000)
+    assert cache.readInto('a',10000,buf,fetch) == len(buf)
+    assert bytes(buf) == source[10000:310000]
+    assert reads == [(0,320*1024)] # one block-aligned read
+    # an overlapping read only fetches the blocks it does not share
+    buf = bytearray(200000)
+    assert cache.readInto('a',250000,buf,fetch) == len(buf)
+    assert bytes(buf) == source[250000:450000]
+    assert reads[1] == (320*1024,2*64*1024)
+    # reads running to the end of the object are cut short
+    buf = bytearray(50000)
+    assert cache.readInto('a',1000000,buf,fetch) == 24000
+    assert bytes(buf[:24000]) == source[1000000:]
+    assert cache.cached_bytes <= ONE_M
+
+
+def test_daemon_shares_blocks_between_requests(endpoint,bucket,cube,tmp_path):
+    (path,filename,data) = cube
+    S3Object(bucket,filename,ACCESS,SECRET,endpoint).uploadFile(path,filename,progress=False)
+    certs = str(tmp_path / 'certs.json')
+    with open(certs,'w') as f:
+        json.dump({"endpoints":{endpoint:{"projects":{"proj":{"access":ACCESS,"secret":SECRET}}}}},f)
+    socket_path = str(tmp_path / 'daemon.sock')
+    daemon = CutoutDaemon(socket_path,certs,cache_bytes=ONE_M*16,num_threads=2,block_size=64*1024)
+    server = threading.Thread(target=daemon.serve_forever,daemon=True)
+    server.start()
+    try:
+        client = DaemonObject(endpoint,'proj',bucket,filename,socket_path=socket_path)
+        header = client.getHeaderDict()
+        assert int(header["NAXIS3"]) == data.shape[0]
+        # different boxes, served at once, each read through its own object
+        boxes = [(0,29,0,39,0,19),(5,20,10,30,2,15),(0,29,0,39,3,9),(1,2,3,4,0,19)]
+        results = [None]*len(boxes)
+        def run(i):
+            results[i] = client.getPartitionData(*boxes[i])
+        threads = [threading.Thread(target=run,args=(i,)) for i in range(len(boxes))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for (box,result) in zip(boxes,results):
+            (xmin,xmax,ymin,ymax,zmin,zmax) = box
+            assert (result == data[zmin:zmax+1,ymin:ymax+1,xmin:xmax+1].ravel()).all()
+        # the whole cube was read, so every later request is served from cached blocks
+        misses = daemon.cache.misses
+        spectra = client.getSpectra([(3,4),(10,20)])
+        assert (spectra == np.array([data[:,4,3],data[:,20,10]])).all()
+        assert daemon.cache.misses == misses
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+
+
+def test_daemon_keeps_objects_apart_by_certs(endpoint,bucket,cube,tmp_path):
+    (path,filename,data) = cube
+    S3Object(bucket,filename,ACCESS,SECRET,endpoint).uploadFile(path,filename,progress=False)
+    certs = str(tmp_path / 'certs.json')
+    with open(certs,'w') as f:
+        json.dump({"endpoints":{endpoint:{"projects":{"proj":{"access":ACCESS,"secret":SECRET}}}}},f)
+    # another user's certs, without keys for the project
+    other = str(tmp_path / 'other.json')
+    with open(other,'w') as f:
+        json.dump({"endpoints":{endpoint:{"projects":{"elsewhere":{"access":ACCESS,"secret":SECRET}}}}},f)
+    socket_path = str(tmp_path / 'daemon.sock')
+    daemon = CutoutDaemon(socket_path,certs,cache_bytes=ONE_M*16,num_threads=2,block_size=64*1024)
+    server = threading.Thread(target=daemon.serve_forever,daemon=True)
+    server.start()
+    try:
+        box = (0,29,0,39,0,19)
+        client = DaemonObject(endpoint,'proj',bucket,filename,socket_path=socket_path)
+        assert (client.getPartitionData(*box) == data.ravel()).all()
+        # the header and objects cached for the daemon's certs are not used for other certs
+        stranger = DaemonObject(endpoint,'proj',bucket,filename,socket_path=socket_path,certs=other)
+        with pytest.raises(RuntimeError,match="KeyError"):
+            stranger.getPartitionData(*box)
+        with pytest.raises(RuntimeError,match="KeyError"):
+            stranger.getHeaderDict()
+        # the same keys in another file read their own header, then share the cached blocks
+        mine = str(tmp_path / 'mine.json')
+        shutil.copy(certs,mine)
+        same = DaemonObject(endpoint,'proj',bucket,filename,socket_path=socket_path,certs=mine)
+        misses = daemon.cache.misses
+        assert (same.getPartitionData(*box) == data.ravel()).all()
+        assert daemon.cache.misses == misses
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
@@ -0,0 +1,82 @@
+''' Headers of local FITS files, read from the header blocks alone, and their upload metadata '''
+import io
+
+import numpy as np
+import pytest
+
+from conftest import writeWCSCube
+
+import FITSheader as FITSheaderModule
+from FITSheader import *
+
+
+def recordReads(monkeypatch):
+    ''' Record the number of bytes asked for by each read of a file opened by FITSheader '''
+    reads = []
+    class RecordingFile(io.FileIO):
+        def read(self,size=-1):
+            reads.append(size)
+            return io.FileIO.read(self,size)
+    monkeypatch.setattr(FITSheaderModule,'open',lambda path,mode: RecordingFile(path,mode),raising=False)
+    return reads
+
+
+def test_header_blocks_only(tmp_path,monkeypatch):
+    from astropy.io import fits
+    path = str(tmp_path / 'cube.fits')
+    writeWCSCube(path,shape=(40,200,300))
+    reads = recordReads(monkeypatch)
+    hdr = FITSheaderFromFile(path)
+    assert reads == [HEADER_READ]
+    header = fits.getheader(path)
+    assert hdr.len() == len(header.tostring())
+    assert hdr.rawHdrData() == header.tostring().encode()
+    assert hdr.getHeaderDict()["CTYPE3"] == 'FREQ'
+    # the astropy HDUList is only opened when asked for
+    assert hdr._FITSheaderFromFile__hdul is None
+    assert hdr.hdul[0].header["NAXIS1"] == 300
+
+
+def test_header_longer_than_one_read(tmp_path,monkeypatch):
+    from astropy.io import fits
+    path = str(tmp_path / 'history.fits')
+    hdu = fits.PrimaryHDU(np.zeros((2,3,4),dtype='>f4'))
+    for n in range(HEADER_READ // 80 + 100):
+        hdu.header.add_history('step %s' % n)
+    hdu.writeto(path)
+    reads = recordReads(monkeypatch)
+    hdr = FITSheaderFromFile(path)
+    assert reads == [HEADER_READ,HEADER_READ]
+    assert hdr.rawHdrData() == hdu.header.tostring().encode()
+
+
+def test_not_fits(tmp_path):
+    with open(str(tmp_path / 'notes.txt'),'w') as f:
+        f.write('not a FITS file')
+    for path in (str(tmp_path / 'notes.txt'),str(tmp_path / 'missing.fits')):
+        hdr = FITSheaderFromFile(path)
+        assert hdr.len() == 0
+        assert hdr.convert2dict() == {}
+
+
+def test_convert2dict(tmp_path):
+    from astropy.io import fits
+    path = str(tmp_path / 'cube.fits')
+    writeWCSCube(path)
+    fits.setval(path,'HISTORY',value='made for a test')
+    fits.setval(path,'OBJECT',value='a source')
+    fits.append(path,np.zeros((2,2),dtype='>f4'))
+    hdr = FITSheaderFromFile(path)
+    metadata = hdr.convert2dict()["Metadata"]
+    assert metadata["NAXIS3"] == '20' and metadata["OBJECT"] == 'a source' and metadata["RESTFRQ"] == '1420405752.0'
+    assert 'HISTORY' not in metadata and 'COMMENT' not in metadata
+    # keywords in order of priority, with patterns
+    metadata = hdr.convert2dict(keywords=['OBJECT','CTYPE*'])["Metadata"]
+    assert list(metadata) == ['OBJECT','CTYPE1','CTYPE2','CTYPE3']
+    assert list(hdr.convert2dict(keywords=CUBE_KEYWORDS)["Metadata"])[:4] == ['SIMPLE','BITPIX','NAXIS','NAXIS1']
+    # keywords are dropped once the limit is reached
+    metadata = hdr.convert2dict(limit=60)["Metadata"]
+    assert sum([len(key) + len(value) for (key,value) in metadata.items()]) <= 60
+    assert list(metadata) == list(hdr.convert2dict()["Metadata"])[:len(metadata)]
+    # other HDUs come from astropy
+    assert hdr.convert2dict(hdrpos=1)["Metadata"]["XTENSION"] == 'IMAGE'
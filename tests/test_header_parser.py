@@ -0,0 +1,74 @@
+''' The vectorised header parser gives the same keywords and values as astropy '''
+import pytest
+
+from HeaderParser import *
+
+fits = pytest.importorskip('astropy.io.fits')
+
+
+def makeHeader():
+    ''' A header holding each kind of card the parser handles '''
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    for (axis,size) in enumerate((30,40,20)):
+        header['NAXIS%s' % (axis+1)] = size
+    header['EXTEND'] = (False,'a false logical')
+    header['BSCALE'] = (1.5e-3,'a real')
+    header['BIGINT'] = 12345678901
+    header['NEGREAL'] = -2.25
+    header['OBJECT'] = ("O'Brien / field","quote and slash inside the string")
+    header['EMPTY'] = ''
+    header['TRAIL'] = 'padded   '
+    header['CPLX'] = (complex(1.5,-2.0),'a complex value')
+    header['UNDEF'] = (None,'an undefined value')
+    header['LONGSTR'] = ('a long string that runs well past the seventy characters of one card, ' * 3).strip()
+    header['HIERARCH ESO DET CHIP NAME'] = ('CCD-44','a HIERARCH keyword')
+    header['HIERARCH ESO TEL ALT'] = 45.5
+    header['COMMENT'] = 'first comment'
+    header['COMMENT'] = 'second comment / with a slash'
+    header['HISTORY'] = 'made for the tests'
+    raw = header.tostring().encode()
+    # astropy writes E exponents - add a card with a Fortran D exponent by hand
+    card = ('DEXP    = %20s / a D exponent' % '1.25D+03').ljust(80).encode()
+    end = raw.index(b'END     ')
+    raw = raw[:end] + card + raw[end:-80]
+    return (raw,fits.Header.fromstring(raw.decode()))
+
+
+def test_parse_header_matches_astropy():
+    (raw,header) = makeHeader()
+    parsed = parseHeader(raw)
+    comments = []
+    for card in header.cards:
+        if card.keyword == 'COMMENT':
+            comments.append(card.value)
+            continue
+        if card.keyword == 'HISTORY':
+            assert parsed['HISTORY'].strip() == card.value
+            continue
+        value = parsed[card.keyword]
+        if card.value is fits.card.UNDEFINED:
+            assert value is None
+        elif isinstance(card.value,float):
+            assert isinstance(value,float) and value == pytest.approx(card.value)
+        else:
+            assert type(value) == type(card.value) and value == card.value, card.keyword
+    assert [parsed['COMMENT_%s' % i] for i in range(len(comments))] == comments
+
+
+def test_parse_cards_keeps_comments_and_order():
+    (raw,header) = makeHeader()
+    cards = [card for card in parseCards(raw) if card[0] not in ('COMMENT','HISTORY')]
+    expected = [card for card in header.cards if card.keyword not in ('COMMENT','HISTORY')]
+    assert [key for (key,value,comment) in cards] == [card.keyword for card in expected]
+    for ((key,value,comment),card) in zip(cards,expected):
+        assert comment == card.comment, key
+
+
+def test_header_cards_stop_at_end():
+    (raw,header) = makeHeader()
+    (cards,keys) = headerCards(raw + b' ' * 2880)
+    assert keys.tolist()[-1] == b'DEXP'
+    assert len(keys) == raw.index(b'END     ') // 80 # every card before END, CONTINUE cards included
@@ -0,0 +1,42 @@
+''' Importing the package stays cheap: boto3 and astropy are only imported when first used,
+    and the time the package itself adds on top of numpy is kept within a budget.
+'''
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ('boto3','botocore','astropy')
+OWN_BUDGET = 150000 # us the package may add to a cold import beyond numpy (10-15ms when measured)
+RUNS = 3
+
+
+def coldImport(module):
+    ''' Import 'module' in a fresh interpreter with -X importtime, and return {imported module:
+        cumulative us} from the report.
+    '''
+    result = subprocess.run([sys.executable,'-X','importtime','-c','import %s' % module],
+                            cwd=ROOT,capture_output=True,text=True,check=True)
+    # each line of the report is "import time: self [us] | cumulative | imported package"
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            (own,cumulative,name) = line[len('import time:'):].split('|')
+            times.setdefault(name.strip(),int(cumulative))
+    return times
+
+
+@pytest.mark.parametrize('module',['ObjStore','S3Object','URLObject','FITSheader'])
+def test_cold_import_skips_heavy_dependencies(module):
+    imported = set([name.split('.')[0] for name in coldImport(module)])
+    assert module in imported
+    assert not imported.intersection(HEAVY)
+
+
+@pytest.mark.parametrize('module',['ObjStore','S3Object','URLObject'])
+def test_cold_import_time_within_budget(module):
+    # the best of a few runs, so a busy machine does not fail the test
+    own = min([times[module] - times.get('numpy',0) for times in [coldImport(module) for i in range(RUNS)]])
+    assert own < OWN_BUDGET, "import %s adds %sus beyond numpy (budget %sus)" % (module,own,OWN_BUDGET)
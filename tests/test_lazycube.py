@@ -0,0 +1,54 @@
+''' The lazy array view of a cube: indexing like numpy, chunks and dask '''
+import numpy as np
+import pytest
+
+from S3Object import *
+
+
+def test_indexing_matches_numpy(s3cube):
+    (obj,hdr,data) = s3cube
+    cube = obj.asLazyArray(hdr)
+    assert (cube.shape,cube.dtype,cube.ndim,len(cube)) == (data.shape,data.dtype,3,20)
+    assert cube.nbytes == data.nbytes
+    for key in [5,(5,10),(5,10,20),(-1,-2,-3),(slice(2,9,3),slice(None,None,-7),[4,0,29]),
+                (Ellipsis,3),(1,Ellipsis),([19,0],),(slice(5,5),),(np.int64(4),slice(1,3))]:
+        got = cube[key]
+        assert got.shape == data[key].shape
+        assert np.array_equal(got,data[key])
+    assert np.array_equal(np.asarray(cube),data)
+    with pytest.raises(IndexError):
+        cube[20]
+    with pytest.raises(IndexError):
+        cube[0,0,0,0]
+
+
+def test_chunks(s3cube):
+    (obj,hdr,data) = s3cube
+    cube = obj.asLazyArray(hdr)
+    # whole channels fit in the default chunk size
+    assert cube.chunks == (20,40,30)
+    assert cube.defaultChunks(chunk_bytes=30*40*4*3) == (3,40,30)
+    assert cube.defaultChunks(chunk_bytes=30*4*7) == (1,7,30)
+    cube = obj.asLazyArray(hdr,chunks=(8,40,16))
+    boxes = cube.chunkBoxes()
+    assert len(boxes) == 3*1*2
+    assert boxes[(2,0,1)] == (16,29,0,39,16,19)
+    # every pixel is in exactly one chunk
+    covered = np.zeros(data.shape,dtype=int)
+    for (xmin,xmax,ymin,ymax,zmin,zmax) in boxes.values():
+        covered[zmin:zmax+1,ymin:ymax+1,xmin:xmax+1] += 1
+    assert (covered == 1).all()
+    chunkmap = cube.chunkMap(gap=0)
+    assert sorted(chunkmap) == sorted(boxes)
+    # one read per channel of a chunk that is not whole rows, one read for the chunk of whole channels
+    assert len(chunkmap[(0,0,0)]) == 8
+    assert len(obj.asLazyArray(hdr,chunks=(8,40,30)).chunkMap(gap=0)[(0,0,0)]) == 1
+
+
+def test_dask_array(s3cube):
+    pytest.importorskip('dask')
+    (obj,hdr,data) = s3cube
+    array = obj.asLazyArray(hdr,chunks=(8,40,16)).to_dask()
+    assert array.chunks == ((8,8,4),(40,),(16,14))
+    assert np.array_equal(array[3:12,5,::2].compute(),data[3:12,5,::2])
+    assert np.isclose(array.sum().compute(scheduler='threads'),data.astype(float).sum(),rtol=1e-5)
@@ -0,0 +1,67 @@
+''' Rate limits of a project applied to every request its objects make '''
+import uuid
+
+from conftest import ACCESS,SECRET
+
+from S3Object import *
+from URLObject import *
+from RateLimiter import configureLimiter
+
+
+def countingLimiter(endpoint,project):
+    ''' Configure a (generous) project limiter that records the bytes of each acquire '''
+    limiter = configureLimiter(endpoint,project,requests_per_s=1e6)
+    limiter.calls = []
+    acquire = limiter.acquire
+    def counted(nbytes=0,requests=1):
+        limiter.calls.append(nbytes)
+        return acquire(nbytes,requests)
+    limiter.acquire = counted
+    return limiter
+
+
+def test_project_limiter_covers_s3_reads(endpoint,bucket,cube):
+    (path,filename,data) = cube
+    S3Object(bucket,filename,ACCESS,SECRET,endpoint).uploadFile(path,filename,progress=False)
+    project = 'proj-%s' % uuid.uuid4().hex[:8]
+    limiter = countingLimiter(endpoint,project)
+
+    hdr = FITSheaderFromS3(endpoint,bucket,filename,ACCESS,SECRET,project)
+    assert limiter.calls and limiter.calls[0] == FITS_HEADER_BLOCK_SIZE
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint,project)
+    assert obj.project == project
+    limiter.calls.clear()
+    (z,y,x) = data.shape
+    out = obj.getPartitionData(0,x-1,0,y-1,0,z-1,hdr,2)
+    assert (out == data.ravel()).all()
+    assert limiter.calls
+    # Objects made for another project are not limited by this one
+    limiter.calls.clear()
+    S3Object(bucket,filename,ACCESS,SECRET,endpoint,'other').getObjectSize()
+    assert not limiter.calls
+
+
+def test_project_limiter_covers_url_reads(endpoint,bucket,cube):
+    (path,filename,data) = cube
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.uploadFile(path,filename,progress=False,checksum=True)
+    url = obj.client.generate_presigned_url(ClientMethod='get_object',Params={'Bucket':bucket,'Key':filename})
+    crcurl = obj.client.generate_presigned_url(ClientMethod='get_object',Params={'Bucket':bucket,'Key':filename+CHECKSUM_SUFFIX})
+    project = 'proj-%s' % uuid.uuid4().hex[:8]
+    limiter = countingLimiter(endpoint,project)
+
+    hdr = FITSheaderFromURL(url,project)
+    assert limiter.calls == [FITS_HEADER_BLOCK_SIZE] * (hdr.length // FITS_HEADER_BLOCK_SIZE)
+    urlobj = UrlObject(url,project=project)
+    limiter.calls.clear()
+    assert urlobj.getObjectSize() == os.path.getsize(path + '/' + filename)
+    assert limiter.calls == [1]
+    urlobj.getObjectHeaders()
+    assert limiter.calls == [1,1]
+    assert urlobj.loadChecksums(crcurl)
+    assert len(limiter.calls) == 3
+    limiter.calls.clear()
+    (z,y,x) = data.shape
+    out = urlobj.getPartitionData(0,x-1,0,y-1,0,z-1,hdr,2)
+    assert (out == data.ravel()).all()
+    assert limiter.calls
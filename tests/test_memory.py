@@ -0,0 +1,46 @@
+''' Memory-limited partition reads: the result plus the reads in flight stay within max_memory '''
+import io
+import tracemalloc
+
+from conftest import writeCube
+
+from ObjStore import *
+
+
+class LocalClient:
+    ''' Serves range reads of a local file held in memory, as a boto3 client would - so 
+        tracemalloc sees only the allocations of the read path (not of an S3 server)
+    '''
+    def __init__(self,path):
+        with open(path,'rb') as f:
+            self.content = f.read()
+
+    def get_object(self,Bucket,Key,Range):
+        (first,last) = [int(v) for v in Range.split('=')[1].split('-')]
+        return {'Body':io.BytesIO(self.content[first:last+1])}
+
+    def head_object(self,Bucket,Key):
+        return {'ContentLength':len(self.content)}
+
+
+def test_partition_read_peak_within_max_memory(tmp_path):
+    path = str(tmp_path / 'big.fits')
+    data = writeCube(path,shape=(40,200,300),seed=2)
+    obj = FitsObjStore(mode='s3')
+    (obj.bucket,obj.obj,obj.client) = ('local','big.fits',LocalClient(path))
+    obj.setBufferPool(BufferPool())
+    hdr = FITSheaderFromFile(path)
+    hdr.getHeaderDict()
+    (xmin,xmax,ymin,ymax) = (10,289,5,194)
+    result = 40*(ymax-ymin+1)*(xmax-xmin+1)*FITS_FLOAT_SIZE
+    max_memory = result + 2*200*300*FITS_FLOAT_SIZE # room for two channels in flight
+    tracemalloc.start()
+    try:
+        out = obj.getPartitionData(xmin,xmax,ymin,ymax,0,39,hdr,4,max_memory=max_memory)
+        (current,peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert (out == data[:,ymin:ymax+1,xmin:xmax+1].ravel()).all()
+    # pooled read buffers are mmaps, which are not traced: what is traced is the result,
+    # the range bodies in flight and small change - never a second copy of the result
+    assert peak < max_memory + ONE_M
@@ -0,0 +1,116 @@
+''' Presigned multipart uploads: resuming, part checks, aborting and the stored object '''
+import hashlib
+import json
+import types
+
+import numpy as np
+import pytest
+import urllib3
+
+from conftest import ACCESS,SECRET
+
+from URLObject import *
+from Checksums import compositeMD5, ChecksumError
+
+PARTSIZE = ONE_M * 5 # the smallest part S3 allows
+
+
+def s3client(endpoint):
+    import boto3
+    return boto3.client('s3',aws_access_key_id=ACCESS,aws_secret_access_key=SECRET,endpoint_url=endpoint,region_name='us-east-1')
+
+
+@pytest.fixture
+def upload(endpoint,bucket,tmp_path):
+    ''' A file of two and a half parts, and a presigned multipart upload for it '''
+    path = str(tmp_path / 'big.bin')
+    data = np.random.default_rng(1).integers(0,256,size=PARTSIZE*5//2,dtype=np.uint8).tobytes()
+    with open(path,'wb') as f:
+        f.write(data)
+    certs = str(tmp_path / 'certs.json')
+    with open(certs,'w') as f:
+        json.dump({"endpoints":{endpoint:{"projects":{"proj":{"access":ACCESS,"secret":SECRET}}}}},f)
+    upload_dict = UrlObject(project='proj').create_presigned_url_upload(certs,endpoint,'proj',bucket,'big.bin',
+                                                                       filesize=len(data),partsize=PARTSIZE)
+    return (path,data,upload_dict)
+
+
+def countingRequests(obj,change=None):
+    ''' Record the (method,part url) of each request the object makes, and let 'change(method,
+        url,kwargs,response)' alter a request or its response
+    '''
+    sent = []
+    request = obj.urlRequest
+    def urlRequest(method,url,nbytes=0,http=None,**kwargs):
+        sent.append((method,url))
+        if change:
+            return change(method,url,kwargs,lambda: request(method,url,nbytes,http,**kwargs))
+        return request(method,url,nbytes,http,**kwargs)
+    obj.urlRequest = urlRequest
+    return sent
+
+
+def test_rerun_skips_matching_parts(endpoint,bucket,upload):
+    (path,data,upload_dict) = upload
+    multipart = upload_dict['multipart']
+    assert len(multipart['parts']) == 3
+    # an earlier attempt stored part 1, and a part 2 that does not match the file
+    http = urllib3.PoolManager()
+    assert http.request("PUT",multipart['parts'][0],body=data[:PARTSIZE]).status == 200
+    assert http.request("PUT",multipart['parts'][1],body=b'x'*PARTSIZE).status == 200
+
+    obj = UrlObject(project='proj')
+    sent = countingRequests(obj)
+    assert obj.upload_via_URL(path,upload_dict,num_threads=2) == 200
+    puts = [url for (method,url) in sent if method == "PUT"]
+    assert sorted(puts) == sorted(multipart['parts'][1:])
+
+    client = s3client(endpoint)
+    assert client.get_object(Bucket=bucket,Key='big.bin')['Body'].read() == data
+    parts = [hashlib.md5(data[n:n+PARTSIZE]).digest() for n in range(0,len(data),PARTSIZE)]
+    assert client.head_object(Bucket=bucket,Key='big.bin')['ETag'].strip('"') == compositeMD5(parts)
+
+
+def test_part_stored_with_wrong_etag(upload):
+    (path,data,upload_dict) = upload
+    def change(method,url,kwargs,send):
+        response = send()
+        if method == "PUT" and url == upload_dict['multipart']['parts'][2]:
+            return types.SimpleNamespace(status=response.status,data=response.data,headers={'ETag':'"%s"' % ('0'*32)})
+        return response
+    obj = UrlObject(project='proj')
+    countingRequests(obj,change)
+    with pytest.raises(ChecksumError,match="Part 3"):
+        obj.upload_via_multipart_URL(path,upload_dict,num_threads=1)
+
+
+def test_part_corrupted_on_the_way(upload):
+    (path,data,upload_dict) = upload
+    def change(method,url,kwargs,send):
+        if method == "PUT" and url == upload_dict['multipart']['parts'][0]:
+            # corrupted on the way - the Content-MD5 of the part no longer matches
+            kwargs['body'] = b'y' + kwargs['body'][1:]
+        return send()
+    obj = UrlObject(project='proj')
+    countingRequests(obj,change)
+    # an objectstore that checks Content-MD5 refuses the part, otherwise its ETag gives it away
+    with pytest.raises(IOError,match="(?i)part 1"):
+        obj.upload_via_multipart_URL(path,upload_dict,num_threads=1)
+
+
+def test_wrong_size_and_abort(endpoint,bucket,upload,tmp_path):
+    (path,data,upload_dict) = upload
+    other = str(tmp_path / 'other.bin')
+    with open(other,'wb') as f:
+        f.write(data[:-1])
+    obj = UrlObject(project='proj')
+    with pytest.raises(ValueError):
+        obj.upload_via_multipart_URL(other,upload_dict)
+
+    http = urllib3.PoolManager()
+    assert http.request("PUT",upload_dict['multipart']['parts'][0],body=data[:PARTSIZE]).status == 200
+    assert obj.abort_via_URL(upload_dict) == 204
+    client = s3client(endpoint)
+    assert not client.list_multipart_uploads(Bucket=bucket).get('Uploads')
+    assert http.request("GET",upload_dict['multipart']['list']).status == 404
+    assert 'Contents' not in client.list_objects_v2(Bucket=bucket)
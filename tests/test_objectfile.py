@@ -0,0 +1,77 @@
+''' The seekable file object over an object: block cache, readahead and large reads '''
+import io
+
+import numpy as np
+import pytest
+
+from ObjectFile import ObjectRawIO,openObject
+
+
+class BytesObject:
+    ''' Stands in for an S3Object holding 'data', recording the (start,length) of each read '''
+
+    def __init__(self,data):
+        self.data = data
+        self.obj = 'bytes'
+        self.reads = []
+
+    def getObjectSize(self):
+        return len(self.data)
+
+    def readBytes(self,start,length):
+        self.reads.append((start,length))
+        return self.data[start:start+length]
+
+
+def test_seek_and_read():
+    data = bytes(range(256)) * 40
+    f = openObject(BytesObject(data),blocksize=100,cacheblocks=4,maxreadahead=8)
+    assert f.read(10) == data[:10]
+    assert f.seek(-5,io.SEEK_END) == len(data) - 5
+    assert f.read() == data[-5:]
+    assert f.read(3) == b''
+    f.seek(1234)
+    f.seek(100,io.SEEK_CUR)
+    assert f.tell() == 1334
+    assert f.read(500) == data[1334:1834]
+    with pytest.raises((ValueError,OSError)):
+        f.seek(-1)
+
+
+def test_readahead_doubles_then_resets():
+    obj = BytesObject(bytes(10000))
+    raw = ObjectRawIO(obj,blocksize=100,cacheblocks=64,maxreadahead=4)
+    buf = bytearray(100)
+    for n in range(12):
+        raw.readinto(buf)
+    # sequential blocks: the first read is one block, each one after doubles up to 4
+    assert obj.reads == [(0,100),(100,200),(300,400),(700,400),(1100,400)]
+    del obj.reads[:]
+    raw.seek(5000)
+    raw.readinto(buf)
+    raw.seek(100) # cached - no read
+    raw.readinto(buf)
+    assert obj.reads == [(5000,100)]
+    # a read of the whole readahead window or more goes straight to the object
+    raw.seek(7000)
+    assert raw.readinto(bytearray(400)) == 400
+    assert obj.reads[-1] == (7000,400)
+
+
+def test_cache_keeps_the_latest_blocks():
+    obj = BytesObject(bytes(1000))
+    raw = ObjectRawIO(obj,blocksize=100,cacheblocks=2,maxreadahead=1)
+    buf = bytearray(10)
+    for pos in (0,500,0,900,500):
+        raw.seek(pos)
+        raw.readinto(buf)
+    # block 0 was used again before block 9 was read, so block 5 was the one removed
+    assert [start for (start,length) in obj.reads] == [0,500,900,500]
+
+
+def test_astropy_reads_through_the_file_object(s3cube):
+    from astropy.io import fits
+    (obj,hdr,data) = s3cube
+    with fits.open(obj.open(blocksize=4096,maxreadahead=4)) as hdul:
+        assert np.array_equal(hdul[0].data[3:5,10:20],data[3:5,10:20])
+        assert hdul[0].header["NAXIS3"] == data.shape[0]
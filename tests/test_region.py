@@ -0,0 +1,89 @@
+''' Polygon and mask regions, read as row runs '''
+import numpy as np
+import pytest
+
+from S3Object import *
+from RegionMask import polygonMask,rowRuns
+
+
+def test_polygon_mask():
+    # pixel centres x 2..5, y 2..4 are inside
+    (mask,origin) = polygonMask([(1.5,1.5),(5.5,1.5),(5.5,4.5),(1.5,4.5)])
+    assert origin == (1,1) and mask.shape == (5,6)
+    (ys,xs) = np.nonzero(mask)
+    assert sorted(set(xs + 1)) == [2,3,4,5] and sorted(set(ys + 1)) == [2,3,4] and mask.sum() == 12
+    # an L shape: the notch at x > 3, y > 3 is left out
+    (mask,origin) = polygonMask([(0,0),(6,0),(6,3),(3,3),(3,6),(0,6)])
+    expected = np.zeros((7,7),dtype=bool)
+    expected[0:3,0:6] = True
+    expected[3:6,0:3] = True
+    # centres on the lower and left edges are inside, on the upper and right edges outside
+    assert origin == (0,0)
+    assert np.array_equal(mask,expected)
+    # clipped to the channel, and empty off it
+    (mask,origin) = polygonMask([(-5,-5),(2.5,-5),(2.5,2.5),(-5,2.5)],xsize=10,ysize=10)
+    assert origin == (0,0) and mask.shape == (4,4) and mask[:3,:3].all() and not mask[3].any()
+    assert polygonMask([(20,20),(25,20),(25,25)],xsize=10,ysize=10)[0].size == 0
+    with pytest.raises(ValueError):
+        polygonMask([(0,0),(1,1)])
+
+
+def test_row_runs():
+    mask = np.array([[[0,1,1,0,1],[1,1,1,1,1]],[[0,0,0,0,0],[1,0,0,0,1]]],dtype=bool)
+    (z,y,xstart,xend) = rowRuns(mask)
+    assert list(zip(z,y,xstart,xend)) == [(0,0,1,3),(0,0,4,5),(0,1,0,5),(1,1,0,1),(1,1,4,5)]
+
+
+def test_coalesce_spans():
+    starts = np.array([0,10,100,1000])
+    lengths = np.array([8,8,8,8])
+    assert coalesceSpans(starts,lengths,gap=1) == [(0,8,0,1),(10,8,1,2),(100,8,2,3),(1000,8,3,4)]
+    assert coalesceSpans(starts,lengths,gap=100) == [(0,108,0,3),(1000,8,3,4)]
+    # a read stops once it reaches maxlen (and can pass it by one span)
+    assert coalesceSpans(starts,lengths,gap=1000,maxlen=50) == [(0,18,0,2),(100,8,2,3),(1000,8,3,4)]
+    assert coalesceSpans([],[]) == []
+
+
+def test_region_data(s3cube):
+    (obj,hdr,data) = s3cube
+    polygon = [(2.5,3.5),(20.5,8.5),(9.5,30.5)]
+    (mask,(x0,y0)) = polygonMask(polygon,30,40)
+    (ny,nx) = mask.shape
+    (coords,values) = obj.getRegionData(polygon,hdr,4,9,num_threads=2)
+    (ys,xs) = np.nonzero(mask)
+    assert len(values) == 6*len(ys)
+    assert np.array_equal(values,data[coords[:,0],coords[:,1],coords[:,2]])
+    assert set(map(tuple,coords[:,1:])) == set(zip(ys + y0,xs + x0))
+
+    (bounds,masked) = obj.getRegionData(polygon,hdr,4,9,output='masked')
+    assert bounds == (x0,x0+nx-1,y0,y0+ny-1,4,9)
+    box = data[4:10,y0:y0+ny,x0:x0+nx]
+    assert np.array_equal(masked.mask,np.broadcast_to(~mask,box.shape))
+    assert np.array_equal(masked.compressed(),box[:,mask].ravel())
+
+    # a mask with its own channel selection - every other channel of a 3x2 block
+    block = np.ones((2,3),dtype=bool)
+    channels = np.zeros((4,2,3),dtype=bool)
+    channels[::2] = True
+    (coords,values) = obj.getRegionData(block,hdr,0,3,origin=(5,6),channel_mask=channels)
+    assert np.array_equal(values,data[[0,0,0,0,0,0,2,2,2,2,2,2],[6,6,6,7,7,7]*2,[5,6,7]*4])
+    with pytest.raises(ValueError):
+        obj.getRegionData(block,hdr,0,3,origin=(28,0))
+    with pytest.raises(ValueError):
+        obj.getRegionData(block,hdr,0,3,channel_mask=np.ones((3,2,3),dtype=bool))
+    with pytest.raises(ValueError):
+        obj.getRegionData(block,hdr,output='dense')
+
+
+def test_region_reads_only_its_rows(s3cube):
+    (obj,hdr,data) = s3cube
+    reads = []
+    read = obj.readPooled
+    def recordRead(start,length):
+        reads.append((start,length))
+        return read(start,length)
+    obj.readPooled = recordRead
+    mask = np.array([[1,1,0,0,1],[0,0,0,0,0],[0,1,1,1,0]],dtype=bool)
+    obj.getRegionData(mask,hdr,7,7,origin=(10,20),gap=0)
+    first = hdr.len() + 7*30*40*4
+    assert sorted(reads) == [(first + (20*30+10)*4,8),(first + (20*30+14)*4,4),(first + (22*30+11)*4,12)]
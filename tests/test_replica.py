@@ -0,0 +1,51 @@
+''' Spectral-major replicas: the transposed cube and spectrum reads served from it '''
+import io
+
+import numpy as np
+
+from conftest import ACCESS,SECRET,writeWCSCube
+
+from S3Object import *
+
+
+def test_replica_header_reorders_the_axes(tmp_path):
+    from astropy.io import fits
+    writeWCSCube(str(tmp_path / 'wcs.fits'))
+    raw = FITSheaderFromFile(str(tmp_path / 'wcs.fits')).rawHdrData()
+    header = fits.Header.fromstring(replicaHeader(raw).decode())
+    assert [header["NAXIS%s" % n] for n in (1,2,3)] == [20,30,40]
+    assert [header["CTYPE%s" % n] for n in (1,2,3)] == ['FREQ','RA---SIN','DEC--SIN']
+    assert header["CDELT1"] == 1e6 and header["CRPIX2"] == 15.5
+    assert header["OSLAYOUT"] == REPLICA_LAYOUT
+
+
+def test_replica_spectrum_ranges():
+    header = {"NAXIS1":20,"NAXIS2":30,"NAXIS3":40}
+    assert replicaSpectrumRanges([(0,0),(2,1)],header,2880,5,9) == [(2880+5*4,20),(2880+((1*30+2)*20+5)*4,20)]
+
+
+def test_spectra_from_the_replica(s3cube):
+    from astropy.io import fits
+    (obj,hdr,data) = s3cube
+    assert not obj.attachSpectralReplica()
+    # bands of 7 rows (each band is held twice), so the last band is short
+    replica = obj.buildSpectralReplica(hdr,max_memory=2*7*30*20*4)
+    assert replica.obj == obj.obj + REPLICA_SUFFIX
+    body = replica.client.get_object(Bucket=replica.bucket,Key=replica.obj)['Body'].read()
+    assert len(body) % 2880 == 0
+    with fits.open(io.BytesIO(body)) as hdul:
+        assert np.array_equal(hdul[0].data,data.transpose(1,2,0))
+
+    assert obj.attachSpectralReplica()
+    reads = []
+    for o in (obj,obj.replica[0]):
+        def recordRead(start,length,read=o.readPooled,o=o):
+            reads.append((o.obj,start,length))
+            return read(start,length)
+        o.readPooled = recordRead
+    spectra = obj.getSpectra([(7,12),(29,39)],hdr,3,15,gap=0)
+    assert np.array_equal(spectra,np.array([data[3:16,12,7],data[3:16,39,29]]))
+    # one contiguous read of the replica per spectrum
+    assert sorted([(key,length) for (key,start,length) in reads]) == [(replica.obj,13*4)]*2
+    obj.setSpectralReplica(None,None)
+    assert np.array_equal(obj.getSpectra([(7,12)],hdr,3,15),data[3:16,12,7][None,:])
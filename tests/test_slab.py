@@ -0,0 +1,59 @@
+''' Channel slabs copied server-side into a new cube '''
+import numpy as np
+import pytest
+
+from conftest import ACCESS,SECRET,writeWCSCube
+
+from S3Object import *
+
+
+def readCube(obj,key):
+    ''' Return the (astropy header,data) of a stored cube '''
+    import io
+    from astropy.io import fits
+    body = obj.client.get_object(Bucket=obj.bucket,Key=key)['Body'].read()
+    with fits.open(io.BytesIO(body)) as hdul:
+        return (hdul[0].header,hdul[0].data.copy())
+
+
+def test_slab_with_header_of_a_whole_part(endpoint,bucket,tmp_path):
+    # A header of more than MIN_PART fills the first part on its own, with no data after it
+    path = str(tmp_path / 'history.fits')
+    data = writeWCSCube(path,shape=(48,256,256),seed=2)
+    with open(path,'rb') as f:
+        raw = f.read()
+    hdrlen = raw.index(b'END' + b' '*77) # the END card is at a card boundary in this header
+    cards = b''.join([b'HISTORY step %-67d' % n for n in range(MIN_PART//80 + 10)])
+    header = raw[:hdrlen] + cards + b'END' + b' '*77
+    header += b' ' * (-len(header) % FITS_HEADER_BLOCK_SIZE)
+    with open(path,'wb') as f:
+        f.write(header + raw[FITS_HEADER_BLOCK_SIZE:])
+    assert len(header) > MIN_PART
+
+    obj = S3Object(bucket,'history.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(str(tmp_path),'history.fits',progress=False)
+    hdr = FITSheaderFromFile(path)
+    assert hdr.len() == len(header)
+    obj.copyChannelSlab('slab.fits',4,45,hdr)
+    (slabheader,slab) = readCube(obj,'slab.fits')
+    assert slabheader["NAXIS3"] == 42
+    assert slabheader["CRPIX3"] == 1 - 4
+    assert np.array_equal(slab,data[4:46])
+
+
+def test_slab_keeps_the_spectral_axis(endpoint,bucket,tmp_path):
+    from astropy.wcs import WCS
+    path = str(tmp_path / 'wcs.fits')
+    data = writeWCSCube(path)
+    obj = S3Object(bucket,'wcs.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(str(tmp_path),'wcs.fits',progress=False)
+    hdr = FITSheaderFromFile(path)
+    slab = obj.copyChannelSlab('slab.fits',5,9,hdr)
+    assert slab.obj == 'slab.fits'
+    (header,cube) = readCube(obj,'slab.fits')
+    assert np.array_equal(cube,data[5:10])
+    # the first channel of the slab is channel 5 (1.405GHz) of the cube
+    assert (header["NAXIS3"],header["CRPIX3"],header["CRVAL3"]) == (5,1 - 5,1.4e9)
+    assert WCS(header).spectral.pixel_to_world_values(0) == 1.405e9
+    with pytest.raises(ValueError):
+        obj.copyChannelSlab('slab.fits',15,20,hdr)
@@ -0,0 +1,48 @@
+''' Spectra at many pixel positions, read as grouped pixel offsets '''
+import numpy as np
+import pytest
+
+from S3Object import *
+
+
+def test_coalesce_offsets():
+    offsets = np.array([[100,0],[8,10000]])
+    groups = coalesceOffsets(offsets,4,gap=4)
+    assert [(start,length) for (start,length,items,index) in groups] == [(0,12),(100,4),(10000,4)]
+    (start,length,items,index) = groups[0]
+    assert list(items) == [1,2] and list(index) == [0,2]
+    # no gap allowed - each pixel is read on its own
+    assert len(coalesceOffsets(offsets,4,gap=0)) == 4
+    # a long run is split into reads of at most maxlen bytes
+    groups = coalesceOffsets(np.arange(0,400,4),4,gap=0,maxlen=100)
+    assert len(groups) > 1 and max([length for (start,length,items,index) in groups]) <= 100
+    assert np.array_equal(np.concatenate([items for (start,length,items,index) in groups]),np.arange(100))
+    assert coalesceOffsets([],4) == []
+
+
+def test_spectra_match_the_data(s3cube):
+    (obj,hdr,data) = s3cube
+    positions = [(0,0),(29,39),(7,12),(8,12),(7,12)]
+    spectra = obj.getSpectra(positions,hdr,num_threads=2)
+    assert spectra.shape == (5,20)
+    for ((x,y),spectrum) in zip(positions,spectra):
+        assert np.array_equal(spectrum,data[:,y,x])
+    assert np.array_equal(obj.getSpectra([(3,4)],hdr,5,9),data[5:10,4,3][None,:])
+    with pytest.raises(ValueError,match="within"):
+        obj.getSpectra([(30,0)],hdr)
+    with pytest.raises(ValueError,match="Channels"):
+        obj.getSpectra([(0,0)],hdr,5,20)
+
+
+def test_sparse_spectra_read_only_their_pixels(s3cube):
+    (obj,hdr,data) = s3cube
+    reads = []
+    read = obj.readPooled
+    def recordRead(start,length):
+        reads.append((start,length))
+        return read(start,length)
+    obj.readPooled = recordRead
+    # neighbouring pixels share a read in each channel
+    spectra = obj.getSpectra([(7,12),(8,12)],hdr,2,4,gap=0)
+    assert sorted(reads) == [(hdr.len() + z*30*40*4 + (12*30+7)*4,8) for z in (2,3,4)]
+    assert np.array_equal(spectra,data[2:5,12,7:9].T)
@@ -0,0 +1,57 @@
+''' DirectorySync planning and deletion '''
+import os
+
+from conftest import ACCESS,SECRET,writeCube
+
+from S3Object import *
+from S3Sync import *
+
+
+def test_sync_keeps_derived_objects(endpoint,bucket,tmp_path):
+    writeCube(str(tmp_path / 'a.fits'))
+    # Older than any upload, so a.fits is unchanged however the object was stored
+    os.utime(str(tmp_path / 'a.fits'),(1e9,1e9))
+    sync = DirectorySync(bucket,ACCESS,SECRET,endpoint,num_threads=2)
+    sync.sync(str(tmp_path),'pre')
+
+    obj = S3Object(bucket,'pre/a.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(str(tmp_path),'a.fits',progress=False,checksum=True)
+    for key in ('pre/a.fits' + REPLICA_SUFFIX,'pre/a.fits' + TILED_SUFFIX,'pre/gone.fits'):
+        obj.client.put_object(Bucket=bucket,Key=key,Body=b'x')
+
+    summary = sync.sync(str(tmp_path),'pre',delete=True,dryrun=True)
+    assert summary["deleted"] == ['pre/gone.fits']
+    sync.sync(str(tmp_path),'pre',delete=True)
+    remaining = set(sync.listBucket('pre/'))
+    assert 'pre/a.fits' + CHECKSUM_SUFFIX in remaining
+    assert 'pre/a.fits' + HEADER_SIDECAR_SUFFIX in remaining
+    assert 'pre/a.fits' + REPLICA_SUFFIX in remaining
+    assert 'pre/gone.fits' not in remaining
+
+
+def test_sync_drops_stale_checksums(endpoint,bucket,tmp_path):
+    writeCube(str(tmp_path / 'a.fits'))
+    obj = S3Object(bucket,'pre/a.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(str(tmp_path),'a.fits',progress=False,checksum=True)
+    writeCube(str(tmp_path / 'a.fits'),shape=(21,40,30))
+    DirectorySync(bucket,ACCESS,SECRET,endpoint).sync(str(tmp_path),'pre')
+    assert obj.storedChecksums() is None
+
+
+def test_sync_shares_threads_between_uploads(endpoint,bucket,tmp_path):
+    for (n,size) in enumerate((3,3,1)):
+        with open(str(tmp_path / ('big%s.bin' % n)),'wb') as f:
+            f.write(os.urandom(size*MIN_PART + 1))
+    sync = DirectorySync(bucket,ACCESS,SECRET,endpoint,num_threads=4)
+    sync.partsize = MIN_PART
+    concurrency = []
+    upload_file = sync.client.upload_file
+    def recordingUpload(*args,**kwargs):
+        concurrency.append(kwargs['Config'].max_concurrency)
+        return upload_file(*args,**kwargs)
+    sync.client.upload_file = recordingUpload
+    summary = sync.sync(str(tmp_path),'pre')
+    assert sorted(summary["uploaded"]) == ['pre/big0.bin','pre/big1.bin','pre/big2.bin']
+    # three files at once with four threads between them
+    assert concurrency == [1,1,1]
+    assert sync.client.head_object(Bucket=bucket,Key='pre/big0.bin')['ETag'].strip('"') == fileETag(str(tmp_path / 'big0.bin'),MIN_PART)
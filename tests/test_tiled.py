@@ -0,0 +1,88 @@
+''' Reads of tile-compressed objects (see TiledCube) give the same results as the plain layout '''
+import numpy as np
+import pytest
+
+from conftest import ACCESS,SECRET
+
+from S3Object import *
+
+
+@pytest.fixture
+def stored(endpoint,bucket,cube):
+    ''' (plain object,plain header,tiled object,tiled header,data) of one cube stored both ways '''
+    (path,filename,data) = cube
+    plain = S3Object(bucket,'plain.fits',ACCESS,SECRET,endpoint)
+    plain.uploadFile(path,filename,progress=False)
+    tiled = S3Object(bucket,'tiled.fits',ACCESS,SECRET,endpoint)
+    tiled.uploadTiled(path,filename,tile=(4,16,16))
+    return (plain,FITSheaderFromS3(endpoint,bucket,'plain.fits',ACCESS,SECRET),
+            tiled,FITSheaderFromS3(endpoint,bucket,'tiled.fits',ACCESS,SECRET),data)
+
+
+def test_partition_data_matches_plain_layout(stored):
+    (plain,plain_hdr,tiled,tiled_hdr,data) = stored
+    box = (3,25,5,37,2,17)
+    expected = plain.getPartitionData(*box,plain_hdr,2)
+    got = tiled.getPartitionData(*box,tiled_hdr,2)
+    assert got.shape == expected.shape == (23*33*16,)
+    assert np.array_equal(got,expected)
+    for channels in ([9,2,3,4,18],slice(1,20,6)):
+        expected = plain.getPartitionData(*box,plain_hdr,2,channels=channels)
+        got = tiled.getPartitionData(*box,tiled_hdr,2,channels=channels)
+        assert got.shape == expected.shape
+        assert np.array_equal(got,expected)
+
+
+def test_partition_data_reads_only_requested_channels(stored):
+    (plain,plain_hdr,tiled,tiled_hdr,data) = stored
+    reads = []
+    read = tiled.readBytes
+    def recordRead(start,length):
+        reads.append((start,start+length))
+        return read(start,length)
+    tiled.readBytes = recordRead
+    got = tiled.getPartitionData(0,29,0,39,0,0,tiled_hdr,1,channels=[0,17])
+    assert np.array_equal(got,data[[0,17]].ravel())
+    tiles = tiled.getTileIndex(tiled_hdr)
+    # channels 4-15 are in tiles that no requested channel needs
+    for number in tiles.tilesFor(0,29,0,39,4,15):
+        offset = int(tiles.index[number]['offset'])
+        assert not any([start <= offset < end for (start,end) in reads])
+
+
+def test_spectra_match_plain_layout(stored):
+    (plain,plain_hdr,tiled,tiled_hdr,data) = stored
+    positions = [(0,0),(29,39),(7,12),(8,12),(17,33)]
+    expected = plain.getSpectra(positions,plain_hdr,3,15,2)
+    got = tiled.getSpectra(positions,tiled_hdr,3,15,2)
+    assert got.shape == expected.shape == (5,13)
+    assert np.array_equal(got,expected)
+    assert np.array_equal(got[2],data[3:16,12,7])
+
+
+def test_region_data_matches_plain_layout(stored):
+    (plain,plain_hdr,tiled,tiled_hdr,data) = stored
+    polygon = [(2,3),(26,8),(20,35),(5,30)]
+    (coords,expected) = plain.getRegionData(polygon,plain_hdr,4,11)
+    (got_coords,got) = tiled.getRegionData(polygon,tiled_hdr,4,11)
+    assert np.array_equal(got_coords,coords)
+    assert np.array_equal(got,expected)
+
+    region = np.zeros((10,12),dtype=bool)
+    region[2:8,3:5] = True
+    channel_mask = np.random.default_rng(2).random((6,10,12)) > 0.5
+    (bounds,expected) = plain.getRegionData(region,plain_hdr,0,5,origin=(14,20),channel_mask=channel_mask,output='masked')
+    (got_bounds,got) = tiled.getRegionData(region,tiled_hdr,0,5,origin=(14,20),channel_mask=channel_mask,output='masked')
+    assert got_bounds == bounds
+    assert np.array_equal(got.mask,expected.mask)
+    assert np.array_equal(got.filled(0),expected.filled(0))
+
+
+def test_strategies_read_tiles(stored):
+    (plain,plain_hdr,tiled,tiled_hdr,data) = stored
+    box = (1,20,2,30,0,9)
+    expected = plain.getPartitionData(*box,plain_hdr)
+    for strategy in (1,2,3,'auto'):
+        assert np.array_equal(tiled.getPartitionDataByStrategy(*box,tiled_hdr,strategy),expected)
+    with pytest.raises(ValueError):
+        tiled.planPartitionData(*box,tiled_hdr)
@@ -0,0 +1,65 @@
+''' In-place updates: the part planner, and updates of stored objects '''
+import numpy as np
+import pytest
+
+from conftest import ACCESS,SECRET
+
+from S3Object import *
+
+M = ONE_M
+
+
+@pytest.fixture
+def planUpdate():
+    obj = S3Object('bucket','key',ACCESS,SECRET,'http://127.0.0.1:1')
+    return obj._S3Object__planUpdate
+
+
+def checkPlan(plan,size,changes):
+    ''' The segments cover the object in order, hold every change in a data segment, and all
+        but the last reach the multipart minimum
+    '''
+    assert plan[0][1] == 0 and plan[-1][2] == size
+    for (seg,following) in zip(plan,plan[1:]):
+        assert seg[2] == following[1] and seg[0] != following[0]
+        assert seg[2] - seg[1] >= MIN_PART
+    for (start,end) in changes:
+        assert any([kind == 'data' and lo <= start and end <= hi for (kind,lo,hi) in plan])
+
+
+def test_plan_update(planUpdate):
+    # a small change is grown into the unchanged bytes after it
+    assert planUpdate(50*M,[(20*M,20*M+10)]) == [('copy',0,20*M),('data',20*M,25*M),('copy',25*M,50*M)]
+    # the last part may be small
+    assert planUpdate(7*M,[(0,10)]) == [('data',0,5*M),('copy',5*M,7*M)]
+    assert planUpdate(3*M,[(M,M+10)]) == [('data',0,3*M)]
+    # an unchanged gap too small to copy is uploaded with the changes around it
+    assert planUpdate(50*M,[(10*M,10*M+4),(12*M,12*M+4)]) == [('copy',0,10*M),('data',10*M,15*M),('copy',15*M,50*M)]
+    # growing into a copy that would then be too small takes all of it, up to the next change
+    assert planUpdate(50*M,[(10*M,10*M+4),(18*M,18*M+4)]) == [('copy',0,10*M),('data',10*M,18*M+4),('copy',18*M+4,50*M)]
+    rng = np.random.default_rng(3)
+    for n in range(50):
+        size = int(rng.integers(1,100*M))
+        points = np.unique(rng.integers(0,size,size=2*int(rng.integers(1,6))))
+        changes = [(int(a),int(b)) for (a,b) in zip(points[::2],points[1::2]) if b > a]
+        if changes:
+            checkPlan(planUpdate(size,changes),size,changes)
+
+
+def test_update_ranges(s3cube):
+    (obj,hdr,data) = s3cube
+    size = obj.getObjectSize()
+    obj.updateRanges([(size-4,b'\x00\x00\x00\x01'),(hdr.len(),np.array([2.5],dtype='>f4').tobytes())])
+    expected = data.copy()
+    expected.flat[0] = 2.5
+    stored = obj.client.get_object(Bucket=obj.bucket,Key=obj.obj)['Body'].read()
+    assert len(stored) == size and stored[-4:] == b'\x00\x00\x00\x01'
+    assert np.array_equal(np.frombuffer(stored[hdr.len():hdr.len()+data.nbytes],dtype='>f4'),expected.ravel())
+    with pytest.raises(ValueError,match="outside"):
+        obj.updateRanges([(size-2,b'xxxx')])
+    with pytest.raises(ValueError,match="overlaps"):
+        obj.updateRanges([(100,b'xxxx'),(102,b'yy')])
+    with pytest.raises(ValueError,match="whole number"):
+        obj.updateChannels([(3,np.zeros(10))],hdr)
+    with pytest.raises(ValueError,match="not within"):
+        obj.updateChannels([(19,np.zeros((2,40,30)))],hdr)
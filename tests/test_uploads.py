@@ -0,0 +1,121 @@
+''' Uploads through S3Object and the sidecar objects stored with them '''
+import numpy as np
+
+from conftest import ACCESS,SECRET,writeCube
+
+from S3Object import *
+
+
+def test_upload_header_sidecar(endpoint,bucket,cube):
+    (path,filename,data) = cube
+    obj = S3Object(bucket,'cube.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(path,filename,progress=False)
+    hdr = FITSheaderFromFile(path + '/' + filename)
+    key = obj.uploadHeader(hdr)
+    assert key == 'cube.fits' + HEADER_SIDECAR_SUFFIX
+    stored = obj.client.get_object(Bucket=bucket,Key=key)['Body'].read()
+    assert stored == hdr.rawHdrData()
+
+
+def bigCube(tmp_path):
+    ''' A cube of ~9.6Mb, so it spans several checksum blocks and multipart parts '''
+    data = writeCube(str(tmp_path / 'big.fits'),shape=(40,200,300),seed=1)
+    return (str(tmp_path),'big.fits',data)
+
+
+def readBack(endpoint,bucket,key):
+    ''' Read a whole cube back through a new object, checked against its stored checksums '''
+    obj = S3Object(bucket,key,ACCESS,SECRET,endpoint)
+    assert obj.loadChecksums()
+    hdr = FITSheaderFromS3(endpoint,bucket,key,ACCESS,SECRET)
+    header = hdr.getHeaderDict()
+    (x,y,z) = (int(header["NAXIS1"]),int(header["NAXIS2"]),int(header["NAXIS3"]))
+    obj.readBytes(0,obj.getObjectSize()) # every whole block is checked
+    return obj.getPartitionData(0,x-1,0,y-1,0,z-1,hdr,2).reshape(z,y,x)
+
+
+def test_update_channels_refreshes_checksums(endpoint,bucket,tmp_path):
+    (path,filename,data) = bigCube(tmp_path)
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.setConfig(ONE_M*5,ONE_M*5,4)
+    obj.uploadFile(path,filename,progress=False,checksum=True)
+    hdr = FITSheaderFromS3(endpoint,bucket,filename,ACCESS,SECRET)
+
+    fixed = np.full((3,200,300),7.5,dtype='>f4')
+    obj.updateChannels([(10,fixed)],hdr)
+    expected = data.copy()
+    expected[10:13] = fixed
+    assert np.array_equal(readBack(endpoint,bucket,filename),expected)
+
+    obj.updateRanges([(hdr.len() + 4,np.array([1.25],dtype='>f4').tobytes())])
+    expected.flat[1] = 1.25
+    assert np.array_equal(readBack(endpoint,bucket,filename),expected)
+
+
+def test_unchecked_writes_drop_checksums(endpoint,bucket,tmp_path):
+    (path,filename,data) = bigCube(tmp_path)
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.uploadFile(path,filename,progress=False,checksum=True)
+    assert obj.storedChecksums() is not None
+    obj.uploadFile(path,filename,progress=False)
+    assert obj.storedChecksums() is None
+    assert not S3Object(bucket,filename,ACCESS,SECRET,endpoint).loadChecksums()
+
+    # A channel slab written over a checksummed object
+    slab = S3Object(bucket,'slab.fits',ACCESS,SECRET,endpoint)
+    slab.uploadFile(path,filename,progress=False,checksum=True)
+    hdr = FITSheaderFromS3(endpoint,bucket,filename,ACCESS,SECRET)
+    obj.copyChannelSlab('slab.fits',5,9,hdr)
+    assert slab.storedChecksums() is None
+
+    tiled = S3Object(bucket,'tiled.fits',ACCESS,SECRET,endpoint)
+    tiled.uploadFile(path,filename,progress=False,checksum=True)
+    tiled.uploadTiled(path,filename)
+    assert tiled.storedChecksums() is None
+    tiled.uploadTiled(path,filename,checksum=True)
+    assert tiled.storedChecksums() is not None
+
+
+def test_checked_file_upload_reads_parts_from_disk(endpoint,bucket,tmp_path):
+    (path,filename,data) = bigCube(tmp_path)
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.setConfig(ONE_M*5,ONE_M*5,4)
+    def unseekable(*args,**kwargs):
+        raise AssertionError("uploadFile(checksum=True) must not stream the file through upload_fileobj")
+    obj.client.upload_fileobj = unseekable
+    checksums = obj.uploadFile(path,filename,progress=False,checksum=True)
+    assert checksums.md5.endswith('-2')
+    assert checksums.md5 == obj.client.head_object(Bucket=bucket,Key=filename)['ETag'].strip('"')
+    assert np.array_equal(readBack(endpoint,bucket,filename),data)
+
+
+def test_plain_writes_leave_sidecars_alone(endpoint,bucket,cube):
+    (path,filename,data) = cube
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    deletes = []
+    obj.client.meta.events.register('before-call.s3.DeleteObject',lambda params,**kwargs: deletes.append(params['Key']))
+    obj.uploadFile(path,filename,progress=False)
+    obj.uploadFile(path,filename,progress=False)
+    obj.uploadStream(open(path + '/' + filename,'rb'),chunksize=ONE_M*5)
+    assert deletes == []
+
+    # Without delete permission, an upload over a checksummed object still succeeds
+    obj.uploadFile(path,filename,progress=False,checksum=True)
+    def denied(**kwargs):
+        raise obj.client.exceptions.ClientError({'Error':{'Code':'AccessDenied','Message':'Access Denied'}},'DeleteObject')
+    obj.client.delete_object = denied
+    obj.uploadFile(path,filename,progress=False)
+    assert obj.checksums is None
+
+
+def test_update_keeps_checksum_metadata(endpoint,bucket,tmp_path):
+    (path,filename,data) = bigCube(tmp_path)
+    obj = S3Object(bucket,filename,ACCESS,SECRET,endpoint)
+    obj.setConfig(ONE_M*5,ONE_M*5,4)
+    obj.uploadFile(path,filename,progress=False,checksum=True)
+    obj.updateRanges([(ONE_M*3,b'\0'*1000)],ExtraArgs={"ContentType":"binary/octet-stream"})
+    assert obj.hasChecksums()
+    assert obj.storedChecksums() is not None
+    # so a later plain upload still knows to remove them
+    obj.uploadFile(path,filename,progress=False)
+    assert obj.storedChecksums() is None
@@ -0,0 +1,67 @@
+''' World-coordinate cutouts: sky positions and spectral ranges to pixel bounds '''
+import numpy as np
+import pytest
+
+from conftest import ACCESS,SECRET,writeWCSCube
+
+from S3Object import *
+
+
+def test_batch_with_position_on_far_hemisphere(endpoint,bucket,tmp_path):
+    data = writeWCSCube(str(tmp_path / 'wcs.fits'))
+    obj = S3Object(bucket,'wcs.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(str(tmp_path),'wcs.fits',progress=False)
+    hdr = FITSheaderFromS3(endpoint,bucket,'wcs.fits',ACCESS,SECRET)
+    # (150,50) is on the far side of the sky from the SIN projection centre, so does not project
+    assert skyToPixelBounds(hdr,150.0,50.0,radius=0.05) == [None]
+    results = obj.getSkyPartitionDataBatch([150.0,10.0],[-30.0,50.0],hdr,radius=0.05)
+    assert results[1] == (None,None)
+    (bounds,cutout) = results[0]
+    (xmin,xmax,ymin,ymax,zmin,zmax) = bounds
+    assert (cutout.ravel() == data[zmin:zmax+1,ymin:ymax+1,xmin:xmax+1].ravel()).all()
+
+
+def within(value,low,high):
+    return low <= value <= high
+
+
+def test_sky_to_pixel_bounds(tmp_path):
+    from astropy import units as u
+    writeWCSCube(str(tmp_path / 'wcs.fits'))
+    hdr = FITSheaderFromFile(str(tmp_path / 'wcs.fits'))
+    assert hdr.getWCS() is hdr.getWCS()
+    # the cube centre is pixel (14.5,19.5), and a 0.05 degree cone spans 5 pixels each way
+    # (a pixel whose edge is on the cone may be included)
+    [(xmin,xmax,ymin,ymax,zmin,zmax)] = skyToPixelBounds(hdr,150.0,-30.0,radius=0.05)
+    assert within(xmin,9,10) and within(xmax,19,20) and within(ymin,14,15) and within(ymax,24,25)
+    assert (zmin,zmax) == (0,19)
+
+    # a box clipped at the cube edge, and one off the cube
+    bounds = skyToPixelBounds(hdr,[150.0,150.2,140.0],[-30.0,-30.0,-30.0],box=(0.1,0.04))
+    assert within(bounds[0][2],17,18) and within(bounds[0][3],21,22)
+    assert bounds[1][:2] == (0,2)
+    assert bounds[2] is None
+
+    # channels are 1MHz apart from 1.4GHz - the same range in axis units, as a frequency or
+    # as a radio velocity from RESTFRQ
+    restfrq = 1.420405752e9
+    velocity = lambda f: (1 - f/restfrq) * 299792.458
+    for spectral in ((1.405e9,1.41e9),(1.405,1.41)*u.GHz,(velocity(1.41e9),velocity(1.405e9))*u.km/u.s):
+        [bounds] = skyToPixelBounds(hdr,150.0,-30.0,radius=0.05,spectral=spectral)
+        assert bounds[4:] == (5,10)
+    assert skyToPixelBounds(hdr,150.0,-30.0,radius=0.05,spectral=(1.3e9,1.35e9)) == [None]
+    with pytest.raises(ValueError):
+        skyToPixelBounds(hdr,150.0,-30.0)
+
+
+def test_sky_cutout_matches_pixel_bounds(endpoint,bucket,tmp_path):
+    from astropy import units as u
+    data = writeWCSCube(str(tmp_path / 'wcs.fits'))
+    obj = S3Object(bucket,'wcs.fits',ACCESS,SECRET,endpoint)
+    obj.uploadFile(str(tmp_path),'wcs.fits',progress=False)
+    hdr = FITSheaderFromS3(endpoint,bucket,'wcs.fits',ACCESS,SECRET)
+    (bounds,cutout) = obj.getSkyPartitionData(150.0,-30.0,hdr,box=(0.1,0.1),spectral=(1.405,1.41)*u.GHz)
+    assert bounds == skyToPixelBounds(hdr,150.0,-30.0,box=(0.1,0.1),spectral=(1.405,1.41)*u.GHz)[0]
+    (xmin,xmax,ymin,ymax,zmin,zmax) = bounds
+    assert (cutout.ravel() == data[zmin:zmax+1,ymin:ymax+1,xmin:xmax+1].ravel()).all()
+    assert obj.getSkyPartitionData(10.0,-30.0,hdr,radius=0.05) == (None,None)